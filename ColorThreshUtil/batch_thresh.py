@@ -0,0 +1,380 @@
+"""
+Apply saved threshold presets (see colorthresh.py) to directories of
+images and to video files in parallel, without any GUI. For usage, type:
+    > python batch_thresh.py -h
+"""
+
+import argparse
+import csv
+from multiprocessing import Pool
+import os
+import sys
+import time
+import cv2
+from color_classifier import ColorClassifier
+from threshold_engine import ThresholdEngine, loadPresets
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "multithread"))
+from FrameSource import FrameSource
+from Metrics import RateMeter
+
+IMAGE_EXTENSIONS = (".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp")
+VIDEO_EXTENSIONS = (".avi", ".m4v", ".mkv", ".mov", ".mp4", ".mpeg", ".mpg",
+    ".webm", ".wmv")
+
+# Per-process state set up by _initWorker().
+_worker = {}
+
+def findInputs(paths, segment_frames=0, step=1, exclude=None):
+    """
+    Expand a list of image files, video files, and directories (searched
+    recursively for images and videos) into a sorted list of work units.
+    Each unit is a tuple (key, kind, path, start_frame, end_frame), where
+    kind is "image" or "video". If segment_frames is nonzero, videos
+    whose length is known are split into units of that many frames
+    (rounded up to a multiple of step) so they can be processed in
+    parallel. A file found more than once is listed once, and nothing
+    under the directory exclude (e.g., the output directory, if it is
+    inside an input directory) is searched.
+    """
+
+    exclude = None if exclude is None else os.path.abspath(exclude)
+    files = []
+    seen = set()
+    def add(path):
+        full_path = os.path.abspath(path)
+        if full_path not in seen:
+            seen.add(full_path)
+            files.append(path)
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                if os.path.abspath(root) == exclude:
+                    dirs[:] = []
+                    continue
+                dirs.sort()
+                for name in sorted(names):
+                    add(os.path.join(root, name))
+        else:
+            add(path)
+
+    units = []
+    for path in files:
+        ext = os.path.splitext(path)[1].lower()
+        if ext in IMAGE_EXTENSIONS:
+            units.append((path, "image", path, None, None))
+        elif ext in VIDEO_EXTENSIONS:
+            total = None
+            if segment_frames:
+                cap = cv2.VideoCapture(path)
+                total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+                cap.release()
+            if not total:
+                units.append((path, "video", path, None, None))
+                continue
+            size = -(-segment_frames // step) * step
+            for start in range(0, total, size):
+                end = min(total, start + size)
+                units.append(("{}:{}-{}".format(path, start, end), "video",
+                    path, start, end))
+    return units
+
+def _initWorker(presets, compiled, output_dir, root, step):
+    # Each worker processes one frame at a time; let the pool provide
+    # the parallelism rather than OpenCV's internal threads.
+    cv2.setNumThreads(1)
+    if len(presets) == 1:
+        values = next(iter(presets.values()))
+        _worker["engine"] = ThresholdEngine.fromValues(values)
+        _worker["classifier"] = None
+    else:
+        _worker["classifier"] = ColorClassifier(presets, compiled[3],
+            compiled[:3])
+    _worker.update(output_dir=output_dir, root=root, step=step)
+
+def _classify(img):
+    """
+    Return the mask (one preset) or label image (several presets) of an
+    image and the number of pixels in each class, where class 0 is
+    pixels matching no preset.
+    """
+
+    classifier = _worker["classifier"]
+    if classifier is not None:
+        return classifier.classifyWithCounts(img)
+    mask = _worker["engine"].apply(img)
+    matched = cv2.countNonZero(mask)
+    return mask, [mask.size - matched, matched]
+
+def _outputPath(output_dir, root, path, frame_idx=None):
+    """
+    Return the output path of an image, or of frame frame_idx of a video.
+    Outputs mirror the input tree below root, the deepest directory
+    containing all the inputs.
+    """
+
+    rel = os.path.relpath(os.path.abspath(path), root)
+    stem = os.path.splitext(rel)[0]
+    if frame_idx is None:
+        return os.path.join(output_dir, stem + ".png")
+    return os.path.join(output_dir, stem, "{:06d}.png".format(frame_idx))
+
+def _checkOutputs(units, output_dir, root):
+    """
+    Raise ValueError if two inputs would be written to the same output,
+    such as x.jpg and x.png (both x.png) or x.avi and x.mp4 (both x/).
+    """
+
+    outputs = {}
+    for (_, kind, path, _, _) in units:
+        out_path = _outputPath(output_dir, root, path,
+            None if kind == "image" else 0)
+        if kind == "video":
+            out_path = os.path.dirname(out_path)
+        previous = outputs.setdefault(out_path, path)
+        if previous != path:
+            raise ValueError("{} and {} would both be written to {}".format(
+                previous, path, out_path))
+
+def _writeOutput(out_path, mask):
+    directory = os.path.dirname(out_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    cv2.imwrite(out_path, mask)
+
+def processUnit(unit):
+    """
+    Process one work unit in a worker process. Returns (key, rows,
+    pixels, error), where rows is a list of (path, frame_idx, timestamp,
+    pixels, counts) tuples, one per image or frame.
+    """
+
+    (key, kind, path, start, end) = unit
+    rows = []
+    total_pixels = 0
+    try:
+        if kind == "image":
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+            if img is None:
+                return key, rows, 0, "Error reading image"
+            mask, counts = _classify(img)
+            if _worker["output_dir"] is not None:
+                _writeOutput(_outputPath(_worker["output_dir"],
+                    _worker["root"], path), mask)
+            rows.append((path, None, None, mask.size, list(counts)))
+            total_pixels += mask.size
+        else:
+            cap = FrameSource(path, step=_worker["step"], start_frame=start,
+                end_frame=end)
+            if not cap.isOpened():
+                return key, rows, 0, "Error opening video"
+            frame = None
+            while True:
+                (grabbed, frame) = cap.read(frame)
+                if not grabbed:
+                    break
+                mask, counts = _classify(frame)
+                if _worker["output_dir"] is not None:
+                    _writeOutput(_outputPath(_worker["output_dir"],
+                        _worker["root"], path, cap.frame_idx), mask)
+                rows.append((path, cap.frame_idx, cap.timestamp, mask.size,
+                    list(counts)))
+                total_pixels += mask.size
+            cap.release()
+    except Exception as e:
+        return key, rows, total_pixels, "{}: {}".format(type(e).__name__, e)
+    return key, rows, total_pixels, None
+
+def batchThreshold(inputs, presets, output_dir=None, stats_path=None,
+        progress_path=None, workers=None, step=1, segment_frames=1000,
+        bits=8, report_interval=5.0):
+    """
+    Threshold every image and video in inputs with the given presets
+    (an OrderedDict as returned by loadPresets()) in a pool of worker
+    processes.
+
+    With a single preset, the output for each image or frame is a binary
+    mask; with several, it is a label image (label i is the i-th preset,
+    0 is none) computed with a ColorClassifier compiled once up front.
+
+    output_dir: if given, masks or label images are written as PNG files
+        mirroring the input tree below the deepest directory containing
+        all the inputs, with one directory per video holding an image per
+        frame. Anything under output_dir is not taken as input, and a
+        batch in which two inputs would be written to the same output
+        (e.g., x.jpg and x.png) raises ValueError before any is
+        processed.
+    stats_path: if given, a CSV row per image or frame is appended to
+        this file with the fraction of pixels in each class.
+    progress_path: file in which completed work units are recorded (by
+        default, stats_path + ".done" or output_dir/.done). Units listed
+        in it are skipped, so an interrupted run can be resumed by
+        running it again with the same arguments. A unit interrupted
+        partway through is redone in full. A unit's stats rows are
+        written only if it succeeds, and it is recorded as done (along
+        with the size of the stats file) only after its rows are
+        flushed, so on resume any rows after the last recorded size,
+        which belong to units not done, are truncated.
+
+    Returns a dict with the number of units, frames, and pixels
+    processed, the units that failed, and the elapsed time.
+    """
+
+    if progress_path is None:
+        if stats_path is not None:
+            progress_path = stats_path + ".done"
+        elif output_dir is not None:
+            progress_path = os.path.join(output_dir, ".done")
+
+    # Each line of the progress file is the key of a completed unit and
+    # the size of the stats file once the unit's rows were written; a
+    # line with an empty key records the size at the start of a run.
+    done = set()
+    stats_size = None
+    if progress_path is not None and os.path.isfile(progress_path):
+        with open(progress_path) as f:
+            for line in f:
+                (key, _, size) = line.rstrip("\n").partition("\t")
+                if key:
+                    done.add(key)
+                if size:
+                    stats_size = int(size)
+
+    names = ["none"] + list(presets)
+    compiled = None
+    if len(presets) > 1:
+        classifier = ColorClassifier(presets, bits)
+        compiled = (classifier.table, classifier.blocks,
+            classifier.block_index, bits)
+
+    root = os.path.commonpath([os.path.abspath(path) for path in inputs])
+    if not os.path.isdir(root):
+        root = os.path.dirname(root)
+    units = findInputs(inputs, segment_frames, step, exclude=output_dir)
+    if output_dir is not None:
+        _checkOutputs(units, output_dir, root)
+    units = [unit for unit in units if unit[0] not in done]
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    if progress_path is not None and os.path.dirname(progress_path):
+        os.makedirs(os.path.dirname(progress_path), exist_ok=True)
+
+    stats_file = writer = None
+    if stats_path is not None:
+        new_file = not os.path.isfile(stats_path)
+        if (not new_file and stats_size is not None
+                and os.path.getsize(stats_path) > stats_size):
+            os.truncate(stats_path, stats_size)
+        stats_file = open(stats_path, "a", newline="")
+        writer = csv.writer(stats_file)
+        if new_file:
+            writer.writerow(["path", "frame", "timestamp", "pixels"] + names)
+        stats_file.flush()
+    progress_file = (open(progress_path, "a")
+        if progress_path is not None else None)
+    if stats_file is not None and progress_file is not None:
+        progress_file.write("\t{}\n".format(stats_file.tell()))
+        progress_file.flush()
+
+    result = {"units": 0, "frames": 0, "pixels": 0, "failed": [],
+        "skipped": len(done)}
+    rate = RateMeter()
+    start_time = time.perf_counter()
+    next_report = start_time + report_interval
+
+    pool = Pool(workers, initializer=_initWorker,
+        initargs=(presets, compiled, output_dir, root, step))
+    try:
+        for key, rows, pixels, error in pool.imap_unordered(processUnit,
+                units, chunksize=1 if segment_frames else 8):
+            if writer is not None and error is None:
+                for (path, frame_idx, timestamp, num_pixels, counts) in rows:
+                    writer.writerow([path,
+                        "" if frame_idx is None else frame_idx,
+                        "" if timestamp is None else "{:.3f}".format(
+                            timestamp), num_pixels]
+                        + ["{:.6f}".format(count / num_pixels)
+                            for count in counts])
+                stats_file.flush()
+
+            result["units"] += 1
+            result["frames"] += len(rows)
+            result["pixels"] += pixels
+            rate.increment(len(rows))
+            if error is not None:
+                result["failed"].append((key, error))
+                print("{}: {}".format(key, error), file=sys.stderr)
+            elif progress_file is not None:
+                if stats_file is not None:
+                    key = "{}\t{}".format(key, stats_file.tell())
+                progress_file.write(key + "\n")
+                progress_file.flush()
+
+            now = time.perf_counter()
+            if now >= next_report:
+                next_report = now + report_interval
+                elapsed = now - start_time
+                print("{}/{} units, {} frames, {:.1f} frames/sec"
+                    " ({:.1f} overall), {:.1f} MP/sec".format(
+                        result["units"], len(units), result["frames"],
+                        rate.rate(), result["frames"] / elapsed,
+                        result["pixels"] / elapsed / 1e6))
+    finally:
+        pool.terminate()
+        pool.join()
+        if stats_file is not None:
+            stats_file.close()
+        if progress_file is not None:
+            progress_file.close()
+
+    result["elapsed"] = time.perf_counter() - start_time
+    return result
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("presets",
+        help="JSON presets file saved with colorthresh.py")
+    ap.add_argument("inputs", nargs="+",
+        help="Image files, video files, and/or directories to process")
+    ap.add_argument("--output-dir", "-o", default=None,
+        help="Directory to which masks (or label images, for several"
+            + " presets) are written as PNG files")
+    ap.add_argument("--stats", "-s", default=None,
+        help="CSV file to which per-image/per-frame class coverage is"
+            + " appended")
+    ap.add_argument("--progress", default=None,
+        help="File recording completed work for resuming (default:"
+            + " STATS.done or OUTPUT_DIR/.done)")
+    ap.add_argument("--workers", "-w", type=int, default=None,
+        help="Number of worker processes (default: number of CPUs)")
+    ap.add_argument("--step", type=int, default=1,
+        help="Process every STEP-th video frame (default 1)")
+    ap.add_argument("--segment-frames", type=int, default=1000,
+        help="Split videos into work units of this many frames; 0 to"
+            + " process each video as one unit (default 1000)")
+    ap.add_argument("--bits", type=int, default=8,
+        help="Bits per channel of the lookup table used for several"
+            + " presets (default 8; see color_classifier.py)")
+    ap.add_argument("--report-interval", type=float, default=5.0,
+        help="Seconds between progress reports (default 5)")
+    args = vars(ap.parse_args())
+
+    if args["output_dir"] is None and args["stats"] is None:
+        ap.error("at least one of --output-dir and --stats is required")
+
+    result = batchThreshold(args["inputs"], loadPresets(args["presets"]),
+        args["output_dir"], args["stats"], args["progress"],
+        args["workers"], args["step"], args["segment_frames"],
+        args["bits"], args["report_interval"])
+
+    print("{} units ({} already done), {} frames, {} failed in {:.1f} s"
+        " ({:.1f} frames/sec, {:.1f} MP/sec)".format(result["units"],
+            result["skipped"], result["frames"], len(result["failed"]),
+            result["elapsed"],
+            result["frames"] / max(result["elapsed"], 1e-9),
+            result["pixels"] / max(result["elapsed"], 1e-9) / 1e6))
+
+if __name__ == "__main__":
+    main()
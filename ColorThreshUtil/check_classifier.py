@@ -0,0 +1,57 @@
+"""
+Check that ColorClassifier gives exactly the same label for every BGR
+color with each quantized table size (bits 1-7) as with the full table
+(bits 8). Exits with status 1 on any mismatch. For usage, type:
+    > python check_classifier.py -h
+"""
+
+import argparse
+from collections import OrderedDict
+import sys
+import numpy as np
+from color_classifier import ColorClassifier, colorCube
+from threshold_engine import loadPresets
+
+# Presets in three different color spaces, used if no file is given.
+DEFAULT_PRESETS = OrderedDict((
+    ("red", {"colorSpaceName": "HSV", "ch0Low": 0, "ch0High": 10,
+        "ch1Low": 100, "ch1High": 255, "ch2Low": 50, "ch2High": 255}),
+    ("green", {"colorSpaceName": "Lab", "ch0Low": 20, "ch0High": 230,
+        "ch1Low": 0, "ch1High": 110, "ch2Low": 130, "ch2High": 255}),
+    ("blue", {"colorSpaceName": "BGR", "ch0Low": 120, "ch0High": 255,
+        "ch1Low": 0, "ch1High": 90, "ch2Low": 0, "ch2High": 90}),
+    ))
+
+def checkClassifier(presets, bits=range(1, 8)):
+    """
+    Classify an image containing every BGR color once with each number
+    of bits and return a dict mapping bits to the number of colors whose
+    label differs from the full table's.
+    """
+
+    img = colorCube()
+    exact = ColorClassifier(presets, 8).classify(img).copy()
+    mismatches = OrderedDict()
+    for b in bits:
+        labels = ColorClassifier(presets, b).classify(img)
+        mismatches[b] = np.count_nonzero(labels != exact)
+    return mismatches
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("presets", nargs="?", default=None,
+        help="JSON presets file (default: built-in red, green, and blue"
+            + " presets in HSV, Lab, and BGR)")
+    args = vars(ap.parse_args())
+
+    presets = (DEFAULT_PRESETS if args["presets"] is None
+        else loadPresets(args["presets"]))
+    mismatches = checkClassifier(presets)
+    for bits, mismatched in mismatches.items():
+        print("bits={}: {} of {} colors differ from bits=8".format(
+            bits, mismatched, 1 << 24))
+    if any(mismatches.values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
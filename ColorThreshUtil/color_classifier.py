@@ -0,0 +1,206 @@
+from collections import OrderedDict
+import json
+import numpy as np
+import cv2
+from threshold_engine import ThresholdEngine
+
+class ColorClassifier:
+    """
+    Class that classifies every pixel of a BGR image into one of several
+    color classes with a single table lookup per pixel.
+
+    Each class is defined by a threshold preset in the format returned by
+    ColorThreshold.getValues(), in any of the color spaces supported by
+    ThresholdEngine. The presets are compiled once into a lookup table
+    mapping BGR colors directly to class labels, so classifying an image
+    involves no color conversion and costs the same for 1 class as for
+    254. Pixels are labeled 1..N in the order the presets are given, or
+    0 if they match none; where presets overlap, the first one wins.
+
+    bits is the number of bits per channel used to index the table:
+        8: a full 256^3 table (16 MB) giving the exact label of every
+            color in one lookup.
+        1-7: a table with 2^bits levels per channel (e.g., 32 KB for 5
+            bits) that stays in cache. Cells of the table whose colors
+            don't all share one label are marked AMBIGUOUS and given a
+            block holding the exact label of each color in the cell.
+            Pixels falling in ambiguous cells are refined with a second
+            lookup into their cell's block, so the result is still
+            exact. This uses much less memory than the full table when
+            the class boundaries cross few cells, but is slower when
+            many pixels lie near class boundaries.
+
+    presets is a dict mapping class names to presets, or a list of
+    presets, which are then named by their label. Compiling takes a
+    fraction of a second per preset; compiled tables can be passed in
+    as compiled (see save() and load()) to skip it.
+    """
+
+    AMBIGUOUS = 255
+    MAX_CLASSES = 254
+
+    def __init__(self, presets, bits=8, compiled=None):
+        if not isinstance(presets, dict):
+            presets = OrderedDict((str(i + 1), preset)
+                for i, preset in enumerate(presets))
+        if len(presets) > ColorClassifier.MAX_CLASSES:
+            raise ValueError("At most {} classes are supported".format(
+                ColorClassifier.MAX_CLASSES))
+        if not 1 <= bits <= 8:
+            raise ValueError("bits must be between 1 and 8")
+
+        self.names = ["none"] + list(presets)
+        self.presets = list(presets.values())
+        self.bits = bits
+        self.table, self.blocks, self.block_index = (
+            self._compile() if compiled is None else compiled)
+
+        # Per-channel tables used to compute quantized table indices.
+        # Indices need 3 * bits bits, so they only fit in 16 bits (which
+        # makes cv2.transform() faster) for up to 5 bits per channel.
+        levels = np.arange(256) >> (8 - bits)
+        index_dtype = np.uint16 if 3 * bits <= 16 else np.int32
+        self._index_lut = np.empty((1, 256, 3), dtype=index_dtype)
+        for ch in range(3):
+            self._index_lut[0, :, ch] = levels << (bits * ch)
+
+        self._packed = None
+        self._index = None
+        self.labels = None
+        self.pixels_refined = 0
+
+    def _compile(self):
+        """
+        Build the lookup table by thresholding an image containing every
+        BGR color once with each preset's engine, so the table agrees
+        exactly with ThresholdEngine. Colors are laid out so that color
+        (b, g, r) is at flat index b + 256 * g + 65536 * r.
+        """
+
+        colors = colorCube()
+        table = np.zeros(1 << 24, dtype=np.uint8)
+        for label in range(len(self.presets), 0, -1):
+            mask = ThresholdEngine.fromValues(
+                self.presets[label - 1]).apply(colors)
+            table[mask.ravel() > 0] = label
+
+        if self.bits == 8:
+            return table, None, None
+
+        # A cell of the quantized table gets a label only if every color
+        # in the cell has that label.
+        levels = 1 << self.bits
+        step = 1 << (8 - self.bits)
+        cells = table.reshape(levels, step, levels, step, levels, step)
+        low = cells.min(axis=(1, 3, 5))
+        high = cells.max(axis=(1, 3, 5))
+        quantized = np.where(low == high, low, ColorClassifier.AMBIGUOUS)
+
+        # The cell axes are (r, g, b); flatten so that the index is
+        # b + levels * g + levels^2 * r.
+        quantized = np.ascontiguousarray(quantized, dtype=np.uint8).ravel()
+
+        # Gather the exact labels of the colors in each ambiguous cell
+        # into a block, indexed by the low bits of the color as
+        # b + step * g + step^2 * r.
+        ambiguous = np.flatnonzero(quantized == ColorClassifier.AMBIGUOUS)
+        block_index = np.full(quantized.size, -1, dtype=np.int32)
+        block_index[ambiguous] = np.arange(ambiguous.size)
+        blocks = cells.transpose(0, 2, 4, 1, 3, 5).reshape(
+            quantized.size, step ** 3)[ambiguous]
+        return quantized, blocks, block_index
+
+    def _tableIndex(self, img):
+        """Return the table index of every pixel of a BGR image."""
+
+        if self.bits == 8:
+            # Copy B, G, R into the low three bytes of zeroed 4-byte
+            # pixels and view them as little-endian 32-bit integers.
+            shape = img.shape[:2] + (4,)
+            if self._packed is None or self._packed.shape != shape:
+                self._packed = np.zeros(shape, dtype=np.uint8)
+            cv2.mixChannels([img], [self._packed], [0, 0, 1, 1, 2, 2])
+            return self._packed.view(np.uint32)[..., 0]
+
+        # Map each channel to its quantized level shifted into place,
+        # then add the channels.
+        shifted = cv2.LUT(img, self._index_lut)
+        self._index = cv2.transform(shifted, np.ones((1, 3)),
+            dst=self._index)
+        return self._index
+
+    def classify(self, img, out=None):
+        """
+        Return the label image of a BGR image, written into out if given
+        or into a buffer that is reused for every image of the same size.
+        """
+
+        index = self._tableIndex(img)
+        if out is None:
+            if self.labels is None or self.labels.shape != index.shape:
+                self.labels = np.empty(index.shape, dtype=np.uint8)
+            out = self.labels
+        np.take(self.table, index, out=out)
+
+        if self.bits < 8:
+            self._refine(img, index, out)
+        return out
+
+    def _refine(self, img, index, labels):
+        """Look up the exact label of pixels in ambiguous table cells."""
+
+        flat_labels = labels.reshape(-1)
+        ambiguous = np.flatnonzero(flat_labels == ColorClassifier.AMBIGUOUS)
+        if not ambiguous.size:
+            return
+        self.pixels_refined += ambiguous.size
+
+        low_bits = img.reshape(-1, 3)[ambiguous] & ((1 << (8 - self.bits)) - 1)
+        low_bits = low_bits.astype(np.int32)
+        offset = low_bits[:, 0] + ((low_bits[:, 1] + (low_bits[:, 2]
+            << (8 - self.bits))) << (8 - self.bits))
+        blocks = self.block_index[index.reshape(-1)[ambiguous]]
+        flat_labels[ambiguous] = self.blocks[blocks, offset]
+
+    def counts(self, labels):
+        """
+        Return the number of pixels of each label (index 0 is the number
+        of unclassified pixels) as an array of len(names) integers.
+        """
+
+        hist = cv2.calcHist([labels], [0], None, [256], [0, 256])
+        return hist.ravel()[:len(self.names)].astype(np.int64)
+
+    def classifyWithCounts(self, img, out=None):
+        """Return the label image and per-class pixel counts."""
+
+        labels = self.classify(img, out)
+        return labels, self.counts(labels)
+
+    def save(self, path):
+        """Save the compiled table and presets to a .npz file."""
+
+        presets = OrderedDict(zip(self.names[1:], self.presets))
+        arrays = {"table": self.table}
+        if self.blocks is not None:
+            arrays.update(blocks=self.blocks, block_index=self.block_index)
+        np.savez_compressed(path, bits=self.bits,
+            presets=json.dumps(presets), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Load a classifier saved with save() without recompiling it."""
+
+        data = np.load(path)
+        presets = json.loads(str(data["presets"]),
+            object_pairs_hook=OrderedDict)
+        compiled = (data["table"],
+            data["blocks"] if "blocks" in data else None,
+            data["block_index"] if "block_index" in data else None)
+        return cls(presets, int(data["bits"]), compiled)
+
+def colorCube():
+    """Return a 4096x4096 BGR image containing every color once."""
+
+    colors = np.arange(1 << 24, dtype=np.uint32).view(np.uint8)
+    return np.ascontiguousarray(colors.reshape(4096, 4096, 4)[..., :3])
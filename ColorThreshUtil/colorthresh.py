@@ -1,20 +1,29 @@
 import argparse
 from collections import OrderedDict
+import os
+import sys
+import time
 import numpy as np
 import cv2
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "multithread"))
+from FrameSource import FrameSource
+from threshold_engine import CV_COLOR_CODES, ThresholdEngine, savePreset
+
 class ColorThreshold:
-    CV_COLOR_CODES = OrderedDict((
-        ("BGR", None),
-        ("GRAY", cv2.COLOR_BGR2GRAY),
-        ("HSV", cv2.COLOR_BGR2HSV),
-        ("Lab", cv2.COLOR_BGR2Lab),
-        ("Luv", cv2.COLOR_BGR2Luv),
-        ("YCrCb", cv2.COLOR_BGR2YCrCb),
-        ("YUV", cv2.COLOR_BGR2YUV)
-        ))
-
-    def __init__(self, mode="cam", source=0):
+    CV_COLOR_CODES = CV_COLOR_CODES
+
+    # In image mode, trackbar and mouse events only mark the thresholds
+    # as changed. The image is rethresholded (once, with the latest
+    # values) when the event loop, which runs every POLL_INTERVAL_MS
+    # milliseconds, sees the change. Converted images are cached for
+    # the CACHE_SIZE most recently used color spaces.
+    POLL_INTERVAL_MS = 15
+    CACHE_SIZE = 4
+
+    def __init__(self, mode="cam", source=0, step=1, presets_path=None,
+            preset_name="preset", preview_width=1280, settle_time=0.25):
         self.PIXEL_MIN = 0
         self.PIXEL_MAX = 255
         self.BTN_HUE = 127
@@ -41,6 +50,24 @@ class ColorThreshold:
         self.btn = self.BTN_HUE * np.ones((50, 400, 3), dtype=np.uint8)
         self.mode = mode
         self.source = source
+        self.step = step
+        self.presetsPath = presets_path
+        self.presetName = preset_name
+        self.engine = ThresholdEngine()
+
+        # Progressive mode (image mode only): while the controls are
+        # being changed, a preview downscaled to preview_width is
+        # thresholded; the full image is thresholded once there have
+        # been no changes for settle_time seconds.
+        self.previewWidth = preview_width
+        self.settleTime = settle_time
+        self.preview = None
+        self.fullPending = False
+        self.changed = False
+        self.lastInputTime = 0.0
+        self.cache = OrderedDict()
+        self.threshBuffers = {}
+        self.shownImage = None
 
         # Create trackbars.
         cv2.createTrackbar("Ch0 Low", self.CTRL_WIN, self.ch0LowVal,
@@ -74,6 +101,10 @@ class ColorThreshold:
         cv2.imshow(self.CTRL_WIN, btnWithText)
 
     def onTrackbar(self, val):
+        self.changed = True
+        self.lastInputTime = time.perf_counter()
+
+    def readTrackbars(self):
         # OpenCV-Python seems to have issues with trackbars. Each trackbar's
         # linked variable is not updated when the trackbar position changes.
         # Creating a separate callback function for each trackbar (since a
@@ -84,7 +115,8 @@ class ColorThreshold:
         # ch2HighVal), regardless of which callback function was passed to them.
         #
         # Hence, I've opted to explicitly query each trackbar by name on any
-        # trackbar change, regardless of which one was changed.
+        # trackbar change, regardless of which one was changed. This is done
+        # once per pass of the event loop rather than once per event.
 
         self.ch0LowVal = cv2.getTrackbarPos("Ch0 Low", self.CTRL_WIN)
         self.ch0HighVal = cv2.getTrackbarPos("Ch0 High", self.CTRL_WIN)
@@ -92,9 +124,7 @@ class ColorThreshold:
         self.ch1HighVal = cv2.getTrackbarPos("Ch1 High", self.CTRL_WIN)
         self.ch2LowVal = cv2.getTrackbarPos("Ch2 Low", self.CTRL_WIN)
         self.ch2HighVal = cv2.getTrackbarPos("Ch2 High", self.CTRL_WIN)
-
-        if self.mode == "image":
-            self.thresholdImage()
+        self.changed = False
 
     def onMouse(self, event, x, y, flags, data):
         if event == cv2.EVENT_LBUTTONDOWN or event == cv2.EVENT_RBUTTONDOWN:
@@ -106,68 +136,143 @@ class ColorThreshold:
             self.colorSpaceIdx = (
                 (self.colorSpaceIdx + increment) % len(self.COLOR_SPACES))
             self.updateButton()
-            
-            # Threshold image on color space change only in image
-            # mode. If video or cam mode, the while loop in start()
-            # handles this.
-            if self.mode == "image":
-                self.thresholdImage()
+            self.changed = True
+            self.lastInputTime = time.perf_counter()
 
-    def thresholdImage(self):
-        """Threshold the current image and store in self.thresh."""
+    def convertCached(self, img, preview):
+        """
+        Return img converted to the current color space, reusing the
+        converted image from an earlier call if there is one. Only used
+        in image mode, where the image doesn't change.
+        """
 
-        # Convert color space from BGR if necessary.
-        colorSpaceName = self.COLOR_SPACES[self.colorSpaceIdx]
-        if colorSpaceName != "BGR":
-            cvColorCode = self.CV_COLOR_CODES[colorSpaceName]
-            thresh = cv2.cvtColor(self.img, cvColorCode)
-        else:
-            thresh = self.img.copy()
+        key = (self.engine.color_space, preview)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        converted = self.engine.convert(img)
+        if converted is not img:
+            converted = converted.copy()
+        self.cache[key] = converted
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return converted
+
+    def thresholdImage(self, preview=False):
+        """
+        Threshold the current image (or, if preview is True, its
+        downscaled preview) and store in self.thresh.
+        """
 
-        # Display original image after converting color space but
-        # before thresholding color channel(s).
-        cv2.imshow(self.IM_WIN, thresh)
+        # Convert color space from BGR if necessary and threshold all
+        # channels at once (see threshold_engine.py).
+        self.engine.setColorSpace(self.COLOR_SPACES[self.colorSpaceIdx])
+        self.engine.setRange(
+            (self.ch0LowVal, self.ch1LowVal, self.ch2LowVal),
+            (self.ch0HighVal, self.ch1HighVal, self.ch2HighVal))
 
-        # Split channels (if not grayscale). Perform inRange
-        # operations to produce thresholded image.
-        if colorSpaceName == "GRAY":
-            thresh = cv2.inRange(thresh, self.ch0LowVal,
-                self.ch0HighVal)
+        if self.mode == "image":
+            img = self.preview if preview else self.img
+            converted = self.convertCached(img, preview)
+            self.thresh = thresh = self.engine.threshold(converted,
+                self.threshBuffers.get(preview))
+            self.threshBuffers[preview] = thresh
+
+            # The converted image only changes with the color space (or
+            # when switching between preview and full resolution).
+            if self.shownImage is not converted:
+                cv2.imshow(self.IM_WIN, converted)
+                self.shownImage = converted
         else:
-            channels = cv2.split(thresh)
-            channels[0] = cv2.inRange(channels[0], self.ch0LowVal,
-                self.ch0HighVal)
-            channels[1] = cv2.inRange(channels[1], self.ch1LowVal,
-                self.ch1HighVal)
-            channels[2] = cv2.inRange(channels[2], self.ch2LowVal,
-                self.ch2HighVal)
-            thresh = cv2.bitwise_and(channels[0], channels[1])
-            thresh = cv2.bitwise_and(thresh, channels[2])
+            self.thresh = thresh = self.engine.apply(self.img)
+
+            # Display original image after converting color space but
+            # before thresholding color channel(s).
+            if self.engine.code is None:
+                cv2.imshow(self.IM_WIN, self.img)
+            else:
+                cv2.imshow(self.IM_WIN, self.engine.converted)
 
         cv2.imshow(self.THRESH_WIN, thresh)
 
+    def runImage(self):
+        """Event loop for image mode."""
+
+        self.img = cv2.imread(self.source)
+        if self.img is None:
+            raise RuntimeError("Error reading image {}".format(self.source))
+
+        (height, width) = self.img.shape[:2]
+        if self.previewWidth and width > self.previewWidth:
+            previewHeight = int(float(self.previewWidth / width) * height)
+            self.preview = cv2.resize(self.img,
+                (self.previewWidth, previewHeight),
+                interpolation=cv2.INTER_AREA)
+
+            # Show the preview and full image at the same window size.
+            cv2.destroyWindow(self.THRESH_WIN)
+            for window in (self.IM_WIN, self.THRESH_WIN):
+                cv2.namedWindow(window, cv2.WINDOW_NORMAL)
+                cv2.resizeWindow(window, self.previewWidth, previewHeight)
+
+        self.thresholdImage()
+        while True:
+            key = cv2.waitKey(self.POLL_INTERVAL_MS)
+            if key != -1 and not self.onKey(key):
+                break
+            if cv2.getWindowProperty(self.CTRL_WIN,
+                    cv2.WND_PROP_VISIBLE) < 1:
+                break
+
+            if self.changed:
+                self.readTrackbars()
+                if self.preview is not None:
+                    self.thresholdImage(preview=True)
+                    self.fullPending = True
+                else:
+                    self.thresholdImage()
+            elif self.fullPending and (time.perf_counter()
+                    - self.lastInputTime >= self.settleTime):
+                self.thresholdImage()
+                self.fullPending = False
+
     def start(self):
         if self.mode == "image":
-            self.img = cv2.imread(self.source)
-            cv2.imshow(self.IM_WIN, self.img)
-            self.thresholdImage()
-            cv2.waitKey(0)
+            self.runImage()
         else:
-            cap = cv2.VideoCapture(self.source)
+            cap = FrameSource(self.source, step=self.step)
 
             if not cap.isOpened():
                 raise RuntimeError("Error opening VideoCapture")
 
-            # Threshold each frame of video in while loop.
+            # Threshold each step-th frame of video in while loop. Each
+            # frame is decoded into the previous frame's array.
+            self.img = None
             while True:
-                grabbed, self.img = cap.read()
-                if not grabbed or cv2.waitKey(1) == ord("q"):
+                grabbed, self.img = cap.read(self.img)
+                if not grabbed or not self.onKey(cv2.waitKey(1)):
                     break
                 
-                cv2.imshow(self.IM_WIN, self.img)
+                if self.changed:
+                    self.readTrackbars()
                 self.thresholdImage()
+            cap.release()
         cv2.destroyAllWindows()
 
+    def onKey(self, key):
+        """
+        Handle a key press. "s" saves the current values as a preset (if
+        a presets file was given). Returns False if the key was "q".
+        """
+
+        key &= 0xFF
+        if key == ord("s") and self.presetsPath is not None:
+            savePreset(self.presetsPath, self.presetName, self.getValues())
+            print("Saved preset {!r} to {}".format(self.presetName,
+                self.presetsPath))
+        return key != ord("q")
+
     def getValues(self):
         colorSpaceName = self.COLOR_SPACES[self.colorSpaceIdx]
         channelValues = {
@@ -189,6 +294,20 @@ if __name__ == "__main__":
         help="Path to video file (if source is a video)")
     ap.add_argument("--cam", "-c", type=int, default=0,
         help="Camera index (if source is camera); default 0")
+    ap.add_argument("--step", "-s", type=int, default=1,
+        help="Threshold every STEP-th video frame; default 1")
+    ap.add_argument("--presets", "-p", type=str, default=None,
+        help="JSON presets file to which the current values are saved"
+            + " when the \"s\" key is pressed")
+    ap.add_argument("--name", "-n", type=str, default="preset",
+        help="Name under which to save the preset; default \"preset\"")
+    ap.add_argument("--preview-width", type=int, default=1280,
+        help="In image mode, threshold a preview downscaled to this width"
+            + " while the controls are changing if the image is wider;"
+            + " 0 to disable; default 1280")
+    ap.add_argument("--settle", type=float, default=0.25,
+        help="Seconds without changes after which the full image is"
+            + " thresholded in preview mode; default 0.25")
     args = vars(ap.parse_args())
 
     if args["image"] is not None:
@@ -201,5 +320,7 @@ if __name__ == "__main__":
         mode = "cam"
         source = args["cam"]
 
-    c = ColorThreshold(mode=mode, source=source)
+    c = ColorThreshold(mode=mode, source=source, step=args["step"],
+        presets_path=args["presets"], preset_name=args["name"],
+        preview_width=args["preview_width"], settle_time=args["settle"])
     c.start()
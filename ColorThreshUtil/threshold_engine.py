@@ -0,0 +1,132 @@
+from collections import OrderedDict
+import json
+import os
+import numpy as np
+import cv2
+
+# OpenCV color conversion codes from BGR, keyed by color space name. BGR
+# needs no conversion.
+CV_COLOR_CODES = OrderedDict((
+    ("BGR", None),
+    ("GRAY", cv2.COLOR_BGR2GRAY),
+    ("HSV", cv2.COLOR_BGR2HSV),
+    ("Lab", cv2.COLOR_BGR2Lab),
+    ("Luv", cv2.COLOR_BGR2Luv),
+    ("YCrCb", cv2.COLOR_BGR2YCrCb),
+    ("YUV", cv2.COLOR_BGR2YUV)
+    ))
+
+def loadPresets(path):
+    """
+    Load threshold presets from a JSON file as an OrderedDict mapping
+    preset names to dicts in the format returned by
+    ColorThreshold.getValues(). A file holding a single preset (not
+    keyed by name) gives one preset named after the file.
+    """
+
+    with open(path) as f:
+        presets = json.load(f, object_pairs_hook=OrderedDict)
+    if "colorSpaceName" in presets:
+        name = os.path.splitext(os.path.basename(path))[0]
+        presets = OrderedDict(((name, presets),))
+    return presets
+
+def savePreset(path, name, values):
+    """
+    Add a preset (or replace the preset of the same name) in a JSON
+    presets file, creating the file if it doesn't exist.
+    """
+
+    presets = loadPresets(path) if os.path.isfile(path) else OrderedDict()
+    presets[name] = values
+    with open(path, "w") as f:
+        json.dump(presets, f, indent=2)
+
+class ThresholdEngine:
+    """
+    Class that thresholds BGR images on a range of values in each channel
+    of a given color space, without any GUI.
+
+    A pixel is in the mask (255) if every channel of the pixel, after
+    conversion to the color space, lies within [lower, upper] (inclusive)
+    for that channel. All channels are tested in a single cv2.inRange()
+    call, which also combines them, rather than splitting the channels
+    and combining per-channel masks. BGR images are thresholded directly
+    without converting or copying them.
+
+    The converted image and mask are written into buffers that are
+    allocated on the first call and reused for every image of the same
+    size, so apply() returns the same mask array each time (unless an
+    output array is passed in). Copy the mask to keep it across calls.
+    """
+
+    def __init__(self, color_space="BGR", lower=(0, 0, 0),
+            upper=(255, 255, 255)):
+        self.color_space = None
+        self.converted = None
+        self.mask = None
+        self.setColorSpace(color_space)
+        self.setRange(lower, upper)
+
+    @classmethod
+    def fromValues(cls, values):
+        """
+        Create an engine from a dict of threshold values in the format
+        returned by ColorThreshold.getValues().
+        """
+
+        return cls(values["colorSpaceName"],
+            (values["ch0Low"], values["ch1Low"], values["ch2Low"]),
+            (values["ch0High"], values["ch1High"], values["ch2High"]))
+
+    def setColorSpace(self, color_space):
+        if color_space not in CV_COLOR_CODES:
+            raise ValueError("Invalid color space {!r}; expected one of {}"
+                .format(color_space, ", ".join(CV_COLOR_CODES)))
+        if color_space != self.color_space:
+            self.color_space = color_space
+            self.code = CV_COLOR_CODES[color_space]
+            self.converted = None
+
+    def setRange(self, lower, upper):
+        """
+        Set the lower and upper bounds of each channel. Only the first
+        bound of each is used for GRAY.
+        """
+
+        num_channels = 1 if self.color_space == "GRAY" else 3
+        self.lower = np.array(lower[:num_channels], dtype=np.float64)
+        self.upper = np.array(upper[:num_channels], dtype=np.float64)
+
+    def convert(self, img):
+        """
+        Return img converted to the engine's color space (img itself for
+        BGR).
+        """
+
+        if self.code is None:
+            return img
+        self.converted = cv2.cvtColor(img, self.code, dst=self.converted)
+        return self.converted
+
+    def threshold(self, converted, out=None):
+        """
+        Threshold an image that has already been converted to the
+        engine's color space (e.g., one cached by the caller) and return
+        the mask, written into out if given or into the engine's reused
+        mask buffer otherwise.
+        """
+
+        if out is not None:
+            return cv2.inRange(converted, self.lower, self.upper, dst=out)
+        self.mask = cv2.inRange(converted, self.lower, self.upper,
+            dst=self.mask)
+        return self.mask
+
+    def apply(self, img, out=None):
+        """
+        Threshold a BGR image and return the mask, written into out if
+        given or into the engine's reused mask buffer otherwise.
+        """
+
+        return self.threshold(self.convert(img), out)
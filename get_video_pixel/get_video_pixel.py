@@ -1,18 +1,54 @@
 '''
 Name: get_video_pixel.py
 Description: Take a snapshot of a video and get the RGB value
-    of any pixel in the snapshot.
+    of any pixel in the snapshot. With --points, instead read the values
+    of a list of pixels and regions from every frame of a video file
+    without any GUI (see pixel_series.py).
 Author: Najam Syed (github.com/nrsyed)
 Created: 2018-Feb-12
 '''
 
+import argparse
+import os
+import sys
 import numpy as np
 import cv2
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'multithread'))
+from FrameSource import FrameSource
+
 COLOR_ROWS = 80
 COLOR_COLS = 250
 
-capture = cv2.VideoCapture(0)
+ap = argparse.ArgumentParser()
+ap.add_argument('-s', '--source', default=0,
+    help='Path to video file or integer representing webcam index'
+        + ' (default 0)')
+ap.add_argument('-p', '--points',
+    help='Headless mode: text file of points, one per line ("x y",'
+        + ' "x y radius", or "x y width height"), whose BGR values are read'
+        + ' from every frame of the source into OUTPUT')
+ap.add_argument('-o', '--output', default='pixels.npy',
+    help='Output .npy file of per-frame values in headless mode'
+        + ' (default pixels.npy)')
+ap.add_argument('--step', type=int, default=1,
+    help='In headless mode, process every STEP-th frame (default 1)')
+args = vars(ap.parse_args())
+# If source is a string consisting only of integers, check that it doesn't
+# refer to a file. If it doesn't, assume it's an integer camera ID.
+source = args['source']
+if (isinstance(source, str) and source.isdigit()
+        and not os.path.isfile(source)):
+    source = int(source)
+
+if args['points']:
+    from pixel_series import extractSeries, loadPoints, printResult
+    printResult(extractSeries(source, loadPoints(args['points']),
+        args['output'], args['step']))
+    sys.exit()
+
+capture = FrameSource(source)
 if not capture.isOpened():
     raise RuntimeError('Error opening VideoCapture.')
 
@@ -41,13 +77,14 @@ def on_mouse_click(event, x, y, flags, userParams):
 
 cv2.setMouseCallback('Snapshot', on_mouse_click)
 
+# Decode each frame into the same array rather than allocating a new one.
 while True:
-    (grabbed, frame) = capture.read()
-    cv2.imshow('Video', frame)
-
+    (grabbed, frame) = capture.read(frame)
     if not grabbed:
         break
 
+    cv2.imshow('Video', frame)
+
     keyVal = cv2.waitKey(1) & 0xFF
     if keyVal == ord('q'):
         break
@@ -0,0 +1,261 @@
+'''
+Name: pixel_series.py
+Description: Headless counterpart of get_video_pixel.py. Reads the BGR
+    values of many fixed pixels, and the mean BGR values of many fixed
+    rectangular regions, from every frame (or every STEP-th frame) of a
+    video without any GUI, and writes them to a memory-mapped .npy array of
+    shape (frames, points, 3), with the timestamp of each frame in a second
+    .npy array. For usage, type:
+    > python pixel_series.py -h
+
+    Points are read from a text file with one point per line, as "x y" for
+    a single pixel, "x y radius" for the mean of the (2 radius + 1)-pixel
+    square centered on (x, y), or "x y width height" for the mean of a
+    rectangle with top left corner (x, y). Values may be separated by
+    spaces or commas; blank lines and lines starting with # are ignored.
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'multithread'))
+from FrameSource import FrameSource
+from Metrics import RateMeter
+
+def loadPoints(path):
+    '''
+    Read a points file (see above) and return an Nx4 int64 array of
+    rectangles (x, y, width, height), one per point in file order; single
+    pixels are 1x1 rectangles.
+    '''
+    rects = []
+    with open(path) as f:
+        for lineNum, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].replace(',', ' ').split()
+            if not line:
+                continue
+            try:
+                values = [int(v) for v in line]
+            except ValueError:
+                values = []
+            if len(values) == 2:
+                rects.append((values[0], values[1], 1, 1))
+            elif len(values) == 3:
+                (x, y, radius) = values
+                rects.append((x - radius, y - radius, 2 * radius + 1,
+                    2 * radius + 1))
+            elif len(values) == 4:
+                rects.append(tuple(values))
+            else:
+                raise ValueError('{}:{}: expected "x y", "x y radius", or'
+                    ' "x y width height"'.format(path, lineNum))
+    if not rects:
+        raise ValueError('{} contains no points'.format(path))
+    return np.array(rects, dtype=np.int64)
+
+class PointSampler:
+    '''
+    Class that samples the values of fixed points of frames of a given
+    (height, width) into a preallocated (points x channels) float32 array.
+
+    All 1x1 points are gathered with a single fancy-indexing operation on
+    the flattened frame. The means of all larger rectangles are computed
+    from one integral image (cv2.integral()) of the bounding box of the
+    rectangles, taking four lookups per rectangle regardless of its size;
+    the integral image is built into a reused buffer.
+
+    Rectangles are clipped to the frame; a point that lies entirely outside
+    it raises ValueError.
+    '''
+    def __init__(self, rects, shape):
+        (height, width) = shape[:2]
+        rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+        x0 = np.clip(rects[:, 0], 0, width)
+        y0 = np.clip(rects[:, 1], 0, height)
+        x1 = np.clip(rects[:, 0] + rects[:, 2], 0, width)
+        y1 = np.clip(rects[:, 1] + rects[:, 3], 0, height)
+        empty = np.flatnonzero((x1 <= x0) | (y1 <= y0))
+        if empty.size:
+            raise ValueError('Point {} lies outside the {}x{} frame'.format(
+                tuple(rects[empty[0]].tolist()), width, height))
+
+        self.shape = (height, width)
+        self.numPoints = len(rects)
+        self.values = np.zeros((self.numPoints, 3), dtype=np.float32)
+
+        single = (x1 - x0 == 1) & (y1 - y0 == 1)
+        self.pixelRows = np.flatnonzero(single)
+        self.pixelIndices = y0[single] * width + x0[single]
+        self._pixels = np.empty((self.pixelRows.size, 3), dtype=np.uint8)
+
+        # Build the integral image only over the bounding box of the
+        # regions, and index its flattened corners relative to the box.
+        self.regionRows = np.flatnonzero(~single)
+        self.box = None
+        if self.regionRows.size:
+            (x0, y0, x1, y1) = (a[~single] for a in (x0, y0, x1, y1))
+            self.box = (y0.min(), y1.max(), x0.min(), x1.max())
+            (x0, x1) = (x0 - self.box[2], x1 - self.box[2])
+            (y0, y1) = (y0 - self.box[0], y1 - self.box[0])
+            stride = self.box[3] - self.box[2] + 1
+            self.corners = np.stack([y1 * stride + x1, y0 * stride + x0,
+                y0 * stride + x1, y1 * stride + x0])
+            self.inverseAreas = (1.0 / ((x1 - x0) * (y1 - y0)))[:, None]
+
+            # 32-bit sums are exact as long as the whole box can't overflow.
+            boxPixels = ((self.box[1] - self.box[0])
+                * (self.box[3] - self.box[2]))
+            self._depth = (cv2.CV_32S if boxPixels * 255 < (1 << 31)
+                else cv2.CV_64F)
+            self._integral = None
+
+    def sample(self, frame):
+        '''
+        Sample the points of a BGR frame and return values, a (points x 3)
+        float32 array overwritten by each call.
+        '''
+        if frame.shape[:2] != self.shape:
+            raise ValueError('Frame size {}x{} does not match {}x{}'.format(
+                frame.shape[1], frame.shape[0], self.shape[1], self.shape[0]))
+
+        if self.pixelRows.size:
+            np.take(frame.reshape(-1, 3), self.pixelIndices, axis=0,
+                out=self._pixels)
+            self.values[self.pixelRows] = self._pixels
+
+        if self.box is not None:
+            (top, bottom, left, right) = self.box
+            self._integral = cv2.integral(frame[top:bottom, left:right],
+                sum=self._integral, sdepth=self._depth)
+            integral = self._integral.reshape(-1, 3)
+            sums = ((integral[self.corners[0]] + integral[self.corners[1]])
+                - (integral[self.corners[2]] + integral[self.corners[3]]))
+            self.values[self.regionRows] = sums * self.inverseAreas
+        return self.values
+
+def outputPaths(output):
+    '''
+    Return the paths of the files making up an extraction to output (a .npy
+    path): values, timestamps, and metadata.
+    '''
+    stem = output[:-4] if output.endswith('.npy') else output
+    return {
+        'values': stem + '.npy',
+        'timestamps': stem + '_timestamps.npy',
+        'metadata': stem + '.json',
+        }
+
+def extractSeries(video, rects, output, step=1, start_frame=None,
+        end_frame=None, report_interval=5.0):
+    '''
+    Sample the given points (an Nx4 array of rectangles, see loadPoints())
+    from every step-th frame of a video file into memory-mapped .npy files
+    (see outputPaths()): a (rows, points, 3) float32 array of BGR values,
+    where row i is frame start_frame + i * step, and a (rows,) float64 array
+    of frame timestamps in seconds. Rows are written as frames are decoded,
+    so the arrays can be read while extraction is still running; rows of
+    frames that couldn't be read stay NaN.
+
+    Returns a dict with the number of frames processed, rows missing, and
+    the elapsed time.
+    '''
+    capture = FrameSource(video, step=step, start_frame=start_frame,
+        end_frame=end_frame)
+    if not capture.isOpened():
+        raise RuntimeError('Error opening video {}'.format(video))
+    rows = capture.frameCount()
+    if rows is None:
+        capture.release()
+        raise RuntimeError('Frame count of {} is unknown; the output can\'t'
+            ' be preallocated'.format(video))
+
+    first = capture.pos
+    rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+    paths = outputPaths(output)
+    directory = os.path.dirname(paths['values'])
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    values = np.lib.format.open_memmap(paths['values'], mode='w+',
+        dtype=np.float32, shape=(rows, len(rects), 3))
+    values[:] = np.nan
+    timestamps = np.lib.format.open_memmap(paths['timestamps'], mode='w+',
+        dtype=np.float64, shape=(rows,))
+    timestamps[:] = np.nan
+    with open(paths['metadata'], 'w') as f:
+        json.dump({'video': os.path.abspath(video), 'step': capture.step,
+            'first_frame': first, 'shape': values.shape,
+            'fps': capture.get(cv2.CAP_PROP_FPS), 'channels': 'bgr',
+            'points': rects.tolist()}, f, indent=2)
+
+    result = {'frames': 0}
+    rate = RateMeter()
+    startTime = time.perf_counter()
+    nextReport = startTime + report_interval
+    sampler = None
+    frame = None
+    try:
+        while True:
+            (grabbed, frame) = capture.read(frame)
+            if not grabbed:
+                break
+            if sampler is None:
+                sampler = PointSampler(rects, frame.shape)
+            row = (capture.frame_idx - first) // capture.step
+            if row >= rows:
+                break
+            values[row] = sampler.sample(frame)
+            if capture.timestamp is not None:
+                timestamps[row] = capture.timestamp
+            result['frames'] += 1
+            rate.increment()
+
+            now = time.perf_counter()
+            if now >= nextReport:
+                nextReport = now + report_interval
+                print('{}/{} frames, {:.1f} frames/sec'.format(
+                    result['frames'], rows, rate.rate()))
+    finally:
+        capture.release()
+        values.flush()
+        timestamps.flush()
+
+    result['missing'] = int(np.isnan(values[:, 0, 0]).sum()) if rows else 0
+    result['elapsed'] = time.perf_counter() - startTime
+    return result
+
+def printResult(result):
+    print('{} frames, {} rows missing in {:.1f} s ({:.1f} frames/sec)'.format(
+        result['frames'], result['missing'], result['elapsed'],
+        result['frames'] / max(result['elapsed'], 1e-9)))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('video', help='Path to video file')
+    ap.add_argument('-p', '--points', required=True,
+        help='Text file of points, one per line: "x y", "x y radius", or'
+            + ' "x y width height"')
+    ap.add_argument('-o', '--output', required=True,
+        help='Output .npy file of per-frame BGR values; timestamps are'
+            + ' written to OUTPUT_timestamps.npy and parameters to'
+            + ' OUTPUT.json')
+    ap.add_argument('-s', '--step', type=int, default=1,
+        help='Process every STEP-th frame; others are skipped without decoding')
+    ap.add_argument('--start-frame', type=int, default=None,
+        help='Index of the first frame to process')
+    ap.add_argument('--end-frame', type=int, default=None,
+        help='Index of the frame at which to stop (exclusive)')
+    args = vars(ap.parse_args())
+
+    result = extractSeries(args['video'], loadPoints(args['points']),
+        args['output'], args['step'], args['start_frame'], args['end_frame'])
+    printResult(result)
+
+if __name__ == '__main__':
+    main()
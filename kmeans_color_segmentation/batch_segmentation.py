@@ -0,0 +1,227 @@
+'''
+Name: batch_segmentation.py
+Description: Segments every image in one or more directories (or a list of
+    image files) with segment() from segmentation.py, using a pool of worker
+    processes. Results are cached by image content and parameters, so
+    running the same batch again (or a batch containing images that have
+    already been segmented with the same parameters) skips finished work.
+    For usage, run this script with the --help [-h] flag:
+    > python batch_segmentation.py -h
+'''
+
+import argparse
+import hashlib
+import json
+from multiprocessing import Pool
+import os
+import shutil
+import time
+import numpy as np
+import cv2
+from segmentation import segment
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+
+def findImages(paths, exclude=()):
+    '''
+    Expand a list of image files and directories (searched recursively) into
+    a sorted list of (path, relative path) pairs, where the relative path is
+    used to name the output file. Relative paths are taken from the deepest
+    directory containing all the inputs, so files of the same name from
+    different inputs get different relative paths. A file found more than
+    once is listed once. Directories in exclude (e.g., the output and cache
+    directories, if they are inside an input directory) are not searched.
+    '''
+    if not paths:
+        return []
+    top = os.path.commonpath([os.path.abspath(path) for path in paths])
+    if not os.path.isdir(top):
+        top = os.path.dirname(top)
+
+    exclude = {os.path.abspath(path) for path in exclude if path is not None}
+    images = []
+    seen = set()
+    def add(path):
+        fullPath = os.path.abspath(path)
+        if fullPath not in seen:
+            seen.add(fullPath)
+            images.append((path, os.path.relpath(fullPath, top)))
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs
+                    if os.path.abspath(os.path.join(root, d)) not in exclude)
+                for name in sorted(names):
+                    if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                        add(os.path.join(root, name))
+        else:
+            add(path)
+    return images
+
+def cacheKey(data, params):
+    '''
+    Return the cache key of an image: a hash of its file contents and the
+    segmentation parameters.
+    '''
+    digest = hashlib.sha256(data)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def _writeAtomic(path, data):
+    # Write to a temporary file and rename it, so an interrupted run never
+    # leaves a partial cache entry behind.
+    tmpPath = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmpPath, 'wb') as f:
+        f.write(data)
+    os.replace(tmpPath, path)
+
+def segmentFile(task):
+    '''
+    Segment one image file in a worker process, or reuse its cached result.
+    task is (path, outPath, cacheDir, params). Returns (path, status, info),
+    where status is 'cached', 'segmented', or 'failed', and info is the
+    result metadata (or an error message).
+    '''
+    (path, outPath, cacheDir, params) = task
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = cacheKey(data, params)
+        cachedImage = os.path.join(cacheDir, key + '.png')
+        cachedInfo = os.path.join(cacheDir, key + '.json')
+
+        status = 'cached'
+        if not (os.path.isfile(cachedImage) and os.path.isfile(cachedInfo)):
+            status = 'segmented'
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                cv2.IMREAD_COLOR)
+            if image is None:
+                return path, 'failed', 'Error decoding image'
+            if params['width'] > 0:
+                height = int((params['width'] / image.shape[1])
+                    * image.shape[0])
+                image = cv2.resize(image, (params['width'], height),
+                    interpolation=cv2.INTER_AREA)
+
+            startTime = time.perf_counter()
+            result = segment(image, params['color_space'],
+                params['channels'], params['k'], params['unique'],
+                params['bits'], params['n_init'], params['max_iter'],
+                params['seed'])
+            info = {
+                'path': path,
+                'shape': list(result.gray.shape),
+                'counts': result.counts.tolist(),
+                'centers': result.centers.tolist(),
+                'inertia': result.inertia,
+                'seconds': time.perf_counter() - startTime,
+                }
+            _writeAtomic(cachedImage, cv2.imencode('.png', result.gray)[1])
+            _writeAtomic(cachedInfo, json.dumps(info).encode())
+
+        with open(cachedInfo) as f:
+            info = json.load(f)
+        if outPath is not None:
+            os.makedirs(os.path.dirname(outPath) or '.', exist_ok=True)
+            shutil.copyfile(cachedImage, outPath)
+        return path, status, info
+    except Exception as e:
+        return path, 'failed', '{}: {}'.format(type(e).__name__, e)
+
+def segmentBatch(paths, outputDir=None, cacheDir=None, workers=None,
+        color_space='bgr', channels='all', k=3, unique=True, bits=8,
+        n_init=40, max_iter=500, seed=0, width=0):
+    '''
+    Segment every image in paths (image files and directories) across a
+    pool of worker processes. Segmented images are written as PNG files to
+    outputDir (if given), mirroring the input directories. Results are
+    cached in cacheDir (default outputDir/.cache) keyed by image contents
+    and parameters. seed defaults to a fixed value so that cached and
+    recomputed results agree. Raises ValueError, before segmenting anything,
+    if two images would be written to the same output or an output would
+    overwrite an input. Returns a list of (path, status, info) tuples (see
+    segmentFile()) in input order.
+    '''
+    if cacheDir is None:
+        if outputDir is None:
+            raise ValueError('outputDir or cacheDir is required')
+        cacheDir = os.path.join(outputDir, '.cache')
+    os.makedirs(cacheDir, exist_ok=True)
+
+    params = {'color_space': color_space.lower(), 'channels': channels,
+        'k': k, 'unique': unique, 'bits': bits, 'n_init': n_init,
+        'max_iter': max_iter, 'seed': seed, 'width': width}
+    images = findImages(paths, exclude=(outputDir, cacheDir))
+    inputs = {os.path.realpath(path): path for path, _ in images}
+    tasks = []
+    outputs = {}
+    for path, relPath in images:
+        outPath = None
+        if outputDir is not None:
+            outPath = os.path.join(outputDir,
+                os.path.splitext(relPath)[0] + '.png')
+            # Files differing only in extension (e.g., a.jpg and a.png)
+            # would overwrite each other's output.
+            if outPath in outputs:
+                raise ValueError('{} and {} would both be written to {}'
+                    .format(outputs[outPath], path, outPath))
+            outputs[outPath] = path
+            # A .png input whose output is written to its own directory
+            # would be overwritten by its segmentation.
+            if os.path.realpath(outPath) in inputs:
+                raise ValueError('{} would be overwritten by the output of {}'
+                    .format(inputs[os.path.realpath(outPath)], path))
+        tasks.append((path, outPath, cacheDir, params))
+
+    # Each worker segments one image at a time; let the pool provide the
+    # parallelism rather than OpenCV's internal threads.
+    with Pool(workers, initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+        return pool.map(segmentFile, tasks, chunksize=1)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('inputs', nargs='+',
+        help='Image files and/or directories of images to segment')
+    ap.add_argument('-o', '--output-dir', required=True,
+        help='Directory to which segmented images are written')
+    ap.add_argument('--cache-dir', default=None,
+        help='Cache directory (default OUTPUT_DIR/.cache)')
+    ap.add_argument('-j', '--workers', type=int, default=None,
+        help='Number of worker processes (default: number of CPUs)')
+    ap.add_argument('-w', '--width', type=int, default=0,
+        help='Width to resize images to in pixels')
+    ap.add_argument('-s', '--color-space', type=str, default='bgr',
+        help='Color space to use: BGR (default), HSV, Lab, YCrCb (YCC)')
+    ap.add_argument('-c', '--channels', type=str, default='all',
+        help='Channel indices to use for clustering (default "all")')
+    ap.add_argument('-n', '--num-clusters', type=int, default=3,
+        help='Number of clusters for K-means clustering (default 3, min 2)')
+    ap.add_argument('--all-pixels', action='store_true',
+        help='Cluster every pixel instead of the distinct colors weighted'
+        + ' by pixel count (slower, same result up to initialization)')
+    ap.add_argument('-q', '--quantize', type=int, default=8,
+        help='Quantize colors to this many bits per channel before'
+        + ' clustering (default 8, no quantization)')
+    ap.add_argument('--seed', type=int, default=0,
+        help='Random seed for K-means initialization (default 0)')
+    args = vars(ap.parse_args())
+
+    startTime = time.perf_counter()
+    results = segmentBatch(args['inputs'], args['output_dir'],
+        args['cache_dir'], args['workers'], args['color_space'],
+        args['channels'], max(2, args['num_clusters']),
+        not args['all_pixels'], args['quantize'], seed=args['seed'],
+        width=args['width'])
+    elapsed = time.perf_counter() - startTime
+
+    statuses = [status for _, status, _ in results]
+    for path, status, info in results:
+        if status == 'failed':
+            print('{}: {}'.format(path, info))
+    print('{} images: {} segmented, {} cached, {} failed in {:.1f} s'.format(
+        len(results), statuses.count('segmented'), statuses.count('cached'),
+        statuses.count('failed'), elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+'''
+Name: benchmark.py
+Description: Benchmark of K-means engines for the color_segmentation.py
+    workload. Sweeps image size, number of clusters, color space, and
+    channel subset over bundled images (from ../images) and/or a synthetic
+    image, and runs each engine on each configuration in its own process.
+    Wall time, peak memory, inertia (over all pixels), and label agreement
+    with the reference engine (sklearn's full fit) are reported as JSON
+    and, optionally, CSV. For usage, run:
+    > python benchmark.py -h
+'''
+
+import argparse
+from collections import OrderedDict
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import sys
+import time
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+import sklearn
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import adjusted_rand_score
+import cv2
+from segmentation import (colorFeatures, nearestCenters, parseChannels,
+    peakMemoryMb, pixelInertia, uniqueColors)
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'images')
+
+def fitSklearn(features, k, options):
+    '''The reference: sklearn KMeans fit on every pixel, as in the script.'''
+    kmeans = KMeans(n_clusters=k, n_init=options['n_init'],
+        max_iter=options['max_iter'], random_state=options['seed'])
+    kmeans.fit(features)
+    return kmeans.labels_, kmeans.cluster_centers_
+
+def fitUnique(features, k, options):
+    '''sklearn KMeans fit on the distinct colors weighted by pixel count.'''
+    colors, counts, inverse = uniqueColors(features)
+    kmeans = KMeans(n_clusters=k, n_init=options['n_init'],
+        max_iter=options['max_iter'], random_state=options['seed'])
+    kmeans.fit(colors, sample_weight=counts)
+    return kmeans.labels_[inverse], kmeans.cluster_centers_
+
+def fitQuantized(features, k, options):
+    '''As fitUnique(), with colors quantized to options['bits'] bits.'''
+    colors, counts, inverse = uniqueColors(features, options['bits'])
+    kmeans = KMeans(n_clusters=k, n_init=options['n_init'],
+        max_iter=options['max_iter'], random_state=options['seed'])
+    kmeans.fit(colors, sample_weight=counts)
+    return kmeans.labels_[inverse], kmeans.cluster_centers_
+
+def fitOpenCV(features, k, options):
+    '''cv2.kmeans on every pixel with k-means++ initialization.'''
+    cv2.setRNGSeed(options['seed'])
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER,
+        options['max_iter'], 1e-4)
+    _, labels, centers = cv2.kmeans(features.astype(np.float32), k, None,
+        criteria, options['n_init'], cv2.KMEANS_PP_CENTERS)
+    return labels.ravel(), centers.astype(np.float64)
+
+def fitMiniBatch(features, k, options):
+    '''sklearn MiniBatchKMeans on every pixel.'''
+    kmeans = MiniBatchKMeans(n_clusters=k, n_init=3,
+        batch_size=options['batch_size'], random_state=options['seed'])
+    kmeans.fit(features)
+    return kmeans.labels_, kmeans.cluster_centers_
+
+def fitSubsample(features, k, options):
+    '''
+    sklearn KMeans fit on a random sample of pixels, then every pixel
+    assigned to its nearest center.
+    '''
+    sample = features
+    if features.shape[0] > options['sample_size']:
+        rng = np.random.default_rng(options['seed'])
+        sample = features[rng.choice(features.shape[0],
+            options['sample_size'], replace=False)]
+    kmeans = KMeans(n_clusters=k, n_init=options['n_init'],
+        max_iter=options['max_iter'], random_state=options['seed'])
+    kmeans.fit(sample)
+    labels, _ = nearestCenters(features, kmeans.cluster_centers_, False)
+    return labels, kmeans.cluster_centers_
+
+ENGINES = OrderedDict((
+    ('sklearn', fitSklearn),
+    ('unique', fitUnique),
+    ('quantized', fitQuantized),
+    ('opencv', fitOpenCV),
+    ('minibatch', fitMiniBatch),
+    ('subsample', fitSubsample),
+    ))
+
+REFERENCE = 'sklearn'
+
+def syntheticImage(width, seed=0, numColors=6, noise=12.0):
+    '''
+    Return a reproducible 4:3 BGR test image of overlapping ellipses in
+    numColors random colors on a random background, with Gaussian noise so
+    that it has many distinct colors, like a photo.
+    '''
+    rng = np.random.default_rng(seed)
+    height = width * 3 // 4
+    palette = rng.integers(0, 256, (numColors, 3))
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = palette[0]
+    for _ in range(4 * numColors):
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        axes = (int(rng.integers(width // 16, width // 4) + 1),
+            int(rng.integers(height // 16, height // 4) + 1))
+        color = palette[rng.integers(1, numColors)]
+        cv2.ellipse(image, center, axes, float(rng.uniform(0, 180)), 0, 360,
+            tuple(int(c) for c in color), -1)
+    noisy = image + rng.normal(0, noise, image.shape)
+    return np.clip(noisy, 0, 255).astype(np.uint8)
+
+def loadImage(name, width, seed):
+    '''
+    Return the BGR image named by a benchmark config ('synthetic' or a
+    path), resized to the given width.
+    '''
+    if name == 'synthetic':
+        return syntheticImage(width, seed)
+    image = cv2.imread(name)
+    if image is None:
+        raise RuntimeError('Error reading image {}'.format(name))
+    height = max(1, int(round(width * image.shape[0] / image.shape[1])))
+    interpolation = (cv2.INTER_AREA if width < image.shape[1]
+        else cv2.INTER_LINEAR)
+    return cv2.resize(image, (width, height), interpolation=interpolation)
+
+def runEngine(engine, config, options, results):
+    '''
+    Run one engine on one configuration and put its results in the results
+    queue. Intended to be run in a child process so that peak memory is
+    measured for that engine alone.
+    '''
+    try:
+        image = loadImage(config['image'], config['width'], options['seed'])
+        features = np.ascontiguousarray(colorFeatures(image,
+            config['color_space'], parseChannels(config['channels'])))
+        baseMemory = peakMemoryMb()
+
+        times = []
+        for _ in range(options['repeats']):
+            startTime = time.perf_counter()
+            labels, centers = ENGINES[engine](features, config['k'], options)
+            times.append(time.perf_counter() - startTime)
+
+        labels = np.asarray(labels, dtype=np.uint8)
+        results.put({
+            'wall_time_s': float(np.median(times)),
+            'wall_times_s': times,
+            'peak_rss_mb': peakMemoryMb(),
+            'peak_extra_mb': peakMemoryMb() - baseMemory,
+            'height': image.shape[0],
+            'pixels': features.shape[0],
+            'distinct_colors': int(uniqueColors(features)[1].size),
+            'inertia': pixelInertia(features, centers, labels),
+            'labels': labels,
+            })
+    except Exception as e:
+        results.put({'error': '{}: {}'.format(type(e).__name__, e)})
+
+def labelAgreement(reference, labels, k):
+    '''
+    Return the fraction of pixels with the same label in two labelings,
+    after matching the clusters of one to the other so as to maximize it
+    (cluster indices are arbitrary), and the adjusted Rand index.
+    '''
+    confusion = np.bincount(reference.astype(np.int64) * k + labels,
+        minlength=k * k).reshape(k, k)
+    rows, cols = linear_sum_assignment(-confusion)
+    agreement = confusion[rows, cols].sum() / reference.size
+    return float(agreement), float(adjusted_rand_score(reference, labels))
+
+def waitForResult(process, results, timeout):
+    '''
+    Return the result put in the results queue by an engine's process, or
+    an error result if the process exits without one (e.g., it was killed
+    for running out of memory) or runs for more than timeout seconds, in
+    which case it is terminated.
+    '''
+    deadline = time.perf_counter() + timeout if timeout else None
+    while True:
+        try:
+            return results.get(timeout=1.0)
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            # The result may still be in transit from the exited process.
+            try:
+                return results.get(timeout=1.0)
+            except queue.Empty:
+                process.join()
+                return {'error': 'Process exited with code {}'.format(
+                    process.exitcode)}
+        if deadline is not None and time.perf_counter() > deadline:
+            process.terminate()
+            return {'error': 'Timed out after {:g} s'.format(timeout)}
+
+def benchmark(configs, engines, options, timeout=None):
+    '''
+    Run each engine on each configuration in a fresh process and return a
+    list of result rows (dicts), one per configuration and engine. The
+    reference engine is always run first so the others can be compared
+    against it. An engine whose process fails or takes more than timeout
+    seconds gets a row with an error.
+
+    Processes are started with the spawn method rather than forked, so
+    each engine's peak memory doesn't include pages inherited from this
+    process.
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    engines = [REFERENCE] + [e for e in engines if e != REFERENCE]
+    rows = []
+    for config in configs:
+        reference = None
+        for engine in engines:
+            results = ctx.Queue()
+            process = ctx.Process(target=runEngine,
+                args=(engine, config, options, results))
+            process.start()
+            result = waitForResult(process, results, timeout)
+            process.join()
+
+            row = OrderedDict(config)
+            row['engine'] = engine
+            if 'error' in result:
+                row['error'] = result['error']
+                rows.append(row)
+                print('{} {}: {}'.format(describe(config), engine,
+                    result['error']), file=sys.stderr)
+                continue
+
+            labels = result.pop('labels')
+            row.update(result)
+            if engine == REFERENCE:
+                reference = (labels, result['inertia'])
+            if reference is not None:
+                row['inertia_change'] = (result['inertia'] / reference[1] - 1
+                    if reference[1] else 0.0)
+                row['label_agreement'], row['adjusted_rand'] = (
+                    labelAgreement(reference[0], labels, config['k']))
+            rows.append(row)
+            print('{} {}: {:.3f} s, +{:.0f} MB, inertia {:+.2%},'
+                ' agreement {:.2%}'.format(describe(config), engine,
+                    row['wall_time_s'], row['peak_extra_mb'],
+                    row.get('inertia_change', float('nan')),
+                    row.get('label_agreement', float('nan'))),
+                file=sys.stderr)
+    return rows
+
+def describe(config):
+    return '{} w={} k={} {}[{}]'.format(os.path.basename(config['image']),
+        config['width'], config['k'], config['color_space'],
+        config['channels'])
+
+def parseList(value, type=str):
+    return [type(v.strip()) for v in value.split(',') if v.strip()]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--images', '-i', default='synthetic,bundled',
+        help='Comma-separated images: paths, "synthetic" for a generated'
+        + ' image, and/or "bundled" for the images in ../images'
+        + ' (default synthetic,bundled)')
+    ap.add_argument('--widths', '-w', default='320,640',
+        help='Comma-separated image widths in pixels (default 320,640)')
+    ap.add_argument('--clusters', '-k', default='3,5',
+        help='Comma-separated numbers of clusters (default 3,5)')
+    ap.add_argument('--color-spaces', '-s', default='bgr,lab',
+        help='Comma-separated color spaces, from bgr, hsv, lab, ycrcb'
+        + ' (default bgr,lab)')
+    ap.add_argument('--channels', '-c', default='all',
+        help='Comma-separated channel subsets, e.g. "all,12" (default all)')
+    ap.add_argument('--engines', '-e', default=','.join(ENGINES),
+        help='Comma-separated engines to run, from: ' + ', '.join(ENGINES)
+        + ' (default all; {} is always run as the reference)'.format(
+            REFERENCE))
+    ap.add_argument('--n-init', type=int, default=10,
+        help='Initializations per fit (default 10; color_segmentation.py'
+        + ' uses 40)')
+    ap.add_argument('--max-iter', type=int, default=300,
+        help='Maximum iterations per initialization (default 300)')
+    ap.add_argument('--sample-size', type=int, default=20000,
+        help='Pixels fit by the subsample engine (default 20000)')
+    ap.add_argument('--batch-size', type=int, default=4096,
+        help='Batch size of the minibatch engine (default 4096)')
+    ap.add_argument('--bits', type=int, default=5,
+        help='Bits per channel of the quantized engine (default 5)')
+    ap.add_argument('--repeats', '-r', type=int, default=1,
+        help='Timed runs per engine and configuration; the median is'
+        + ' reported (default 1)')
+    ap.add_argument('--seed', type=int, default=0,
+        help='Random seed for images, samples, and initialization'
+        + ' (default 0)')
+    ap.add_argument('--timeout', type=float, default=None,
+        help='Seconds after which an engine is stopped and reported as'
+        + ' failed (default: no limit)')
+    ap.add_argument('--output', '-o', default=None,
+        help='Write JSON results to this file instead of stdout')
+    ap.add_argument('--csv', default=None,
+        help='Also write the result rows to this CSV file')
+    args = vars(ap.parse_args())
+
+    images = []
+    for name in parseList(args['images']):
+        if name == 'bundled':
+            images.extend(sorted(glob.glob(os.path.join(IMAGES_DIR, '*.jpg'))))
+        else:
+            images.append(name)
+    engines = parseList(args['engines'])
+    for engine in engines:
+        if engine not in ENGINES:
+            ap.error('Unknown engine {!r}'.format(engine))
+    colorSpaces = [s.lower() for s in parseList(args['color_spaces'])]
+    for colorSpace in colorSpaces:
+        if colorSpace not in ('bgr', 'hsv', 'lab', 'ycrcb', 'ycc'):
+            ap.error('Unknown color space {!r}'.format(colorSpace))
+
+    configs = [OrderedDict((('image', image), ('width', width), ('k', k),
+            ('color_space', colorSpace), ('channels', channels)))
+        for image in images
+        for width in parseList(args['widths'], int)
+        for k in parseList(args['clusters'], int)
+        for colorSpace in colorSpaces
+        for channels in parseList(args['channels'])]
+    options = {key: args[key] for key in ('n_init', 'max_iter',
+        'sample_size', 'batch_size', 'bits', 'repeats', 'seed')}
+
+    rows = benchmark(configs, engines, options, args['timeout'])
+    report = OrderedDict((
+        ('options', options),
+        ('platform', {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'sklearn': sklearn.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            }),
+        ('results', rows),
+        ))
+
+    output = json.dumps(report, indent=2)
+    if args['output'] is not None:
+        with open(args['output'], 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args['csv'] is not None:
+        fields = []
+        for row in rows:
+            fields.extend(key for key in row
+                if key not in fields and key != 'wall_times_s')
+        with open(args['csv'], 'w', newline='') as f:
+            writer = csv.DictWriter(f, fields, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+
+if __name__ == '__main__':
+    main()
@@ -12,13 +12,20 @@ Created: 2018-03-29
 '''
 
 import numpy as np
-from sklearn.cluster import KMeans
 import argparse
 import cv2
 import datetime
+import os
+import sys
+import time
+from segmentation import (COLOR_CODES, fitLarge, labelLarge, openLargeImage,
+    parseChannels, peakMemoryMb, rowsPerTile, segment, segmentVideo)
 
 ap = argparse.ArgumentParser()
-ap.add_argument('-i', '--image', required=True, help='Path to image file')
+ap.add_argument('-i', '--image', help='Path to image file')
+ap.add_argument('-v', '--video', type=str, default=None,
+    help='Segment a video file or camera (integer index) in real time'
+    + ' instead of an image')
 ap.add_argument('-w', '--width', type=int, default=0,
     help='Width to resize image to in pixels')
 ap.add_argument('-s', '--color-space', type=str, default='bgr',
@@ -34,66 +41,145 @@ ap.add_argument('-o', '--output-file', action='store_true',
     + ' clustering result) to disk.')
 ap.add_argument('-f', '--output-format', type=str, default='png',
     help='File extension for output image (default png)')
+ap.add_argument('-u', '--unique', action='store_true',
+    help='Cluster the distinct colors of the image, weighted by pixel count,'
+    + ' instead of every pixel (much faster, same result up to K-means'
+    + ' initialization)')
+ap.add_argument('-q', '--quantize', type=int, default=8,
+    help='With --unique, quantize colors to this many bits per channel'
+    + ' (1-8) before clustering; fewer bits is faster but approximate'
+    + ' (default 8, no quantization)')
+ap.add_argument('--compare-full', action='store_true',
+    help='Also run K-means on every pixel and report the relative'
+    + ' difference in inertia and the speedup')
+ap.add_argument('--tolerance', type=float, default=0.01,
+    help='Relative inertia difference allowed by --compare-full'
+    + ' (default 0.01)')
+ap.add_argument('-l', '--large', action='store_true',
+    help='Large-image mode: fit on a sample (or mini-batches) and label the'
+    + ' image tile by tile from a memory-mapped input to a memory-mapped'
+    + ' .npy output. Memory is bounded only for .npy inputs, which are mapped'
+    + ' directly; other formats are decoded in full once (see'
+    + ' --max-decode-mb)')
+ap.add_argument('--large-output', type=str, default=None,
+    help='Output .npy file of gray-level labels in large-image mode'
+    + ' (default: IMAGE_labels.npy)')
+ap.add_argument('--fit', type=str, default='sample',
+    choices=['sample', 'minibatch'],
+    help='How to fit centers in large-image mode (default sample)')
+ap.add_argument('--sample-size', type=int, default=1000000,
+    help='Number of pixels to fit on in large-image sample mode'
+    + ' (default 1000000)')
+ap.add_argument('--max-decode-mb', type=float, default=2048,
+    help='In large-image mode, reject non-.npy images whose decoded size'
+    + ' exceeds this many MB instead of decoding them (default 2048)')
+ap.add_argument('--tile-mb', type=float, default=64,
+    help='Working memory budget per tile in large-image mode, in MB'
+    + ' (default 64)')
+ap.add_argument('--max-iter', type=int, default=3,
+    help='K-means iterations per frame in video mode, starting from the'
+    + ' previous frame\'s centers (default 3)')
+ap.add_argument('--drift', type=float, default=0.25,
+    help='In video mode, refit from scratch when inertia rises by more than'
+    + ' this fraction since the last full fit (default 0.25)')
+ap.add_argument('--frame-sample', type=int, default=20000,
+    help='Pixels per frame used to update the centers in video mode'
+    + ' (default 20000)')
+ap.add_argument('--no-display', action='store_true',
+    help='In video mode, don\'t show the video (e.g., to measure latency)')
 
 args = vars(ap.parse_args())
+if (args['image'] is None) == (args['video'] is None):
+    ap.error('exactly one of --image and --video is required')
+
+if args['video'] is not None:
+    source = args['video']
+    if source.isdigit() and not os.path.isfile(source):
+        source = int(source)
+    channelIndices = parseChannels(args['channels'])
+    stream, latency = segmentVideo(source, args['color_space'].lower(),
+        channelIndices, max(2, args['num_clusters']), args['width'],
+        args['max_iter'], args['drift'], args['frame_sample'],
+        not args['no_display'])
+    print('{} frames, {} full fits; segmentation time per frame: p50 {:.1f}'
+        ' ms, p95 {:.1f} ms'.format(stream.frames, stream.refits,
+            1000 * (latency.percentile(50) or 0),
+            1000 * (latency.percentile(95) or 0)))
+    sys.exit(0)
+
+if args['large']:
+    colorSpace = args['color_space'].lower()
+    channelIndices = parseChannels(args['channels'])
+    numClusters = max(2, args['num_clusters'])
+    numChannels = 3 if channelIndices is None else len(channelIndices)
+
+    startTime = time.perf_counter()
+    image = openLargeImage(args['image'], maxDecodeMb=args['max_decode_mb'])
+    tileRows = rowsPerTile(image.shape[1], numChannels, numClusters,
+        args['tile_mb'] * 1024 * 1024)
+    centers = fitLarge(image, colorSpace, channelIndices, numClusters,
+        args['fit'], args['sample_size'], tileRows)
+    fitTime = time.perf_counter()
+
+    outPath = args['large_output'] or (
+        os.path.splitext(args['image'])[0] + '_labels.npy')
+    out, counts, inertia = labelLarge(image, centers, colorSpace,
+        channelIndices, outPath, tileRows)
+    endTime = time.perf_counter()
+
+    print('{}x{} image, {} rows per tile: fit {:.2f} s, labeling {:.2f} s'
+        .format(image.shape[1], image.shape[0], tileRows,
+            fitTime - startTime, endTime - fitTime))
+    print('Inertia: {:.6g}; cluster sizes: {}'.format(inertia,
+        ', '.join(str(count) for count in counts)))
+    # Peak RSS includes pages of the memory-mapped input and output, which
+    # the OS can reclaim under memory pressure.
+    print('Peak RSS {:.0f} MB; labels written to {}'.format(
+        peakMemoryMb(), outPath))
+    sys.exit(0)
+
 image = cv2.imread(args['image'])
 
-# Resize image and make a copy of the original (resized) image.
+# Resize image, if necessary.
 if args['width'] > 0:
     height = int((args['width'] / image.shape[1]) * image.shape[0])
     image = cv2.resize(image, (args['width'], height),
         interpolation=cv2.INTER_AREA)
-orig = image.copy()
 
-# Change image color space, if necessary.
 colorSpace = args['color_space'].lower()
-if colorSpace == 'hsv':
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-elif colorSpace == 'ycrcb' or colorSpace == 'ycc':
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb)
-elif colorSpace == 'lab':
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-else:
+if colorSpace not in COLOR_CODES:
     colorSpace = 'bgr'  # set for file naming purposes
 
-# Keep only the selected channels for K-means clustering.
-if args['channels'] != 'all':
-    channels = cv2.split(image)
-    channelIndices = []
-    for char in args['channels']:
-        channelIndices.append(int(char))
-    image = image[:,:,channelIndices]
-    if len(image.shape) == 2:
-        image.reshape(image.shape[0], image.shape[1], 1)
-
-# Flatten the 2D image array into an MxN feature vector, where M is
-# the number of pixels and N is the dimension (number of channels).
-reshaped = image.reshape(image.shape[0] * image.shape[1], image.shape[2])
-
-# Perform K-means clustering.
+# Perform K-means clustering in the chosen color space and channels (see
+# segment() in segmentation.py).
 if args['num_clusters'] < 2:
     print('Warning: num-clusters < 2 invalid. Using num-clusters = 2')
 numClusters = max(2, args['num_clusters'])
-kmeans = KMeans(n_clusters=numClusters, n_init=40, max_iter=500).fit(reshaped)
-
-# Reshape result back into a 2D array, where each element represents the
-# corresponding pixel's cluster index (0 to K - 1).
-clustering = np.reshape(np.array(kmeans.labels_, dtype=np.uint8),
-    (image.shape[0], image.shape[1]))
-
-# Sort the cluster labels in order of the frequency with which they occur.
-sortedLabels = sorted([n for n in range(numClusters)],
-    key=lambda x: -np.sum(clustering == x))
+startTime = time.perf_counter()
+result = segment(image, colorSpace, args['channels'], numClusters,
+    args['unique'], args['quantize'])
+elapsed = time.perf_counter() - startTime
+print('Clustered {} pixels{} in {:.2f} s'.format(
+    image.shape[0] * image.shape[1],
+    ' by unique color' if args['unique'] or args['quantize'] < 8 else '',
+    elapsed))
+print('Inertia: {:.6g}'.format(result.inertia))
 
-# Initialize K-means grayscale image; set pixel colors based on clustering.
-kmeansImage = np.zeros(image.shape[:2], dtype=np.uint8)
-for i, label in enumerate(sortedLabels):
-    kmeansImage[clustering == label] = int(255 / (numClusters - 1)) * i
+if args['compare_full']:
+    startTime = time.perf_counter()
+    full = segment(image, colorSpace, args['channels'], numClusters)
+    fullElapsed = time.perf_counter() - startTime
+    difference = (result.inertia - full.inertia) / full.inertia
+    print('Full fit: inertia {:.6g} in {:.2f} s; relative difference'
+        ' {:+.4%} ({} tolerance of {:.2%}); speedup {:.1f}x'.format(
+            full.inertia, fullElapsed, difference,
+            'within' if difference <= args['tolerance'] else 'OUTSIDE',
+            args['tolerance'], fullElapsed / elapsed))
 
 # Concatenate original image and K-means image, separated by a gray strip.
-concatImage = np.concatenate((orig,
-    193 * np.ones((orig.shape[0], int(0.0625 * orig.shape[1]), 3), dtype=np.uint8),
-    cv2.cvtColor(kmeansImage, cv2.COLOR_GRAY2BGR)), axis=1)
+concatImage = np.concatenate((image,
+    193 * np.ones((image.shape[0], int(0.0625 * image.shape[1]), 3), dtype=np.uint8),
+    cv2.cvtColor(result.gray, cv2.COLOR_GRAY2BGR)), axis=1)
 cv2.imshow('Original vs clustered', concatImage)
 
 if args['output_file']:
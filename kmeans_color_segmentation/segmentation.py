@@ -0,0 +1,552 @@
+'''
+Name: segmentation.py
+Description: K-means color segmentation functions used by
+    color_segmentation.py and batch_segmentation.py, which can also be
+    imported on their own, e.g.:
+    > from segmentation import segment
+    > result = segment(cv2.imread('photo.jpg'), 'lab', 'all', 4)
+    > cv2.imwrite('segmented.png', result.gray)
+'''
+
+from collections import namedtuple
+import os
+import sys
+import tempfile
+import time
+import warnings
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.exceptions import ConvergenceWarning
+import cv2
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Result of segment(). gray is the HxW segmented image, labels the HxW
+# cluster index of each pixel, with clusters numbered by decreasing pixel
+# count, centers and counts the center and pixel count of each cluster (in
+# the same order), and inertia the sum of squared distances of all pixels to
+# their cluster center.
+Segmentation = namedtuple('Segmentation',
+    ['gray', 'labels', 'centers', 'counts', 'inertia'])
+
+COLOR_CODES = {
+    'hsv': cv2.COLOR_BGR2HSV,
+    'ycrcb': cv2.COLOR_BGR2YCrCb,
+    'ycc': cv2.COLOR_BGR2YCrCb,
+    'lab': cv2.COLOR_BGR2LAB,
+    }
+
+def parseChannels(channels):
+    '''
+    Return a list of channel indices given 'all' (or None) for all channels,
+    a string of digits such as '02', or a sequence of integers.
+    '''
+    if channels is None or channels == 'all':
+        return None
+    return [int(channel) for channel in channels]
+
+def frequencyRanks(counts):
+    '''
+    Return the rank of each cluster by pixel count (0 for the most frequent;
+    ties keep cluster order).
+    '''
+    ranks = np.empty(len(counts), dtype=np.int64)
+    ranks[np.argsort(-np.asarray(counts), kind='stable')] = np.arange(
+        len(counts))
+    return ranks
+
+def grayLevels(counts):
+    '''
+    Return a lookup table from cluster index to the gray level used for the
+    cluster in segmented images: evenly spaced from 0 (black) for the most
+    frequent cluster to 255 for the least frequent.
+    '''
+    return (int(255 / (len(counts) - 1)) * frequencyRanks(counts)).astype(
+        np.uint8)
+
+def uniqueColors(features, bits=8, sort=False):
+    '''
+    Collapse an MxN uint8 feature matrix (N <= 3) into its distinct colors.
+    If bits < 8, colors are first quantized to that many bits per channel,
+    and each quantized color is represented by the mean of its pixels.
+    Returns (colors, counts, inverse): the UxN distinct colors, the number
+    of pixels of each, and the index into colors of each pixel.
+
+    Pixels are counted in a table of 2^(bits * N) entries (about 200 MB at
+    8 bits with 3 channels), which is fastest for whole images. If sort,
+    the colors are found by sorting instead, in memory proportional to M,
+    e.g., for a sample of pixels under a memory budget.
+    '''
+    quantized = features >> (8 - bits) if bits < 8 else features
+    keys = np.zeros(features.shape[0], dtype=np.int64)
+    for i in range(features.shape[1]):
+        keys |= quantized[:, i].astype(np.int64) << (bits * i)
+
+    if sort:
+        (present, inverse, counts) = np.unique(keys, return_inverse=True,
+            return_counts=True)
+        inverse = inverse.reshape(-1).astype(np.int32)
+        return _colorsOf(features, bits, present, counts, inverse)
+
+    # Count pixels per color with bincount rather than np.unique, which
+    # would sort all M keys.
+    allCounts = np.bincount(keys, minlength=1 << (bits * features.shape[1]))
+    present = np.flatnonzero(allCounts)
+    index = np.zeros(allCounts.size, dtype=np.int32)
+    index[present] = np.arange(present.size, dtype=np.int32)
+    inverse = index[keys]
+    counts = allCounts[present]
+    return _colorsOf(features, bits, present, counts, inverse)
+
+def _colorsOf(features, bits, present, counts, inverse):
+    '''
+    Return (colors, counts, inverse) for uniqueColors(), given the sorted
+    distinct keys present.
+    '''
+    if bits == 8:
+        colors = np.stack([(present >> (8 * i)) & 0xFF
+            for i in range(features.shape[1])], axis=1)
+    else:
+        colors = np.stack([np.bincount(inverse, weights=features[:, i],
+            minlength=present.size) / counts
+            for i in range(features.shape[1])], axis=1)
+    return colors.astype(np.float64), counts, inverse
+
+def pixelInertia(features, centers, labels, chunkSize=1 << 20):
+    '''
+    Return the K-means inertia (sum of squared distances of pixels to their
+    cluster centers) of a labeling of all pixels, computed in chunks.
+    '''
+    inertia = 0.0
+    for start in range(0, features.shape[0], chunkSize):
+        diff = (features[start:start + chunkSize].astype(np.float64)
+            - centers[labels[start:start + chunkSize]])
+        inertia += np.einsum('ij,ij->', diff, diff)
+    return inertia
+
+def colorFeatures(bgr, colorSpace, channelIndices=None):
+    '''
+    Convert a BGR image (or tile) to the given color space and return the
+    selected channels as an MxN uint8 feature matrix.
+    '''
+    code = COLOR_CODES.get(colorSpace)
+    converted = bgr if code is None else cv2.cvtColor(bgr, code)
+    features = converted.reshape(-1, converted.shape[-1])
+    if channelIndices is not None:
+        features = features[:, channelIndices]
+    return features
+
+def segment(image, color_space='bgr', channels='all', k=3, unique=False,
+        bits=8, n_init=40, max_iter=500, seed=None):
+    '''
+    Segment a BGR image by K-means clustering of its pixels in the given
+    color space ('bgr', 'hsv', 'lab', or 'ycrcb'/'ycc'), using only the
+    given channels (see parseChannels()), into k clusters. If unique is True
+    (or bits < 8), the distinct colors of the image (quantized to bits bits
+    per channel) are clustered, weighted by pixel count, instead of every
+    pixel (see uniqueColors()). If there are fewer distinct colors than k,
+    each is its own cluster and the rest are empty, as with the full fit.
+    Returns a Segmentation.
+    '''
+    colorSpace = color_space.lower()
+    if colorSpace != 'bgr' and colorSpace not in COLOR_CODES:
+        raise ValueError('Unsupported color space {!r}'.format(color_space))
+    if k < 2:
+        raise ValueError('k must be at least 2')
+
+    features = colorFeatures(image, colorSpace, parseChannels(channels))
+    kmeans = KMeans(n_clusters=k, n_init=n_init, max_iter=max_iter,
+        random_state=seed)
+    if unique or bits < 8:
+        colors, weights, inverse = uniqueColors(features, bits)
+        if len(colors) < k:
+            # KMeans can't fit fewer samples than clusters; the optimum is
+            # each color in its own cluster, padded with empty clusters at
+            # an existing color, which is what the full fit finds.
+            warnings.warn('Number of distinct colors ({}) is smaller than k'
+                ' ({})'.format(len(colors), k), ConvergenceWarning)
+            centers = np.concatenate([colors,
+                np.repeat(colors[:1], k - len(colors), axis=0)])
+            labels = inverse
+            fitInertia = 0.0
+        else:
+            kmeans.fit(colors, sample_weight=weights)
+            centers = kmeans.cluster_centers_
+            labels = kmeans.labels_[inverse]
+            fitInertia = kmeans.inertia_
+    else:
+        kmeans.fit(features)
+        centers = kmeans.cluster_centers_
+        labels = kmeans.labels_
+        fitInertia = kmeans.inertia_
+
+    # With exact colors, the weighted inertia is the inertia over all
+    # pixels; quantized colors stand in for several colors each.
+    inertia = (fitInertia if bits == 8
+        else pixelInertia(features, centers, labels))
+
+    # Count pixels per cluster in one pass, then renumber clusters by
+    # frequency and map them to gray levels with lookup tables.
+    counts = np.bincount(labels, minlength=k)
+    ranks = frequencyRanks(counts)
+    shape = image.shape[:2]
+    rankedLabels = ranks.astype(np.uint8)[labels].reshape(shape)
+    gray = grayLevels(counts)[labels].reshape(shape)
+    order = np.argsort(ranks)
+    return Segmentation(gray, rankedLabels, centers[order], counts[order],
+        inertia)
+
+def rowsPerTile(width, numChannels, numClusters, tileBytes):
+    '''
+    Return the number of image rows per tile such that the working memory
+    of labeling a tile (input, converted tile, float features, distances,
+    labels) stays within tileBytes.
+    '''
+    bytesPerPixel = 3 + 3 + 4 * numChannels + 4 * numClusters + 8 + 1
+    return max(1, int(tileBytes // (width * bytesPerPixel)))
+
+def imageSize(path):
+    '''
+    Return the (width, height) of an image file from its header, without
+    decoding it, or None if it can't be determined (Pillow is needed).
+    '''
+    if Image is None:
+        return None
+    try:
+        # Only the header is read, so the decompression bomb limit, which
+        # guards against decoding, doesn't apply here.
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            with Image.open(path) as img:
+                return img.size
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+    except (OSError, ValueError):
+        return None
+
+def openLargeImage(path, scratchDir=None, maxDecodeMb=2048):
+    '''
+    Return an HxWx3 uint8 BGR array for a large image without holding it in
+    memory. .npy files are memory-mapped directly, so memory stays bounded
+    whatever their size. Other formats have to be decoded in full by OpenCV
+    once, so peak memory is the whole decoded image; the decoded image is
+    then copied to a memory-mapped scratch file and freed.
+
+    To keep that bounded, images whose decoded size exceeds maxDecodeMb (or
+    OpenCV's CV_IO_MAX_IMAGE_PIXELS limit) are rejected with a ValueError
+    before decoding; convert them to .npy instead. The size is read from
+    the header if Pillow is installed; otherwise it is only checked by
+    OpenCV.
+    '''
+    if path.lower().endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+
+    size = imageSize(path)
+    if size is not None:
+        pixels = size[0] * size[1]
+        maxPixels = int(os.environ.get('CV_IO_MAX_IMAGE_PIXELS', 1 << 30))
+        if pixels * 3 > maxDecodeMb * 1024 * 1024 or pixels > maxPixels:
+            raise ValueError('{} is {}x{}; decoding it would take {:.0f} MB'
+                ' (limit {:g} MB, {} pixels). Convert it to an HxWx3 BGR'
+                ' .npy file, which is memory-mapped instead of decoded'.format(
+                    path, size[0], size[1], pixels * 3 / (1024 * 1024),
+                    maxDecodeMb, maxPixels))
+
+    decoded = cv2.imread(path)
+    if decoded is None:
+        raise RuntimeError('Error reading image {} (images larger than'
+            ' OpenCV\'s CV_IO_MAX_IMAGE_PIXELS can\'t be decoded; convert'
+            ' them to .npy)'.format(path))
+    handle, scratchPath = tempfile.mkstemp(suffix='.npy', dir=scratchDir)
+    os.close(handle)
+    image = np.lib.format.open_memmap(scratchPath, mode='w+',
+        dtype=np.uint8, shape=decoded.shape)
+    image[:] = decoded
+    del decoded
+    image.flush()
+    os.remove(scratchPath)  # the mapping stays valid (on POSIX systems)
+    return image
+
+def fitLarge(image, colorSpace, channelIndices, numClusters, method='sample',
+        sampleSize=1000000, tileRows=256, batchSize=65536, seed=0):
+    '''
+    Fit K-means cluster centers to a large (memory-mapped) image, reading it
+    tileRows rows at a time. With method 'sample', about sampleSize pixels
+    are drawn from randomly chosen rows and clustered by unique color (see
+    uniqueColors()). With method 'minibatch', MiniBatchKMeans makes one pass
+    over the image, updated with a random batch of batchSize pixels from
+    each tile. Returns the KxN cluster centers.
+    '''
+    rng = np.random.default_rng(seed)
+    (height, width) = image.shape[:2]
+
+    if method == 'minibatch':
+        kmeans = MiniBatchKMeans(n_clusters=numClusters, random_state=seed,
+            batch_size=batchSize, n_init=3)
+        for start in range(0, height, tileRows):
+            features = colorFeatures(image[start:start + tileRows],
+                colorSpace, channelIndices)
+            if features.shape[0] > batchSize:
+                features = features[rng.choice(features.shape[0], batchSize,
+                    replace=False)]
+            if features.shape[0] >= numClusters:
+                kmeans.partial_fit(features.astype(np.float32))
+        return kmeans.cluster_centers_.astype(np.float64)
+
+    # Spread the sample over many rows (for spatial coverage) and take
+    # random columns from each.
+    numRows = min(height, max(1, -(-sampleSize // min(width, 1024))))
+    rows = np.sort(rng.choice(height, numRows, replace=False))
+    perRow = min(width, -(-sampleSize // numRows))
+    samples = []
+    for i in range(0, numRows, tileRows):
+        tile = np.asarray(image[rows[i:i + tileRows]])
+        columns = rng.choice(width, perRow, replace=False)
+        samples.append(colorFeatures(np.ascontiguousarray(tile[:, columns]),
+            colorSpace, channelIndices))
+    sample = np.concatenate(samples)
+
+    # Sort rather than count with a table of every color, so that memory
+    # stays proportional to the sample size.
+    colors, counts, _ = uniqueColors(sample, sort=True)
+    kmeans = KMeans(n_clusters=numClusters, n_init=10, max_iter=500,
+        random_state=seed).fit(colors, sample_weight=counts)
+    return kmeans.cluster_centers_
+
+# Every possible 1- or 2-channel uint8 color, keyed by number of channels.
+_colorGrids = {}
+
+def _colorGrid(numChannels):
+    if numChannels not in _colorGrids:
+        levels = np.arange(256, dtype=np.float32)
+        _colorGrids[numChannels] = np.stack(np.meshgrid(
+            *([levels] * numChannels), indexing='ij'), axis=-1).reshape(
+                -1, numChannels)
+    return _colorGrids[numChannels]
+
+def nearestCenters(features, centers, computeInertia=True):
+    '''
+    Return the index of the nearest center to each row of an MxN feature
+    matrix and the total squared distance (inertia, or None if not
+    computeInertia), computed in float32 as |x|^2 - 2x.c + |c|^2 so that
+    only an MxK distance matrix is allocated. For uint8 features with one or
+    two channels, the nearest center of every possible color (at most 65536)
+    is computed instead and looked up for each pixel.
+    '''
+    numChannels = features.shape[1]
+    if features.dtype == np.uint8 and numChannels <= 2:
+        colorLabels, _ = nearestCenters(_colorGrid(numChannels), centers,
+            False)
+        keys = features[:, 0].astype(np.intp)
+        if numChannels == 2:
+            keys = (keys << 8) | features[:, 1]
+        labels = colorLabels[keys]
+        if not computeInertia:
+            return labels, None
+        diff = _colorGrid(numChannels) - centers[colorLabels]
+        colorDistances = np.einsum('ij,ij->i', diff, diff)
+        counts = np.bincount(keys, minlength=colorLabels.size)
+        return labels, float(counts @ colorDistances)
+
+    features = features.astype(np.float32)
+    centers32 = centers.astype(np.float32)
+    distances = features @ (-2 * centers32.T)
+    distances += np.einsum('ij,ij->i', centers32, centers32)
+    labels = distances.argmin(axis=1)
+    if not computeInertia:
+        return labels, None
+    inertia = float(np.sum(distances.min(axis=1), dtype=np.float64)
+        + np.einsum('ij,ij->', features, features, dtype=np.float64))
+    return labels, inertia
+
+def labelLarge(image, centers, colorSpace, channelIndices, outPath,
+        tileRows=256):
+    '''
+    Assign every pixel of a large (memory-mapped) image to its nearest
+    cluster center, tileRows rows at a time, writing into an HxW uint8
+    memory-mapped .npy file at outPath. As in the rest of this script, the
+    output holds gray levels with clusters ranked by pixel count (most
+    frequent darkest). Returns (output, counts, inertia).
+    '''
+    (height, width) = image.shape[:2]
+    numClusters = centers.shape[0]
+    out = np.lib.format.open_memmap(outPath, mode='w+', dtype=np.uint8,
+        shape=(height, width))
+    counts = np.zeros(numClusters, dtype=np.int64)
+    inertia = 0.0
+
+    # First pass: nearest center of each pixel.
+    for start in range(0, height, tileRows):
+        features = colorFeatures(np.asarray(image[start:start + tileRows]),
+            colorSpace, channelIndices)
+        labels, tileInertia = nearestCenters(features, centers)
+        inertia += tileInertia
+        counts += np.bincount(labels, minlength=numClusters)
+        out[start:start + tileRows] = labels.reshape(-1, width)
+
+    # Second pass: map cluster indices to gray levels by frequency rank.
+    grayLut = grayLevels(counts)
+    for start in range(0, height, tileRows):
+        out[start:start + tileRows] = grayLut[out[start:start + tileRows]]
+    out.flush()
+    return out, counts, inertia
+
+class StreamingKMeans:
+    '''
+    K-means for a stream of frames that reuses each frame's centers to seed
+    the next. For each frame, up to maxIter K-means iterations are run on a
+    random sample of sampleSize pixels, starting from the previous centers,
+    and every pixel is then assigned to its nearest center. A full refit
+    (from scratch, with nInit initializations) is done on the first frame
+    and whenever the sample inertia per pixel rises more than drift (as a
+    fraction) above its value after the last full refit.
+
+    Clusters keep their index from frame to frame: warm-started centers
+    keep their order, and the centers of a full refit are matched to the
+    previous centers (minimizing the total distance between them) before
+    replacing them. Gray levels are assigned to cluster indices once, by
+    pixel count on the first frame (most frequent darkest, as for still
+    images), so the output doesn't flicker.
+    '''
+    def __init__(self, numClusters, maxIter=3, drift=0.25, sampleSize=20000,
+            nInit=3, seed=0):
+        self.numClusters = numClusters
+        self.maxIter = maxIter
+        self.drift = drift
+        self.sampleSize = sampleSize
+        self.nInit = nInit
+        self.rng = np.random.default_rng(seed)
+        self.seed = seed
+
+        self.centers = None
+        self.grayLut = None
+        self.baseInertia = None
+        self.inertia = None
+        self.frames = 0
+        self.refits = 0
+
+    def _sample(self, features):
+        if features.shape[0] <= self.sampleSize:
+            return features.astype(np.float64)
+        idx = self.rng.integers(0, features.shape[0], self.sampleSize)
+        return features[idx].astype(np.float64)
+
+    def _refit(self, sample):
+        kmeans = KMeans(n_clusters=self.numClusters, n_init=self.nInit,
+            max_iter=300, random_state=self.seed + self.refits).fit(sample)
+        centers = kmeans.cluster_centers_
+        if self.centers is not None:
+            cost = ((self.centers[:, None, :] - centers[None]) ** 2).sum(-1)
+            _, order = linear_sum_assignment(cost)
+            centers = centers[order]
+        self.centers = centers
+        self.baseInertia = self.inertia = kmeans.inertia_ / sample.shape[0]
+        self.refits += 1
+
+    def _iterate(self, sample, centers):
+        '''
+        Run up to maxIter Lloyd iterations on the sample from the given
+        centers (clusters left empty keep their center). This avoids the
+        per-call overhead of sklearn's KMeans, which dominates for small
+        samples and few iterations. Returns the new centers and the sample
+        inertia per pixel.
+        '''
+        for _ in range(self.maxIter):
+            labels, _ = nearestCenters(sample, centers, False)
+            counts = np.bincount(labels, minlength=self.numClusters)
+            sums = np.stack([np.bincount(labels, weights=sample[:, i],
+                minlength=self.numClusters)
+                for i in range(sample.shape[1])], axis=1)
+            nonEmpty = counts > 0
+            updated = centers.copy()
+            updated[nonEmpty] = sums[nonEmpty] / counts[nonEmpty, None]
+            converged = np.allclose(updated, centers, atol=1e-2)
+            centers = updated
+            if converged:
+                break
+        _, inertia = nearestCenters(sample, centers)
+        return centers, inertia / sample.shape[0]
+
+    def update(self, features):
+        '''
+        Segment the next frame, given as an MxN feature matrix (see
+        colorFeatures()). Returns the cluster index of each pixel.
+        '''
+        sample = self._sample(features)
+        if self.centers is None:
+            self._refit(sample)
+        else:
+            centers, self.inertia = self._iterate(sample, self.centers)
+            if self.inertia > (1 + self.drift) * self.baseInertia:
+                self._refit(sample)
+            else:
+                self.centers = centers
+
+        labels, _ = nearestCenters(features, self.centers, False)
+        if self.grayLut is None:
+            self.grayLut = grayLevels(np.bincount(labels,
+                minlength=self.numClusters))
+        self.frames += 1
+        return labels
+
+    def grayImage(self, labels, shape):
+        '''Return labels as a gray-level image of the given (H, W) shape.'''
+        return self.grayLut[labels].reshape(shape)
+
+def segmentVideo(source, colorSpace, channelIndices, numClusters, width=0,
+        maxIter=3, drift=0.25, sampleSize=20000, display=True):
+    '''
+    Segment a video file or camera (source is a path or camera index)
+    frame by frame with StreamingKMeans, showing the original and
+    segmented frames side by side with the per-frame segmentation time.
+    Returns the StreamingKMeans and a LatencyHistogram of per-frame times.
+    '''
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(
+        __file__)), '..', 'multithread'))
+    from FrameSource import FrameSource
+    from Metrics import LatencyHistogram
+
+    capture = FrameSource(source, width=width)
+    if not capture.isOpened():
+        raise RuntimeError('Error opening video source {}'.format(source))
+    stream = StreamingKMeans(numClusters, maxIter, drift, sampleSize)
+    latency = LatencyHistogram()
+    frame = None
+    while True:
+        (grabbed, frame) = capture.read(frame)
+        if not grabbed:
+            break
+
+        startTime = time.perf_counter()
+        labels = stream.update(colorFeatures(frame, colorSpace,
+            channelIndices))
+        gray = stream.grayImage(labels, frame.shape[:2])
+        elapsed = time.perf_counter() - startTime
+        latency.record(elapsed)
+
+        if display:
+            output = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+            cv2.putText(output, '{:.1f} ms'.format(1000 * elapsed), (10, 30),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+            cv2.imshow('Original vs clustered',
+                np.concatenate((frame, output), axis=1))
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    capture.release()
+    if display:
+        cv2.destroyAllWindows()
+    return stream, latency
+
+def peakMemoryMb():
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else (
+        peak / 1024.0)
@@ -0,0 +1,202 @@
+import asyncio
+from collections import deque
+from threading import Thread
+from VideoGet import VideoGet
+
+class AsyncFrameStream:
+    """
+    Class that delivers the frames of an AsyncVideoSource to a single
+    async consumer, as an async iterator of VideoGet Frame tuples.
+
+    Frames are buffered in a queue of up to maxsize frames. If the
+    consumer falls behind, the oldest buffered frames are dropped so
+    that a slow consumer never holds up the capture or other consumers.
+    lag() gives the number of frames the consumer is behind the newest
+    captured frame.
+    """
+
+    def __init__(self, source, maxsize=2):
+        self.source = source
+        self.maxsize = max(1, maxsize)
+        self._queue = deque()
+        self._event = asyncio.Event()
+        self._closed = False
+
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.last_seq = -1
+
+    def lag(self):
+        """
+        Return the number of frames captured since the last frame this
+        consumer took from the stream.
+        """
+
+        return max(0, self.source.seq - self.last_seq)
+
+    def stats(self):
+        return {
+            "received": self.frames_received,
+            "dropped": self.frames_dropped,
+            "queued": len(self._queue),
+            "lag": self.lag(),
+            }
+
+    def _push(self, frame):
+        """Add a frame to the queue. Runs in the event loop thread."""
+
+        if len(self._queue) >= self.maxsize:
+            self._queue.popleft()
+            self.frames_dropped += 1
+        self._queue.append(frame)
+        self.frames_received += 1
+        self._event.set()
+
+    def _close(self):
+        self._closed = True
+        self._event.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await self.source._ensureStarted()
+        while not self._queue:
+            if self._closed:
+                raise StopAsyncIteration
+            self._event.clear()
+            await self._event.wait()
+        frame = self._queue.popleft()
+        self.last_seq = frame.seq
+        return frame
+
+    def close(self):
+        """Stop receiving frames from the source."""
+
+        self.source._unsubscribe(self)
+        self._close()
+
+class AsyncVideoSource:
+    """
+    Class that makes frames from a VideoGet available to asyncio code
+    without blocking the event loop:
+
+        async with AsyncVideoSource(src) as source:
+            async for frame in source:
+                ...
+
+    Each "async for" over the source (or call to subscribe()) creates a
+    separate AsyncFrameStream consumer. All consumers share the frames
+    of a single capture, so one camera can feed many clients with one
+    decode per frame. Frames are shared between consumers and must not
+    be modified in place.
+
+    A dedicated thread waits on VideoGet.read() and hands each frame to
+    the event loop with call_soon_threadsafe(). policy and queue_size
+    are passed to the VideoGet; "block" avoids dropping frames of video
+    files at the VideoGet (consumers still drop frames independently).
+    The source starts when first iterated (or with start()) and runs
+    until the video ends or stop() is called.
+    """
+
+    def __init__(self, src=0, maxsize=2, policy="drop_oldest", queue_size=4,
+            metrics=None):
+        self.src = src
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue_size = queue_size
+        self.metrics = metrics
+        self.seq = -1
+        self.stopped = False
+
+        self._consumers = []
+        self._getter = None
+        self._thread = None
+        self._loop = None
+        self._start_lock = None
+
+    async def _ensureStarted(self):
+        if self._getter is None:
+            await self.start()
+
+    async def start(self):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+
+        async with self._start_lock:
+            if self._getter is not None:
+                return self
+
+            # VideoGet opens the stream and reads the first frame in its
+            # constructor, which can block for a while (e.g., camera
+            # startup), so create it in the default executor.
+            self._loop = asyncio.get_running_loop()
+            self._getter = await self._loop.run_in_executor(None,
+                lambda: VideoGet(self.src, self.queue_size, self.policy,
+                    metrics=self.metrics))
+            self._getter.start()
+            self._thread = Thread(target=self._dispatch, args=(), daemon=True)
+            self._thread.start()
+        return self
+
+    def _dispatch(self):
+        """Pass frames from the VideoGet to the event loop."""
+
+        while not self.stopped:
+            frame = self._getter.read(timeout=0.1)
+            if frame is not None:
+                self._loop.call_soon_threadsafe(self._publish, frame)
+            elif self._getter.stopped:
+                break
+
+        self._loop.call_soon_threadsafe(self._closeAll)
+
+    def _publish(self, frame):
+        self.seq = frame.seq
+        for consumer in self._consumers:
+            consumer._push(frame)
+
+    def _closeAll(self):
+        self.stopped = True
+        for consumer in self._consumers:
+            consumer._close()
+
+    def subscribe(self, maxsize=None):
+        """
+        Return a new AsyncFrameStream that receives every subsequent
+        frame, buffering up to maxsize frames (default: the source's
+        maxsize) before dropping the oldest.
+        """
+
+        consumer = AsyncFrameStream(self,
+            self.maxsize if maxsize is None else maxsize)
+        if self.stopped:
+            consumer._close()
+        else:
+            self._consumers.append(consumer)
+        return consumer
+
+    def _unsubscribe(self, consumer):
+        if consumer in self._consumers:
+            self._consumers.remove(consumer)
+
+    def __aiter__(self):
+        return self.subscribe()
+
+    def stats(self):
+        """Return a list of per-consumer statistics."""
+
+        return [consumer.stats() for consumer in self._consumers]
+
+    async def stop(self):
+        self.stopped = True
+        if self._getter is not None:
+            self._getter.stop()
+            await self._loop.run_in_executor(None, self._thread.join)
+        self._closeAll()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
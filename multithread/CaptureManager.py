@@ -0,0 +1,282 @@
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+from threading import Condition, Thread
+import time
+from Metrics import LatencyHistogram, RateMeter, clock
+from VideoGet import Frame, openCapture
+
+# A set of frames, one per source (a dict mapping source name to Frame),
+# captured within the manager's tolerance of one another. timestamp is
+# the earliest capture timestamp in the set.
+FrameSet = namedtuple("FrameSet", ["seq", "timestamp", "frames"])
+
+class CaptureSource:
+    """
+    Class that holds the capture object, health, and statistics of one
+    source owned by a CaptureManager.
+
+    status is one of:
+        "ok": frames are being captured.
+        "reconnecting": too many consecutive reads failed; the stream
+            has been closed and will be reopened periodically.
+        "ended": a video file reached its end (files are not reopened),
+            or reads from a capture object passed in as the source kept
+            failing while it still reported being open (e.g., a
+            VideoCapture or FrameSource over a file at its end), which
+            reopening can't fix.
+    """
+
+    def __init__(self, name, src):
+        self.name = name
+        self.src = src
+        self.is_file = isinstance(src, str) and os.path.isfile(src)
+        self.stream = None
+        self.status = "reconnecting"
+        self.failures = 0
+        self.opens = 0
+        self.next_retry = 0.0
+
+        self.seq = -1
+        self.frame = None
+        self.frames_captured = 0
+        self.rate = RateMeter()
+        self.grab_latency = LatencyHistogram()
+
+    def open(self):
+        """
+        Open (or reopen) the stream. Capture objects passed in as the
+        source are reused as is. Returns True on success.
+        """
+
+        if self.stream is not None and self.stream is not self.src:
+            self.stream.release()
+        self.stream = openCapture(self.src)
+        if self.stream.isOpened():
+            self.status = "ok"
+            self.failures = 0
+            self.opens += 1
+            return True
+        return False
+
+    def grab(self):
+        """Grab (but don't decode) a frame; return its timestamp or None."""
+
+        start_time = clock()
+        if not self.stream.grab():
+            return None
+        timestamp = clock()
+        self.grab_latency.record(timestamp - start_time)
+        return timestamp
+
+    def retrieve(self, timestamp):
+        """Decode the grabbed frame; return it as a Frame or None."""
+
+        grabbed, image = self.stream.retrieve()
+        if not grabbed:
+            return None
+        self.seq += 1
+        self.frames_captured += 1
+        self.rate.increment(now=timestamp)
+        self.frame = Frame(self.seq, timestamp, image)
+        return self.frame
+
+    def stats(self, now=None):
+        now = clock() if now is None else now
+        return {
+            "status": self.status,
+            "frames": self.frames_captured,
+            "rate": self.rate.rate(now),
+            "lag": now - self.frame.timestamp if self.frame else None,
+            "grab_p50": self.grab_latency.percentile(50),
+            "grab_p95": self.grab_latency.percentile(95),
+            "failures": self.failures,
+            "reconnects": max(0, self.opens - 1),
+            }
+
+class CaptureManager:
+    """
+    Class that captures from many sources with a single dedicated thread
+    and emits synchronized sets of frames.
+
+    Each round, every healthy source is first grabbed (with
+    VideoCapture.grab(), which doesn't decode) and only then retrieved
+    (decoded), so that all sources are grabbed as close together in time
+    as possible. If parallel is True, the grabs (and then the retrieves)
+    of all sources are issued concurrently from a thread pool, since
+    OpenCV releases the GIL while they run.
+
+    A FrameSet is emitted for a round if the capture timestamps of its
+    frames lie within tolerance seconds of one another and, if
+    require_all is True, every source with status "ok" contributed a
+    frame. Frame sets are placed in a buffer of queue_size sets, from
+    which the oldest is dropped when full, and taken with read().
+
+    After max_failures consecutive failed reads, a camera's stream is
+    closed and reopened every reconnect_interval seconds until it
+    works again.
+
+    sources is a dict mapping names to sources (file paths, camera
+    indices, or capture objects), or a list of sources, which are then
+    named by their index.
+    """
+
+    def __init__(self, sources, tolerance=0.02, require_all=True,
+            parallel=True, max_failures=5, reconnect_interval=2.0,
+            queue_size=2):
+        if not isinstance(sources, dict):
+            sources = OrderedDict((str(i), src)
+                for i, src in enumerate(sources))
+
+        self.sources = OrderedDict((name, CaptureSource(name, src))
+            for name, src in sources.items())
+        self.tolerance = tolerance
+        self.require_all = require_all
+        self.max_failures = max_failures
+        self.reconnect_interval = reconnect_interval
+        self.queue_size = max(1, queue_size)
+        self._pool = ThreadPoolExecutor(len(self.sources)) if (
+            parallel and len(self.sources) > 1) else None
+
+        self._buffer = deque()
+        self._cond = Condition()
+        self.seq = -1
+        self.sets_emitted = 0
+        self.sets_dropped = 0
+        self.sets_unaligned = 0
+        self.spread = LatencyHistogram()
+        self.stopped = False
+        self._thread = None
+
+    def start(self):
+        for source in self.sources.values():
+            if not source.open():
+                source.next_retry = clock() + self.reconnect_interval
+        self._thread = Thread(target=self.run, args=(), daemon=True)
+        self._thread.start()
+        return self
+
+    def _map(self, func, items):
+        if self._pool is None:
+            return [func(item) for item in items]
+        return list(self._pool.map(func, items))
+
+    def run(self):
+        while not self.stopped:
+            self._reconnect()
+            active = [s for s in self.sources.values() if s.status == "ok"]
+            if not active:
+                if all(s.status == "ended" for s in self.sources.values()):
+                    break
+                time.sleep(min(0.1, self.reconnect_interval))
+                continue
+
+            timestamps = self._map(lambda s: s.grab(), active)
+            grabbed = [(s, t) for s, t in zip(active, timestamps)
+                if t is not None]
+            frames = self._map(lambda st: st[0].retrieve(st[1]), grabbed)
+
+            frame_set = OrderedDict()
+            retrieved = set()
+            for (source, _), frame in zip(grabbed, frames):
+                if frame is not None:
+                    frame_set[source.name] = frame
+                    retrieved.add(source.name)
+            for source in active:
+                if source.name in retrieved:
+                    source.failures = 0
+                else:
+                    self._fail(source)
+
+            self._emit(frame_set, len(active))
+
+        for source in self.sources.values():
+            if source.stream is not None and hasattr(source.stream, "release"):
+                source.stream.release()
+        if self._pool is not None:
+            self._pool.shutdown()
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+
+    def _reconnect(self):
+        now = clock()
+        for source in self.sources.values():
+            if source.status == "reconnecting" and now >= source.next_retry:
+                if not source.open():
+                    source.next_retry = now + self.reconnect_interval
+
+    def _fail(self, source):
+        source.failures += 1
+        if source.is_file:
+            source.status = "ended"
+        elif source.failures >= self.max_failures:
+            if source.stream is source.src and source.stream.isOpened():
+                # open() would reuse the same object, which would keep
+                # failing, so treat it as having ended.
+                source.status = "ended"
+                return
+            source.status = "reconnecting"
+            source.next_retry = clock() + self.reconnect_interval
+
+    def _emit(self, frames, num_active):
+        if not frames or (self.require_all and len(frames) < num_active):
+            self.sets_unaligned += 1
+            return
+
+        timestamps = [frame.timestamp for frame in frames.values()]
+        spread = max(timestamps) - min(timestamps)
+        if spread > self.tolerance:
+            self.sets_unaligned += 1
+            return
+        self.spread.record(spread)
+
+        with self._cond:
+            if len(self._buffer) >= self.queue_size:
+                self._buffer.popleft()
+                self.sets_dropped += 1
+            self.seq += 1
+            self.sets_emitted += 1
+            self._buffer.append(FrameSet(self.seq, min(timestamps), frames))
+            self._cond.notify_all()
+
+    def read(self, timeout=None):
+        """
+        Return the oldest unread FrameSet, waiting up to timeout seconds
+        (indefinitely if None). Returns None on timeout or if the manager
+        stopped with no frame sets left to read.
+        """
+
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._buffer or self.stopped, timeout):
+                return None
+            if not self._buffer:
+                return None
+            return self._buffer.popleft()
+
+    def stats(self):
+        """
+        Return per-source health and capture statistics (status, capture
+        rate, lag since the last frame, grab latency, failures, and
+        reconnects) along with frame set counts and timestamp spread.
+        """
+
+        now = clock()
+        return {
+            "sources": OrderedDict((name, source.stats(now))
+                for name, source in self.sources.items()),
+            "sets_emitted": self.sets_emitted,
+            "sets_dropped": self.sets_dropped,
+            "sets_unaligned": self.sets_unaligned,
+            "spread": self.spread.snapshot(),
+            }
+
+    def stop(self):
+        """Stop capturing and wait for the capture thread to finish."""
+
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
@@ -1,23 +1,26 @@
-from datetime import datetime
+from Metrics import RateMeter
 
 class CountsPerSec:
     """
     Class that tracks the number of occurrences ("counts") of an
     arbitrary event and returns the frequency in occurrences
     (counts) per second. The caller must increment the count.
+
+    The frequency is measured with a monotonic clock over a sliding
+    window of the last window seconds rather than averaged over the
+    object's lifetime, so that stalls show up in the result.
     """
 
-    def __init__(self):
-        self._start_time = None
-        self._num_occurrences = 0
+    def __init__(self, window=5.0):
+        self.window = window
+        self._meter = None
 
     def start(self):
-        self._start_time = datetime.now()
+        self._meter = RateMeter(self.window)
         return self
 
     def increment(self):
-        self._num_occurrences += 1
+        self._meter.increment()
 
     def countsPerSec(self):
-        elapsed_time = (datetime.now() - self._start_time).total_seconds()
-        return self._num_occurrences / elapsed_time if elapsed_time > 0 else 0
+        return self._meter.rate()
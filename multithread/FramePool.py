@@ -0,0 +1,77 @@
+from threading import Condition
+import numpy as np
+
+class FramePool:
+    """
+    Class that manages a fixed number of preallocated frame buffers.
+    Buffers are leased with acquire() and must be handed back with
+    release() when the caller is done with them, so that a capture loop
+    can decode every frame into an existing buffer instead of allocating
+    a new array per frame.
+    """
+
+    def __init__(self, shape, dtype=np.uint8, size=4):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.size = size
+        self._free = [np.empty(self.shape, dtype=self.dtype)
+            for _ in range(size)]
+        # Leased buffers by id(). The buffers are kept so that their ids
+        # can't be reused by other arrays while they are leased.
+        self._leased = {}
+        self._cond = Condition()
+
+        # Number of successful acquire() calls and number of acquire()
+        # calls that found no free buffer.
+        self.acquired = 0
+        self.exhausted = 0
+
+    def acquire(self, block=False, timeout=None):
+        """
+        Lease a free buffer. If none are free, return None or, if block
+        is True, wait up to timeout seconds (indefinitely if None) for
+        one to be released.
+        """
+
+        with self._cond:
+            if not self._free:
+                self.exhausted += 1
+                if not block or not self._cond.wait_for(
+                        lambda: self._free, timeout):
+                    return None
+            buf = self._free.pop()
+            self._leased[id(buf)] = buf
+            self.acquired += 1
+            return buf
+
+    def release(self, buf):
+        """
+        Return a leased buffer to the pool. Arrays that did not come
+        from this pool, or that have already been released, are ignored.
+        Returns True if the buffer was returned to the pool.
+        """
+
+        with self._cond:
+            if self._leased.get(id(buf)) is not buf:
+                return False
+            del self._leased[id(buf)]
+            self._free.append(buf)
+            self._cond.notify()
+            return True
+
+    def available(self):
+        with self._cond:
+            return len(self._free)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "available": len(self._free),
+                "leased": len(self._leased),
+                "acquired": self.acquired,
+                "exhausted": self.exhausted,
+                }
@@ -0,0 +1,139 @@
+import cv2
+from VideoGet import openCapture
+
+class FrameSource:
+    """
+    Class that wraps a VideoCapture (or other capture object) to read
+    only the frames that will actually be processed, with the same
+    read()/grab()/retrieve() interface as cv2.VideoCapture.
+
+    step: return every step-th frame. Frames in between are skipped with
+        grab() alone and never fully decoded.
+    width: if nonzero, resize frames to this width (keeping the aspect
+        ratio) with the given interpolation. The full-size frame is
+        decoded into an internal buffer that is reused for every frame.
+    start_frame/start_time, end_frame/end_time: for video files, seek to
+        the given frame index or time in seconds before the first read
+        and stop (read() fails) at the given end frame index or time.
+        End bounds are exclusive. Seeking may not be frame-accurate for
+        every codec and backend.
+
+    As with VideoCapture.read(), frames are returned in a new array
+    unless an array of matching size and type is passed to read().
+    """
+
+    def __init__(self, src=0, step=1, width=0, start_frame=None,
+            end_frame=None, start_time=None, end_time=None,
+            interpolation=cv2.INTER_AREA):
+        self.stream = openCapture(src)
+        self.step = max(1, int(step))
+        self.width = width
+        self.end_frame = end_frame
+        self.end_time = end_time
+        self.interpolation = interpolation
+        self._raw = None
+        self._size = None
+
+        if start_time is not None:
+            self.stream.set(cv2.CAP_PROP_POS_MSEC, 1000.0 * start_time)
+        elif start_frame:
+            self.stream.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+        # Index (in the underlying stream) of the next frame to be
+        # grabbed, and of the frame most recently returned.
+        self.pos = int(self.stream.get(cv2.CAP_PROP_POS_FRAMES) or 0)
+        self.frame_idx = None
+        self.timestamp = None
+        self.frames_decoded = 0
+        self.frames_skipped = 0
+
+    def isOpened(self):
+        return self.stream.isOpened()
+
+    def get(self, prop_id):
+        return self.stream.get(prop_id)
+
+    def set(self, prop_id, value):
+        return self.stream.set(prop_id, value)
+
+    def release(self):
+        self.stream.release()
+
+    def _grabOne(self):
+        """
+        Grab the next frame of the underlying stream without decoding
+        it. Returns False at the end of the stream or the end bound.
+        """
+
+        if self.end_frame is not None and self.pos >= self.end_frame:
+            return False
+        if not self.stream.grab():
+            return False
+        self.pos += 1
+
+        if self.end_time is not None:
+            msec = self.stream.get(cv2.CAP_PROP_POS_MSEC)
+            if msec and msec / 1000.0 >= self.end_time:
+                return False
+        return True
+
+    def grab(self):
+        """
+        Grab the next frame to be returned, skipping step - 1 frames
+        first if this isn't the first frame.
+        """
+
+        if self.frame_idx is not None:
+            for _ in range(self.step - 1):
+                if not self._grabOne():
+                    return False
+                self.frames_skipped += 1
+
+        if not self._grabOne():
+            return False
+        self.frame_idx = self.pos - 1
+        msec = self.stream.get(cv2.CAP_PROP_POS_MSEC)
+        self.timestamp = msec / 1000.0 if msec >= 0 else None
+        return True
+
+    def retrieve(self, image=None, flag=0):
+        """Decode (and resize) the most recently grabbed frame."""
+
+        if not self.width:
+            grabbed, image = self.stream.retrieve(image)
+            if grabbed:
+                self.frames_decoded += 1
+            return grabbed, image
+
+        grabbed, self._raw = self.stream.retrieve(self._raw)
+        if not grabbed:
+            return False, None
+        self.frames_decoded += 1
+
+        (height, width) = self._raw.shape[:2]
+        if self._size is None or self._size[2:] != (width, height):
+            resize_height = int(float(self.width / width) * height)
+            self._size = (self.width, resize_height, width, height)
+        image = cv2.resize(self._raw, self._size[:2], dst=image,
+            interpolation=self.interpolation)
+        return True, image
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def frameCount(self):
+        """
+        Return the number of frames still to be returned by read() (all
+        of them, if reading hasn't started), if the length of the stream
+        is known, or None.
+        """
+
+        total = int(self.stream.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        if total <= 0:
+            return None
+        end = total if self.end_frame is None else min(total, self.end_frame)
+        if self.frame_idx is None:
+            return max(0, (end - self.pos + self.step - 1) // self.step)
+        return max(0, (end - 1 - self.frame_idx) // self.step)
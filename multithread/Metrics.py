@@ -0,0 +1,246 @@
+from bisect import bisect_left
+import json
+import math
+import os
+from threading import Event, Lock, Thread
+import time
+
+# All metrics (and frame timestamps from VideoGet) use this clock, which
+# is monotonic and unaffected by system clock adjustments.
+clock = time.perf_counter
+
+# Default latency histogram bucket upper bounds in seconds: 1-2-5 steps
+# from 100 microseconds to 10 seconds.
+DEFAULT_LATENCY_BOUNDS = tuple(m * 10.0 ** e for e in range(-4, 1)
+    for m in (1, 2, 5)) + (10.0,)
+
+class RateMeter:
+    """
+    Class that tracks the rate of an event, in occurrences per second,
+    over a sliding window of the most recent window seconds. Counts are
+    kept in a ring of fixed-width time buckets, so increment() does a
+    constant amount of work regardless of the event rate.
+    """
+
+    def __init__(self, window=5.0, resolution=0.25):
+        self.window = window
+        self.resolution = resolution
+        self._num_buckets = max(1, int(math.ceil(window / resolution)))
+        self._counts = [0] * self._num_buckets
+        self._bucket_ids = [-1] * self._num_buckets
+        self._start_time = clock()
+        self.total = 0
+
+    def increment(self, n=1, now=None):
+        bucket_id = int((clock() if now is None else now) / self.resolution)
+        i = bucket_id % self._num_buckets
+        if self._bucket_ids[i] != bucket_id:
+            self._bucket_ids[i] = bucket_id
+            self._counts[i] = 0
+        self._counts[i] += n
+        self.total += n
+
+    def rate(self, now=None):
+        """Return occurrences per second over the sliding window."""
+
+        now = clock() if now is None else now
+        bucket_id = int(now / self.resolution)
+        oldest = bucket_id - self._num_buckets
+        count = sum(c for c, b in zip(self._counts, self._bucket_ids)
+            if oldest < b <= bucket_id)
+
+        # The window covers the current (partial) bucket plus the full
+        # buckets before it, but no more time than has elapsed since the
+        # meter was created.
+        span = min((self._num_buckets - 1) * self.resolution
+            + (now - bucket_id * self.resolution), now - self._start_time)
+        return count / span if span > 0 else 0.0
+
+class LatencyHistogram:
+    """
+    Class that records latency samples (in seconds) into fixed buckets,
+    from which percentiles are estimated. bounds are the ascending upper
+    bounds of the buckets; samples above the last bound fall into an
+    overflow bucket.
+    """
+
+    def __init__(self, bounds=DEFAULT_LATENCY_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        Estimate the pth percentile (0 <= p <= 100) by linear
+        interpolation within the bucket containing it. Returns 0 if no
+        samples have been recorded.
+        """
+
+        if self.count == 0:
+            return 0.0
+
+        rank = p / 100.0 * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            if c and cumulative + c >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                upper = min(upper, self.max)
+                fraction = (rank - cumulative) / c
+                return lower + fraction * max(0.0, upper - lower)
+            cumulative += c
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+            }
+
+class PipelineMetrics:
+    """
+    Class that holds named rate meters, latency histograms, and counters
+    for the stages of a video pipeline (e.g., "capture", "process",
+    "display"), and exports snapshots of them as JSON or in Prometheus
+    text format. Metrics are created on first use. Recording a sample is
+    not locked; each metric should be updated from a single thread.
+    """
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self.rates = {}
+        self.latencies = {}
+        self.counters = {}
+        self._lock = Lock()
+        self._start_time = clock()
+
+    def rate(self, name):
+        meter = self.rates.get(name)
+        if meter is None:
+            with self._lock:
+                meter = self.rates.setdefault(name, RateMeter(self.window))
+        return meter
+
+    def latency(self, name):
+        histogram = self.latencies.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.latencies.setdefault(name,
+                    LatencyHistogram())
+        return histogram
+
+    def increment(self, name, n=1):
+        """Increment a counter (e.g., of dropped frames)."""
+
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        now = clock()
+        return {
+            "uptime": now - self._start_time,
+            "rates": {name: meter.rate(now)
+                for name, meter in list(self.rates.items())},
+            "latency": {name: histogram.snapshot()
+                for name, histogram in list(self.latencies.items())},
+            "counters": dict(self.counters),
+            }
+
+    def toJson(self):
+        """Return a snapshot as a single line of JSON."""
+
+        snapshot = self.snapshot()
+        snapshot["time"] = time.time()
+        return json.dumps(snapshot, sort_keys=True)
+
+    def toPrometheus(self, prefix="video_"):
+        """Return the current metrics in Prometheus text format."""
+
+        lines = []
+        now = clock()
+
+        name = prefix + "rate_per_second"
+        lines.append("# TYPE {} gauge".format(name))
+        for stage, meter in sorted(self.rates.items()):
+            lines.append('{}{{stage="{}"}} {:.6g}'.format(
+                name, stage, meter.rate(now)))
+
+        name = prefix + "events_total"
+        lines.append("# TYPE {} counter".format(name))
+        for counter, value in sorted(self.counters.items()):
+            lines.append('{}{{counter="{}"}} {}'.format(name, counter, value))
+
+        name = prefix + "latency_seconds"
+        lines.append("# TYPE {} histogram".format(name))
+        for stage, histogram in sorted(self.latencies.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{stage="{}",le="{:g}"}} {}'.format(
+                    name, stage, bound, cumulative))
+            lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(
+                name, stage, histogram.count))
+            lines.append('{}_sum{{stage="{}"}} {:.6g}'.format(
+                name, stage, histogram.sum))
+            lines.append('{}_count{{stage="{}"}} {}'.format(
+                name, stage, histogram.count))
+        return "\n".join(lines) + "\n"
+
+class MetricsExporter:
+    """
+    Class that periodically exports PipelineMetrics snapshots from a
+    dedicated thread, either appending JSON lines ("jsonl") to a file or
+    overwriting it with the Prometheus text format ("prometheus"), e.g.,
+    for the node exporter textfile collector.
+    """
+
+    FORMATS = ("jsonl", "prometheus")
+
+    def __init__(self, metrics, path, interval=1.0, fmt="jsonl"):
+        if fmt not in MetricsExporter.FORMATS:
+            raise ValueError("Invalid format {!r}; expected one of {}".format(
+                fmt, ", ".join(MetricsExporter.FORMATS)))
+
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.fmt = fmt
+        self._stop_event = Event()
+        self._thread = Thread(target=self.run, args=(), daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.export()
+        self.export()
+
+    def export(self):
+        if self.fmt == "jsonl":
+            with open(self.path, "a") as f:
+                f.write(self.metrics.toJson() + "\n")
+        else:
+            # Write to a temporary file and rename so that readers never
+            # see a partially written file.
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(self.metrics.toPrometheus())
+            os.replace(tmp_path, self.path)
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
@@ -0,0 +1,89 @@
+import time
+import cv2
+import numpy as np
+
+class SyntheticCapture:
+    """
+    Class that mimics the parts of the cv2.VideoCapture interface used in
+    this directory (read(), grab(), retrieve(), isOpened(), get(),
+    release()) and generates frames of a given resolution instead of
+    decoding them, e.g., for benchmarking on machines without a camera.
+
+    Frames cycle through a small set of precomputed noise images with a
+    moving bar, so generating a frame costs a single copy. If fps is
+    nonzero, read() and grab() are paced to that frame rate like a
+    camera; otherwise frames are produced as fast as they are requested.
+    After num_frames frames (if nonzero), reads fail like at the end of
+    a video file.
+    """
+
+    NUM_PATTERNS = 8
+
+    def __init__(self, width=640, height=480, fps=0, num_frames=0, seed=0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.num_frames = num_frames
+        self.frame_idx = 0
+        self._opened = True
+        self._next_time = None
+
+        rng = np.random.default_rng(seed)
+        self._patterns = []
+        for i in range(SyntheticCapture.NUM_PATTERNS):
+            pattern = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+            x = int(i * width / SyntheticCapture.NUM_PATTERNS)
+            pattern[:, x:x + max(1, width // 16)] = 255
+            self._patterns.append(pattern)
+
+    def isOpened(self):
+        return self._opened
+
+    def grab(self):
+        if not self._opened or (
+                self.num_frames and self.frame_idx >= self.num_frames):
+            return False
+
+        if self.fps:
+            now = time.perf_counter()
+            if self._next_time is None:
+                self._next_time = now
+            elif now < self._next_time:
+                time.sleep(self._next_time - now)
+            self._next_time += 1.0 / self.fps
+
+        self.frame_idx += 1
+        return True
+
+    def retrieve(self, image=None, flag=0):
+        if not self._opened or self.frame_idx == 0:
+            return False, None
+
+        pattern = self._patterns[(self.frame_idx - 1)
+            % SyntheticCapture.NUM_PATTERNS]
+        if (image is None or image.shape != pattern.shape
+                or image.dtype != pattern.dtype):
+            image = np.empty_like(pattern)
+        np.copyto(image, pattern)
+        return True, image
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def get(self, prop_id):
+        if prop_id == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        elif prop_id == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        elif prop_id == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        elif prop_id == cv2.CAP_PROP_FRAME_COUNT:
+            return float(self.num_frames)
+        elif prop_id == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.frame_idx)
+        return 0.0
+
+    def release(self):
+        self._opened = False
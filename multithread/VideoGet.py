@@ -1,18 +1,89 @@
-from threading import Thread
+from collections import deque, namedtuple
+from threading import Condition, Thread
 import cv2
+from FramePool import FramePool
+from Metrics import clock
+
+# A captured frame along with its sequence number (starting at 0 and
+# increasing by one for every frame read from the stream) and capture
+# timestamp (from Metrics.clock()).
+Frame = namedtuple("Frame", ["seq", "timestamp", "image"])
+
+def openCapture(src):
+    """
+    Return src itself if it is already a capture object (anything with a
+    read() method, e.g., a SyntheticCapture), else a cv2.VideoCapture
+    for the given file path or camera index.
+    """
+
+    if hasattr(src, "read"):
+        return src
+    return cv2.VideoCapture(src)
 
 class VideoGet:
     """
     Class that continuously gets frames from a VideoCapture object
     with a dedicated thread.
+
+    Captured frames are placed in a bounded ring buffer, from which
+    consumers take them with read(). The policy determines what happens
+    when the buffer is full:
+        "latest": buffer holds only the newest frame; an unread frame
+            is replaced (and counted as dropped) by the next one.
+        "drop_oldest": the oldest unread frame is discarded (and
+            counted as dropped) to make room for the new one.
+        "block": the capture thread waits until a consumer reads a
+            frame, i.e., no frames are dropped.
+
+    If pool_size is nonzero, frames are decoded in place into buffers
+    from a FramePool of that size, and the capture path allocates no
+    new arrays per frame. Each frame returned by read() is then on loan
+    to the caller, who must hand it back with release() when done with
+    it. The pool must be larger than queue_size, since one buffer is
+    always being filled by the capture thread.
+
+    If a PipelineMetrics object is given, the time taken by each
+    VideoCapture.read() call is recorded as "capture" latency, the
+    capture rate as the "capture" rate, and dropped frames with the
+    "capture_dropped" counter.
     """
 
-    def __init__(self, src=0):
-        self.stream = cv2.VideoCapture(src)
+    POLICIES = ("latest", "drop_oldest", "block")
+
+    def __init__(self, src=0, queue_size=1, policy="latest", pool_size=0,
+            metrics=None):
+        if policy not in VideoGet.POLICIES:
+            raise ValueError("Invalid policy {!r}; expected one of {}".format(
+                policy, ", ".join(VideoGet.POLICIES)))
+
+        self.policy = policy
+        self.queue_size = 1 if policy == "latest" else max(1, queue_size)
+        if pool_size and pool_size <= self.queue_size:
+            raise ValueError("pool_size must be greater than queue_size")
+        self._buffer = deque()
+        self._cond = Condition()
+
+        self.seq = -1
+        self.timestamp = None
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.frames_read = 0
+        self.metrics = metrics
+
+        self.stream = openCapture(src)
         (self.grabbed, self.frame) = self.stream.read()
         self.stopped = False
+        self.pool = None
+        if self.grabbed:
+            if pool_size:
+                self.pool = FramePool(self.frame.shape, self.frame.dtype,
+                    pool_size)
+                buf = self.pool.acquire()
+                buf[...] = self.frame
+                self.frame = buf
+            self._put(self.frame)
 
-    def start(self):    
+    def start(self):
         Thread(target=self.get, args=()).start()
         return self
 
@@ -20,8 +91,130 @@ class VideoGet:
         while not self.stopped:
             if not self.grabbed:
                 self.stop()
+            elif self.pool is None:
+                start_time = clock()
+                (self.grabbed, frame) = self.stream.read()
+                if self.grabbed:
+                    self._put(frame, start_time)
             else:
-                (self.grabbed, self.frame) = self.stream.read()
+                buf = self._acquireBuffer()
+                if buf is None:
+                    continue
+                start_time = clock()
+                (self.grabbed, frame) = self.stream.read(buf)
+                if self.grabbed and frame is not buf:
+                    frame = self._rebuffer(buf, frame)
+                if self.grabbed:
+                    self._put(frame, start_time)
+                else:
+                    self.pool.release(buf)
+
+    def _rebuffer(self, buf, frame):
+        """
+        Handle a frame that the capture returned in a new array rather
+        than in the leased buffer buf (e.g., because the frame size or
+        type changed). The frame is copied into buf if it fits; otherwise
+        buf goes back to the pool and the new array, which release()
+        ignores, is passed on instead, so the pool never loses a buffer.
+        """
+
+        if frame.shape == buf.shape and frame.dtype == buf.dtype:
+            buf[...] = frame
+            return buf
+        self.pool.release(buf)
+        return frame
+
+    def _acquireBuffer(self):
+        """
+        Lease a buffer from the pool for the next frame. If the pool is
+        exhausted and the policy permits dropping frames, reuse the
+        buffer of the oldest unread frame; otherwise, wait for a
+        consumer to release one. Returns None if stopped while waiting.
+        """
+
+        buf = self.pool.acquire()
+        if buf is not None:
+            return buf
+
+        if self.policy != "block":
+            with self._cond:
+                if self._buffer:
+                    self._countDropped()
+                    return self._buffer.popleft().image
+
+        while not self.stopped:
+            buf = self.pool.acquire(block=True, timeout=0.1)
+            if buf is not None:
+                return buf
+        return None
+
+    def _countDropped(self):
+        self.frames_dropped += 1
+        if self.metrics is not None:
+            self.metrics.increment("capture_dropped")
+
+    def _put(self, frame, start_time=None):
+        """
+        Add a newly captured frame to the ring buffer according to the
+        buffer policy and wake any consumers waiting in read().
+        start_time is when the read that produced the frame began.
+        """
+
+        timestamp = clock()
+        if self.metrics is not None:
+            self.metrics.rate("capture").increment(now=timestamp)
+            if start_time is not None:
+                self.metrics.latency("capture").record(timestamp - start_time)
+        with self._cond:
+            if self.policy == "block":
+                while (len(self._buffer) >= self.queue_size
+                        and not self.stopped):
+                    self._cond.wait()
+                if self.stopped:
+                    self.release(frame)
+                    return
+            elif len(self._buffer) >= self.queue_size:
+                self.release(self._buffer.popleft())
+                self._countDropped()
+
+            self.seq += 1
+            self.timestamp = timestamp
+            self.frame = frame
+            self.frames_captured += 1
+            self._buffer.append(Frame(self.seq, timestamp, frame))
+            self._cond.notify_all()
+
+    def read(self, timeout=None):
+        """
+        Return the oldest unread Frame, waiting up to timeout seconds
+        (indefinitely if None) for one to arrive. Returns None if the
+        timeout expires or the stream stops with no frames left to read.
+        A given frame is returned by read() at most once.
+        """
+
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._buffer or self.stopped, timeout):
+                return None
+            if not self._buffer:
+                return None
+            item = self._buffer.popleft()
+            self.frames_read += 1
+            self._cond.notify_all()
+            return item
+
+    def release(self, frame):
+        """
+        Return a frame (Frame or array) obtained from read() to the
+        buffer pool. Does nothing if the VideoGet has no pool.
+        """
+
+        if self.pool is not None:
+            if isinstance(frame, Frame):
+                frame = frame.image
+            self.pool.release(frame)
 
     def stop(self):
-        self.stopped = True
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
@@ -0,0 +1,351 @@
+import heapq
+from multiprocessing import Process, Queue, shared_memory
+import os
+import queue
+from threading import Condition, Thread
+import numpy as np
+from Metrics import clock
+from VideoGet import Frame
+
+def _attachSharedMemory(name):
+    """
+    Attach to an existing shared memory block without registering it
+    with the resource tracker (which would otherwise unlink it, or warn
+    about it, when the worker exits), where supported.
+    """
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def _processWorker(func, in_name, out_name, in_shape, in_dtype, out_shape,
+        out_dtype, num_slots, tasks, results):
+    """
+    Worker process loop. Each task names a slot; the worker calls
+    func(input, output) on that slot's shared memory arrays and reports
+    back. Only slot indices and sequence numbers pass through the
+    queues, never pixel data.
+    """
+
+    in_shm = _attachSharedMemory(in_name)
+    out_shm = _attachSharedMemory(out_name)
+    inputs = np.ndarray((num_slots,) + in_shape, dtype=in_dtype,
+        buffer=in_shm.buf)
+    outputs = np.ndarray((num_slots,) + out_shape, dtype=out_dtype,
+        buffer=out_shm.buf)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        slot, seq = task
+        try:
+            func(inputs[slot], outputs[slot])
+            error = None
+        except Exception as e:
+            error = repr(e)
+        results.put((slot, seq, error))
+
+    del inputs, outputs
+    in_shm.close()
+    out_shm.close()
+
+class VideoProcess:
+    """
+    Class that processes frames in a pool of worker processes, passing
+    frames to and from the workers through slots in shared memory.
+
+    func is called in a worker as func(frame, out) and must write its
+    result into the preallocated array out (of shape out_shape and type
+    out_dtype, which default to those of the input frames). It must be
+    defined at module level so it can be sent to the worker processes.
+
+    Frames are submitted with submit() and results retrieved with
+    read(). If ordered is True, results are returned in the order the
+    frames were submitted. Otherwise, only the most recent result is
+    kept ("latest result wins"); results superseded before being read,
+    or that finish after a newer result has been read, are dropped.
+
+    If a PipelineMetrics object is given, the time from submit() to the
+    result arriving back from a worker is recorded as "process"
+    latency, and dropped results with the "process_dropped" counter.
+
+    If a worker process dies (e.g., it segfaults or is killed), the
+    frames in flight can't be accounted for, since any of them could
+    have been the one it was processing. Their slots are freed, error
+    is set, and read() and pending() raise it instead of waiting for
+    results that will never arrive.
+    """
+
+    # Seconds between checks that the workers are alive while waiting
+    # for results.
+    WORKER_CHECK_INTERVAL = 0.5
+
+    def __init__(self, func, shape, dtype=np.uint8, out_shape=None,
+            out_dtype=None, workers=None, slots=None, ordered=True,
+            metrics=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.out_shape = self.shape if out_shape is None else tuple(out_shape)
+        self.out_dtype = self.dtype if out_dtype is None else np.dtype(out_dtype)
+        self.workers = workers or os.cpu_count() or 1
+        self.num_slots = slots or 2 * self.workers
+        self.ordered = ordered
+        self.metrics = metrics
+
+        in_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        out_nbytes = int(np.prod(self.out_shape)) * self.out_dtype.itemsize
+        self._in_shm = shared_memory.SharedMemory(create=True,
+            size=max(1, in_nbytes * self.num_slots))
+        self._out_shm = shared_memory.SharedMemory(create=True,
+            size=max(1, out_nbytes * self.num_slots))
+        self._inputs = np.ndarray((self.num_slots,) + self.shape,
+            dtype=self.dtype, buffer=self._in_shm.buf)
+        self._outputs = np.ndarray((self.num_slots,) + self.out_shape,
+            dtype=self.out_dtype, buffer=self._out_shm.buf)
+
+        self._tasks = Queue()
+        self._results = Queue()
+        self._processes = [
+            Process(target=_processWorker, args=(func, self._in_shm.name,
+                self._out_shm.name, self.shape, self.dtype, self.out_shape,
+                self.out_dtype, self.num_slots, self._tasks, self._results),
+                daemon=True)
+            for _ in range(self.workers)]
+        self._collector = Thread(target=self._collect, args=(), daemon=True)
+
+        self._cond = Condition()
+        self._free_slots = list(range(self.num_slots))
+        self._timestamps = {}
+        self._submit_times = {}
+        self._in_flight = {}
+        self._next_submit = 0
+
+        # Ordered mode: heap of (seq, slot) for finished frames, the next
+        # sequence number to be returned, and failed sequence numbers.
+        self._ready = []
+        self._next_read = 0
+        self._failed = set()
+
+        # Latest mode: (seq, slot) of the newest finished frame and the
+        # sequence number of the last frame returned by read().
+        self._latest = None
+        self._last_read = -1
+
+        self.frames_submitted = 0
+        self.frames_processed = 0
+        self.frames_dropped = 0
+        self.frames_failed = 0
+        self.last_error = None
+        self.error = None
+        self.stopped = False
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        self._collector.start()
+        return self
+
+    def submit(self, frame, timestamp=None, timeout=None):
+        """
+        Copy a frame into a free shared memory slot and queue it for
+        processing, waiting up to timeout seconds (indefinitely if None)
+        for a slot to become free. Returns the frame's sequence number,
+        or None if no slot became free or the processor was stopped or
+        has failed.
+        """
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._free_slots
+                    or self.stopped or self.error is not None, timeout):
+                return None
+            if self.stopped or self.error is not None:
+                return None
+            slot = self._free_slots.pop()
+            seq = self._next_submit
+            self._next_submit += 1
+            self._timestamps[seq] = timestamp
+            self._submit_times[seq] = clock()
+            self._in_flight[seq] = slot
+            self.frames_submitted += 1
+
+        np.copyto(self._inputs[slot], frame)
+        self._tasks.put((slot, seq))
+        return seq
+
+    def _collect(self):
+        """
+        Receive results from the workers until sent None, checking that
+        the workers are still alive every WORKER_CHECK_INTERVAL seconds.
+        """
+
+        last_check = clock()
+        while True:
+            try:
+                msg = self._results.get(timeout=self.WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                msg = False
+            if clock() - last_check >= self.WORKER_CHECK_INTERVAL:
+                self._checkWorkers()
+                last_check = clock()
+            if msg is None:
+                break
+            if msg is False:
+                continue
+
+            slot, seq, error = msg
+            with self._cond:
+                if self._in_flight.pop(seq, None) is None:
+                    # Its slot was already freed when a worker died.
+                    continue
+                submit_time = self._submit_times.pop(seq, None)
+                if self.metrics is not None and error is None:
+                    self.metrics.latency("process").record(
+                        clock() - submit_time)
+                if error is not None:
+                    self.frames_failed += 1
+                    self.last_error = error
+                    self._failed.add(seq)
+                    self._freeSlot(slot, seq)
+                elif self.ordered:
+                    self.frames_processed += 1
+                    heapq.heappush(self._ready, (seq, slot))
+                elif seq <= self._last_read or (
+                        self._latest is not None and seq < self._latest[0]):
+                    self.frames_processed += 1
+                    self._countDropped()
+                    self._freeSlot(slot, seq)
+                else:
+                    self.frames_processed += 1
+                    if self._latest is not None:
+                        self._countDropped()
+                        self._freeSlot(self._latest[1], self._latest[0])
+                    self._latest = (seq, slot)
+                self._cond.notify_all()
+
+    def _checkWorkers(self):
+        """
+        If a worker has died, free the slots of all frames in flight, set
+        error, and wake up anything waiting on results.
+        """
+
+        with self._cond:
+            if self.stopped or self.error is not None:
+                return
+            dead = [p for p in self._processes if not p.is_alive()]
+            if not dead:
+                return
+            self.error = RuntimeError(
+                "VideoProcess worker {} exited with code {}".format(
+                    dead[0].pid, dead[0].exitcode))
+            self.frames_failed += len(self._in_flight)
+            for seq, slot in self._in_flight.items():
+                self._failed.add(seq)
+                self._submit_times.pop(seq, None)
+                self._freeSlot(slot, seq)
+            self._in_flight.clear()
+            self._cond.notify_all()
+
+    def _countDropped(self):
+        self.frames_dropped += 1
+        if self.metrics is not None:
+            self.metrics.increment("process_dropped")
+
+    def _freeSlot(self, slot, seq):
+        """Return a slot to the free list. Caller must hold the lock."""
+
+        self._free_slots.append(slot)
+        self._timestamps.pop(seq, None)
+
+    def _takeReady(self):
+        """
+        Return (seq, slot) of the next result to be read, or None if it
+        isn't available yet. Caller must hold the lock.
+        """
+
+        if not self.ordered:
+            latest, self._latest = self._latest, None
+            return latest
+
+        while self._next_read in self._failed:
+            self._failed.remove(self._next_read)
+            self._next_read += 1
+        if self._ready and self._ready[0][0] == self._next_read:
+            self._next_read += 1
+            return heapq.heappop(self._ready)
+        return None
+
+    def read(self, timeout=None, out=None):
+        """
+        Return the next result as a Frame whose timestamp is the one
+        passed to submit(), waiting up to timeout seconds (indefinitely
+        if None). The result is copied out of shared memory into out, if
+        given, or into a new array. Returns None on timeout or if the
+        processor is stopped. Raises error if a worker has died and no
+        result is left to read.
+        """
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.stopped
+                    or self._hasReady() or self.error is not None, timeout):
+                return None
+            if self.stopped:
+                return None
+            if not self._hasReady():
+                raise self.error
+            (seq, slot) = self._takeReady()
+            timestamp = self._timestamps.get(seq)
+
+        if out is None:
+            out = self._outputs[slot].copy()
+        else:
+            np.copyto(out, self._outputs[slot])
+
+        with self._cond:
+            self._last_read = max(self._last_read, seq)
+            self._freeSlot(slot, seq)
+            self._cond.notify_all()
+        return Frame(seq, timestamp, out)
+
+    def _hasReady(self):
+        if not self.ordered:
+            return self._latest is not None
+        next_read = self._next_read
+        while next_read in self._failed:
+            next_read += 1
+        return bool(self._ready) and self._ready[0][0] == next_read
+
+    def pending(self):
+        """
+        Return the number of frames submitted but not yet read. Raises
+        error if a worker has died and no result is left to read.
+        """
+
+        with self._cond:
+            pending = self.num_slots - len(self._free_slots)
+            if self.error is not None and not self._hasReady():
+                raise self.error
+            return pending
+
+    def stop(self):
+        with self._cond:
+            if self.stopped:
+                return
+            self.stopped = True
+            self._cond.notify_all()
+
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+        self._collector.join()
+
+        del self._inputs, self._outputs
+        for shm in (self._in_shm, self._out_shm):
+            shm.close()
+            shm.unlink()
@@ -1,24 +1,200 @@
-from threading import Thread
+from threading import Condition, Thread
 import cv2
+from Metrics import clock
+
+class ImshowSink:
+    """
+    Display sink that shows frames in a HighGUI window. show() displays
+    a frame; poll() processes window events and returns False once the
+    "q" key has been pressed.
+    """
+
+    def __init__(self, window="Video"):
+        self.window = window
+
+    def show(self, frame):
+        cv2.imshow(self.window, frame)
+
+    def poll(self):
+        return cv2.waitKey(1) != ord("q")
+
+class NullSink:
+    """
+    Display sink that discards frames, e.g., for headless benchmarking.
+    """
+
+    def show(self, frame):
+        pass
+
+    def poll(self):
+        return True
+
+class TeeSink:
+    """
+    Display sink that passes each frame to several sinks, e.g., an
+    ImshowSink and a VideoWrite. poll() returns False if any sink's
+    poll() does.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def show(self, frame):
+        for sink in self.sinks:
+            sink.show(frame)
+
+    def poll(self):
+        return all([sink.poll() for sink in self.sinks])
 
 class VideoShow:
     """
-    Class that continuously shows a frame using a dedicated thread.
+    Class that shows frames using a dedicated thread. Frames are shown
+    with an ImshowSink unless another sink is given.
+
+    The thread sleeps until a new frame is passed in with update() (or
+    by assigning to the frame attribute), so it only spends CPU time on
+    frames that haven't been shown yet. If max_fps is nonzero, frames
+    are shown at most that many times per second. If several frames
+    arrive while the thread is busy or throttled, only the newest is
+    shown and the rest are counted as skipped. Frames passed to update()
+    with the same sequence number as the previous frame are counted as
+    duplicates and ignored.
+
+    If on_release is given, it is called with each frame passed to
+    update() once VideoShow is done with it: when the frame has been
+    replaced by a newer one and is not being shown. Frames on loan from
+    a buffer pool (e.g., VideoGet's) can be handed back from it, so that
+    a buffer is never reused while a sink is still reading it.
+
+    If a PipelineMetrics object is given, the time taken to show each
+    frame is recorded as "display" latency, the time from the timestamp
+    passed to update() (e.g., when the frame was captured) until the
+    frame has been shown as "e2e" latency, the display rate as the
+    "display" rate, and skipped and duplicate frames with the
+    "display_skipped" and "display_duplicate" counters.
     """
 
-    def __init__(self, frame=None):
-        self.frame = frame
+    # Maximum time to wait for a new frame before polling the sink for
+    # window events (e.g., a key press) anyway.
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, frame=None, metrics=None, sink=None, max_fps=0,
+            on_release=None):
+        self.metrics = metrics
+        self.sink = sink or ImshowSink()
+        self.max_fps = max_fps
+        self.on_release = on_release
         self.stopped = False
 
+        self._cond = Condition()
+        self._frame = frame
+        self._seq = None
+        self._timestamp = None
+        self._showing = None
+        self.version = 0 if frame is None else 1
+        self._shown_version = 0
+
+        self.frames_displayed = 0
+        self.frames_skipped = 0
+        self.frames_duplicate = 0
+
+    @property
+    def frame(self):
+        return self._frame
+
+    @frame.setter
+    def frame(self, frame):
+        self.update(frame)
+
+    def update(self, frame, seq=None, timestamp=None):
+        """
+        Pass a new frame to be shown, optionally with its sequence number
+        (e.g., from VideoGet) so repeated frames can be recognized, and
+        the clock() time at which it was captured, from which end-to-end
+        latency is measured.
+        """
+
+        with self._cond:
+            if seq is not None and seq == self._seq:
+                self.frames_duplicate += 1
+                if self.metrics is not None:
+                    self.metrics.increment("display_duplicate")
+                if frame is not self._frame:
+                    self._release(frame)
+                return
+            previous = self._frame
+            self._frame = frame
+            self._seq = seq
+            self._timestamp = timestamp
+            self.version += 1
+            self._cond.notify()
+
+            # A frame being shown is released by the show thread when the
+            # sink is done with it.
+            if previous is not frame and previous is not self._showing:
+                self._release(previous)
+
+    def _release(self, frame):
+        if frame is not None and self.on_release is not None:
+            self.on_release(frame)
+
     def start(self):
         Thread(target=self.show, args=()).start()
         return self
 
     def show(self):
+        next_time = 0.0
         while not self.stopped:
-            cv2.imshow("Video", self.frame)
-            if cv2.waitKey(1) == ord("q"):
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self.stopped or self.version != self._shown_version,
+                    VideoShow.POLL_INTERVAL)
+                has_new = self.version != self._shown_version
+
+            if has_new and self.max_fps:
+                # Throttle to max_fps. Wait (rather than sleep) so that
+                # stop() takes effect immediately; frames arriving in the
+                # meantime replace the one that woke us.
+                with self._cond:
+                    self._cond.wait_for(lambda: self.stopped,
+                        max(0.0, next_time - clock()))
+
+            if self.stopped:
+                break
+
+            if has_new:
+                with self._cond:
+                    frame = self._frame
+                    timestamp = self._timestamp
+                    self._showing = frame
+                    skipped = self.version - self._shown_version - 1
+                    self._shown_version = self.version
+
+                start_time = clock()
+                self.sink.show(frame)
+                end_time = clock()
+                with self._cond:
+                    self._showing = None
+                    if frame is not self._frame:
+                        self._release(frame)
+                if self.max_fps:
+                    next_time = max(next_time, start_time) + 1.0 / self.max_fps
+                self.frames_displayed += 1
+                self.frames_skipped += skipped
+                if self.metrics is not None:
+                    self.metrics.latency("display").record(
+                        end_time - start_time)
+                    if timestamp is not None:
+                        self.metrics.latency("e2e").record(
+                            end_time - timestamp)
+                    self.metrics.rate("display").increment(now=end_time)
+                    if skipped:
+                        self.metrics.increment("display_skipped", skipped)
+
+            if not self.sink.poll():
                 self.stopped = True
 
     def stop(self):
-        self.stopped = True
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
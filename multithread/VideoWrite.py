@@ -0,0 +1,219 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+from threading import Condition, Thread
+import cv2
+from Metrics import clock
+
+class VideoWrite:
+    """
+    Class that encodes frames to disk with a dedicated thread, so that a
+    slow disk or encoder never holds up the thread producing the frames.
+
+    If path contains a format field (e.g., "frames/mask_{:06d}.png"),
+    each frame is written as a numbered image file, with images encoded
+    in parallel by a pool of worker threads. Otherwise, frames are
+    encoded into a single video file with cv2.VideoWriter using the
+    given FourCC code and frame rate; the frame size is taken from the
+    first frame.
+
+    Frames passed to write() are placed in a bounded queue of queue_size
+    frames. The policy determines what happens when it's full:
+        "drop": the new frame is discarded (and counted as dropped).
+        "block": write() waits until there is room in the queue.
+    The writer thread takes up to batch_size frames from the queue at a
+    time and encodes them as a batch. Frames are copied when queued
+    unless copy is False, in which case the caller must not modify a
+    frame after passing it to write().
+
+    If encoding raises an exception (e.g., cv2.imwrite() fails), the
+    writer thread stops: the exception is kept in error, frames still
+    queued or passed to write() afterward are dropped (so write() never
+    blocks on a dead writer), and stop() re-raises it.
+
+    VideoWrite can also be used as a display sink (see VideoShow.py),
+    e.g., combined with an ImshowSink in a TeeSink.
+
+    If a PipelineMetrics object is given, the write rate is recorded as
+    the "write" rate, the per-frame encode time as "write" latency, and
+    dropped frames with the "write_dropped" counter.
+    """
+
+    POLICIES = ("drop", "block")
+
+    def __init__(self, path, fps=30.0, fourcc="mp4v", queue_size=32,
+            policy="block", batch_size=8, workers=4, copy=True, metrics=None):
+        if policy not in VideoWrite.POLICIES:
+            raise ValueError("Invalid policy {!r}; expected one of {}".format(
+                policy, ", ".join(VideoWrite.POLICIES)))
+
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.queue_size = max(1, queue_size)
+        self.policy = policy
+        self.batch_size = max(1, batch_size)
+        self.copy = copy
+        self.metrics = metrics
+        self.image_sequence = "{" in path
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._writer = None
+        self._pool = None
+        if self.image_sequence:
+            self._pool = ThreadPoolExecutor(workers)
+        self._queue = deque()
+        self._cond = Condition()
+        self._thread = Thread(target=self.run, args=())
+
+        self.frames_queued = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.frames_failed = 0
+        self.batches = 0
+        self.encode_time = 0.0
+        self.stopped = False
+        self.error = None
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _openWriter(self, frame):
+        (height, width) = frame.shape[:2]
+        self._writer = cv2.VideoWriter(self.path,
+            cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (width, height),
+            frame.ndim == 3)
+        if not self._writer.isOpened():
+            raise RuntimeError("Error opening VideoWriter for {}".format(
+                self.path))
+
+    def write(self, frame):
+        """
+        Queue a frame to be written. Returns True if the frame was queued
+        or False if it was dropped (or the writer has been stopped).
+        """
+
+        if not self.image_sequence and self._writer is None:
+            self._openWriter(frame)
+
+        with self._cond:
+            if self.policy == "block":
+                self._cond.wait_for(lambda: self.stopped
+                    or len(self._queue) < self.queue_size)
+            if self.stopped:
+                if self.error is not None:
+                    self._countDropped()
+                return False
+            if len(self._queue) >= self.queue_size:
+                self._countDropped()
+                return False
+
+            self._queue.append(frame.copy() if self.copy else frame)
+            self.frames_queued += 1
+            self._cond.notify_all()
+            return True
+
+    def _countDropped(self, n=1):
+        if not n:
+            return
+        self.frames_dropped += n
+        if self.metrics is not None:
+            self.metrics.increment("write_dropped", n)
+
+    def show(self, frame):
+        """Display sink interface; equivalent to write()."""
+
+        self.write(frame)
+
+    def poll(self):
+        """Display sink interface; always True."""
+
+        return True
+
+    def run(self):
+        batch = []
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._queue or self.stopped)
+                    if not self._queue:
+                        break
+                    batch = [self._queue.popleft() for _ in
+                        range(min(self.batch_size, len(self._queue)))]
+                    self._cond.notify_all()
+                self._writeBatch(batch)
+        except Exception as e:
+            # Stop rather than die silently, which would leave write()
+            # waiting forever for room in the queue.
+            with self._cond:
+                self.error = e
+                self.frames_failed += len(batch)
+                self._countDropped(len(self._queue))
+                self._queue.clear()
+                self.stopped = True
+                self._cond.notify_all()
+        finally:
+            if self._writer is not None:
+                self._writer.release()
+            if self._pool is not None:
+                self._pool.shutdown()
+
+    def _writeBatch(self, batch):
+        """
+        Encode a batch of frames; in image sequence mode, the images are
+        encoded in parallel and the batch completes when all are written.
+        """
+
+        start_time = clock()
+        if self.image_sequence:
+            first_idx = self.frames_written + self.frames_failed
+            futures = [self._pool.submit(cv2.imwrite,
+                self.path.format(first_idx + i), frame)
+                for i, frame in enumerate(batch)]
+            written = sum(1 for future in futures if future.result())
+        else:
+            for frame in batch:
+                self._writer.write(frame)
+            written = len(batch)
+        end_time = clock()
+
+        self.frames_written += written
+        self.frames_failed += len(batch) - written
+        self.batches += 1
+        self.encode_time += end_time - start_time
+        if self.metrics is not None:
+            self.metrics.rate("write").increment(written, now=end_time)
+            per_frame = (end_time - start_time) / len(batch)
+            latency = self.metrics.latency("write")
+            for _ in batch:
+                latency.record(per_frame)
+
+    def encodeFps(self):
+        """Return frames encoded per second of encoding time."""
+
+        return (self.frames_written / self.encode_time
+            if self.encode_time > 0 else 0.0)
+
+    def stop(self, drain=True):
+        """
+        Stop the writer thread, first writing any frames still in the
+        queue unless drain is False, and close the output. Re-raises the
+        exception that stopped the writer thread, if any.
+        """
+
+        with self._cond:
+            if not drain:
+                self._countDropped(len(self._queue))
+                self._queue.clear()
+            self.stopped = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+        elif self._writer is not None:
+            self._writer.release()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,288 @@
+'''
+Name: benchmark.py
+Description: Headless benchmark of the threading modes in thread_demo.py.
+    Each mode is run in its own process against a video file or a
+    synthetic frame generator, with frames sent to a null display sink
+    (or optionally shown with cv2.imshow). Throughput, end-to-end latency
+    percentiles, CPU utilization, and peak RSS are reported as JSON and
+    can be compared against a stored baseline. For usage, run:
+    > python benchmark.py -h
+'''
+
+import argparse
+from collections import OrderedDict
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import sys
+import cv2
+from Metrics import PipelineMetrics, clock
+from SyntheticCapture import SyntheticCapture
+from VideoShow import ImshowSink, NullSink
+import thread_demo
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MODES = OrderedDict((
+    ("none", thread_demo.noThreading),
+    ("get", thread_demo.threadVideoGet),
+    ("show", thread_demo.threadVideoShow),
+    ("both", thread_demo.threadBoth),
+    ("process", thread_demo.threadProcess),
+    ))
+
+# Result fields compared against a baseline, and whether a higher value
+# is better (True) or worse (False).
+COMPARED_FIELDS = OrderedDict((
+    ("throughput_fps", True),
+    ("e2e_p50_ms", False),
+    ("e2e_p95_ms", False),
+    ("e2e_p99_ms", False),
+    ("cpu_percent", False),
+    ("peak_rss_mb", False),
+    ))
+
+def peakRssMb():
+    """
+    Return the peak resident set size of this process and of its largest
+    waited-for child process in MB (None if unavailable).
+    """
+
+    if resource is None:
+        return None, None
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    scale = 1.0 / (1024 * 1024) if sys.platform == "darwin" else 1.0 / 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return own, children
+
+def cpuSeconds():
+    """Return user + system CPU time of this process and its children."""
+
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def openSource(config):
+    """Create the frame source described by a benchmark config."""
+
+    if config["source"] is not None:
+        source = config["source"]
+        return int(source) if source.isdigit() and not os.path.isfile(
+            source) else source
+    return SyntheticCapture(config["width"], config["height"], config["fps"],
+        config["frames"])
+
+def runMode(mode, config, results):
+    """
+    Run a single threading mode and put its results in the results
+    queue. Intended to be run in a child process so that CPU time and
+    peak RSS are measured for that mode alone.
+    """
+
+    # Keep stdout for the JSON results; mode functions print summaries.
+    sys.stdout = sys.stderr
+
+    source = openSource(config)
+    sink = ImshowSink() if config["display"] else NullSink()
+    metrics = PipelineMetrics()
+
+    start_cpu = cpuSeconds()
+    start_time = clock()
+    MODES[mode](source, metrics=metrics, sink=sink)
+    wall_time = clock() - start_time
+    cpu_time = cpuSeconds() - start_cpu
+
+    snapshot = metrics.snapshot()
+    frames = metrics.rate("loop").total
+    e2e = snapshot["latency"].get("e2e", {})
+    own_rss, children_rss = peakRssMb()
+    results.put({
+        "mode": mode,
+        "frames": frames,
+        "wall_time_s": wall_time,
+        "throughput_fps": frames / wall_time if wall_time > 0 else 0.0,
+        "e2e_p50_ms": 1000 * e2e.get("p50", 0.0),
+        "e2e_p95_ms": 1000 * e2e.get("p95", 0.0),
+        "e2e_p99_ms": 1000 * e2e.get("p99", 0.0),
+        "cpu_percent": 100 * cpu_time / wall_time if wall_time > 0 else 0.0,
+        "peak_rss_mb": own_rss,
+        "peak_child_rss_mb": children_rss,
+        "counters": snapshot["counters"],
+        "latency": snapshot["latency"],
+        })
+
+def waitForResult(process, results, timeout):
+    """
+    Return the result put in the results queue by a mode's process, or
+    None if the process exits without one (e.g., it crashed or was killed
+    for running out of memory) or runs for more than timeout seconds, in
+    which case it is terminated.
+    """
+
+    deadline = clock() + timeout if timeout else None
+    while True:
+        try:
+            return results.get(timeout=1.0)
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            # The result may still be in transit from the exited process.
+            try:
+                return results.get(timeout=1.0)
+            except queue.Empty:
+                return None
+        if deadline is not None and clock() > deadline:
+            process.terminate()
+            return None
+
+def benchmark(modes, config, timeout=600):
+    """
+    Run each mode in a fresh process and return a dict mapping mode name
+    to its results. A mode whose process fails, or takes more than timeout
+    seconds, gets a result with "failed" set and its exit code.
+    """
+
+    ctx = multiprocessing.get_context("spawn")
+    all_results = OrderedDict()
+    for mode in modes:
+        results = ctx.Queue()
+        process = ctx.Process(target=runMode, args=(mode, config, results))
+        process.start()
+        result = waitForResult(process, results, timeout)
+        process.join()
+        if result is None:
+            result = {"mode": mode, "failed": True,
+                "exitcode": process.exitcode}
+            all_results[mode] = result
+            print("{}: failed (exit code {})".format(mode, process.exitcode),
+                file=sys.stderr)
+            continue
+        all_results[mode] = result
+        print("{}: {:.1f} fps, p95 latency {:.1f} ms, {:.0f}% CPU".format(
+            mode, result["throughput_fps"], result["e2e_p95_ms"],
+            result["cpu_percent"]), file=sys.stderr)
+    return all_results
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results against baseline results. A field regresses if it
+    is worse than the baseline by more than the fractional tolerance, and
+    a mode regresses if it failed but has a baseline. Returns a dict of
+    per-mode, per-field comparisons and whether any field regressed.
+    """
+
+    comparison = OrderedDict()
+    regressed = False
+    for mode, result in results.items():
+        if mode not in baseline:
+            continue
+        comparison[mode] = OrderedDict()
+        if result.get("failed"):
+            comparison[mode]["failed"] = {"regression": True}
+            regressed = True
+            continue
+        for field, higher_is_better in COMPARED_FIELDS.items():
+            current = result.get(field)
+            reference = baseline[mode].get(field)
+            if current is None or not reference:
+                continue
+            change = current / reference - 1
+            worse = -change if higher_is_better else change
+            comparison[mode][field] = {
+                "baseline": reference,
+                "current": current,
+                "change": change,
+                "regression": worse > tolerance,
+                }
+            regressed = regressed or worse > tolerance
+    return comparison, regressed
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--source", "-s", default=None,
+        help="Path to video file or camera index (default: synthetic frames)")
+    ap.add_argument("--resolution", "-r", default="1280x720",
+        help="Synthetic frame resolution as WIDTHxHEIGHT (default 1280x720)")
+    ap.add_argument("--fps", type=float, default=0,
+        help="Synthetic frame rate; 0 generates frames as fast as they are"
+            + " read (default 0)")
+    ap.add_argument("--frames", "-n", type=int, default=300,
+        help="Number of synthetic frames per mode (default 300)")
+    ap.add_argument("--modes", "-m", default="none,get,show,both",
+        help="Comma-separated threading modes to run, from: "
+            + ", ".join(MODES) + " (default none,get,show,both)")
+    ap.add_argument("--display", action="store_true",
+        help="Show frames with cv2.imshow instead of a null sink")
+    ap.add_argument("--output", "-o", default=None,
+        help="Write JSON results to this file instead of stdout")
+    ap.add_argument("--baseline", "-b", default=None,
+        help="Compare results against this baseline JSON file; exit with"
+            + " status 1 on regression")
+    ap.add_argument("--save-baseline", default=None,
+        help="Save results to this file as a new baseline")
+    ap.add_argument("--timeout", type=float, default=600,
+        help="Seconds after which a mode is stopped and reported as failed"
+            + " (default 600; 0 for no limit)")
+    ap.add_argument("--tolerance", type=float, default=0.1,
+        help="Fractional change beyond which a result is a regression"
+            + " (default 0.1)")
+    args = vars(ap.parse_args())
+
+    modes = [m.strip() for m in args["modes"].split(",") if m.strip()]
+    for mode in modes:
+        if mode not in MODES:
+            ap.error("Unknown mode {!r}".format(mode))
+
+    width, height = (int(v) for v in args["resolution"].lower().split("x"))
+    config = {
+        "source": args["source"],
+        "width": width,
+        "height": height,
+        "fps": args["fps"],
+        "frames": args["frames"],
+        "display": args["display"],
+        }
+
+    results = benchmark(modes, config, args["timeout"])
+    report = OrderedDict((
+        ("config", config),
+        ("platform", {
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            }),
+        ("results", results),
+        ))
+
+    regressed = False
+    if args["baseline"] is not None:
+        with open(args["baseline"]) as f:
+            baseline = json.load(f)
+        report["comparison"], regressed = compare(results,
+            baseline["results"], args["tolerance"])
+
+    if args["save_baseline"] is not None:
+        with open(args["save_baseline"], "w") as f:
+            json.dump(report, f, indent=2)
+
+    output = json.dumps(report, indent=2)
+    if args["output"] is not None:
+        with open(args["output"], "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if regressed:
+        print("Regression against baseline beyond tolerance {:.0%}".format(
+            args["tolerance"]), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,75 +1,151 @@
 import argparse
 import os
+from threading import Thread
 import cv2
-from CountsPerSec import CountsPerSec
-from VideoGet import VideoGet
-from VideoShow import VideoShow
+from FrameSource import FrameSource
+from Metrics import MetricsExporter, PipelineMetrics, clock
+from VideoGet import VideoGet, openCapture
+from VideoProcess import VideoProcess
+from VideoShow import ImshowSink, TeeSink, VideoShow
+from VideoWrite import VideoWrite
 
-def putIterationsPerSec(frame, iterations_per_sec):
+def putIterationsPerSec(frame, metrics):
     """
-    Add iterations per second text to lower-left corner of a frame.
+    Add iterations per second text (the "loop" rate of a PipelineMetrics
+    object) to lower-left corner of a frame, along with 95th percentile
+    end-to-end ("e2e") latency if any has been recorded.
     """
 
-    cv2.putText(frame, "{:.0f} iterations/sec".format(iterations_per_sec),
+    text = "{:.0f} iterations/sec".format(metrics.rate("loop").rate())
+    e2e = metrics.latencies.get("e2e")
+    if e2e is not None and e2e.count:
+        text += ", p95 latency {:.0f} ms".format(1000 * e2e.percentile(95))
+    cv2.putText(frame, text,
         (10, 450), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255))
     return frame
 
-def noThreading(source=0):
+def printMetrics(metrics):
+    """Print per-stage rates, latency percentiles, and counters."""
+
+    snapshot = metrics.snapshot()
+    for name, rate in sorted(snapshot["rates"].items()):
+        print("{} rate: {:.1f}/sec".format(name, rate))
+    for name, latency in sorted(snapshot["latency"].items()):
+        print("{} latency: p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms".format(
+            name, 1000 * latency["p50"], 1000 * latency["p95"],
+            1000 * latency["p99"]))
+    for name, count in sorted(snapshot["counters"].items()):
+        print("{}: {}".format(name, count))
+
+def printDropped(video_getter):
+    """
+    Print the number of frames captured and dropped by a VideoGet, and
+    buffer pool statistics if it has a pool.
+    """
+
+    print("{} frames captured, {} dropped ({} policy)".format(
+        video_getter.frames_captured, video_getter.frames_dropped,
+        video_getter.policy))
+    if video_getter.pool is not None:
+        print("Buffer pool: {}".format(video_getter.pool.stats()))
+
+def printDisplayed(video_shower):
+    """Print the number of frames displayed, skipped, and duplicated."""
+
+    print("{} frames displayed, {} skipped, {} duplicate".format(
+        video_shower.frames_displayed, video_shower.frames_skipped,
+        video_shower.frames_duplicate))
+
+def noThreading(source=0, metrics=None, sink=None):
     """Grab and show video frames without multithreading."""
 
-    cap = cv2.VideoCapture(source)
-    cps = CountsPerSec().start()
+    cap = openCapture(source)
+    sink = sink or ImshowSink()
+    metrics = metrics or PipelineMetrics()
+    loop = metrics.rate("loop")
 
+    # Decode each frame into the previous frame's array (allocated by
+    # the first read) rather than allocating a new array per frame.
+    frame = None
     while True:
-        grabbed, frame = cap.read()
-        if not grabbed or cv2.waitKey(1) == ord("q"):
+        start_time = clock()
+        grabbed, frame = cap.read(frame)
+        if not grabbed or not sink.poll():
             break
+        capture_time = clock()
+        metrics.latency("capture").record(capture_time - start_time)
 
-        frame = putIterationsPerSec(frame, cps.countsPerSec())
-        cv2.imshow("Video", frame)
-        cps.increment()
+        frame = putIterationsPerSec(frame, metrics)
+        sink.show(frame)
+        metrics.latency("e2e").record(clock() - capture_time)
+        loop.increment()
 
-def threadVideoGet(source=0):
+def threadVideoGet(source=0, policy="latest", queue_size=1, pool_size=0,
+        metrics=None, sink=None):
     """
     Dedicated thread for grabbing video frames with VideoGet object.
     Main thread shows video frames.
     """
 
-    video_getter = VideoGet(source).start()
-    cps = CountsPerSec().start()
+    sink = sink or ImshowSink()
+    metrics = metrics or PipelineMetrics()
+    loop = metrics.rate("loop")
+    video_getter = VideoGet(source, queue_size, policy, pool_size,
+        metrics).start()
 
     while True:
-        if (cv2.waitKey(1) == ord("q")) or video_getter.stopped:
+        if not sink.poll():
             video_getter.stop()
             break
 
-        frame = video_getter.frame
-        frame = putIterationsPerSec(frame, cps.countsPerSec())
-        cv2.imshow("Video", frame)
-        cps.increment()
+        # Wait briefly for a new frame rather than redisplaying the last
+        # one; the timeout keeps the HighGUI event loop responsive. Once
+        # VideoGet has stopped, show what's left in its buffer, until
+        # read() returns None.
+        stopped = video_getter.stopped
+        item = video_getter.read(timeout=0 if stopped else 0.01)
+        if item is None:
+            if stopped:
+                break
+            continue
+
+        frame = putIterationsPerSec(item.image, metrics)
+        sink.show(frame)
+        metrics.latency("e2e").record(clock() - item.timestamp)
+        video_getter.release(item)
+        loop.increment()
 
-def threadVideoShow(source=0):
+    printDropped(video_getter)
+
+def threadVideoShow(source=0, metrics=None, sink=None, max_display_fps=0):
     """
     Dedicated thread for showing video frames with VideoShow object.
     Main thread grabs video frames.
     """
 
-    cap = cv2.VideoCapture(source)
+    metrics = metrics or PipelineMetrics()
+    loop = metrics.rate("loop")
+    cap = openCapture(source)
     (grabbed, frame) = cap.read()
-    video_shower = VideoShow(frame).start()
-    cps = CountsPerSec().start()
+    video_shower = VideoShow(frame, metrics, sink, max_display_fps).start()
 
     while True:
+        start_time = clock()
         (grabbed, frame) = cap.read()
         if not grabbed or video_shower.stopped:
             video_shower.stop()
             break
+        capture_time = clock()
+        metrics.latency("capture").record(capture_time - start_time)
+
+        frame = putIterationsPerSec(frame, metrics)
+        video_shower.update(frame, timestamp=capture_time)
+        loop.increment()
 
-        frame = putIterationsPerSec(frame, cps.countsPerSec())
-        video_shower.frame = frame
-        cps.increment()
+    printDisplayed(video_shower)
 
-def threadBoth(source=0):
+def threadBoth(source=0, policy="latest", queue_size=1, pool_size=0,
+        metrics=None, sink=None, max_display_fps=0):
     """
     Dedicated thread for grabbing video frames with VideoGet object.
     Dedicated thread for showing video frames with VideoShow object.
@@ -77,31 +153,158 @@ def threadBoth(source=0):
     VideoShow objects/threads.
     """
 
-    video_getter = VideoGet(source).start()
-    video_shower = VideoShow(video_getter.frame).start()
-    cps = CountsPerSec().start()
+    metrics = metrics or PipelineMetrics()
+    loop = metrics.rate("loop")
+    video_getter = VideoGet(source, queue_size, policy, pool_size,
+        metrics).start()
+    video_shower = VideoShow(video_getter.frame, metrics, sink,
+        max_display_fps, on_release=video_getter.release).start()
 
     while True:
-        if video_getter.stopped or video_shower.stopped:
-            video_shower.stop()
+        if video_shower.stopped:
             video_getter.stop()
             break
 
-        frame = video_getter.frame
-        frame = putIterationsPerSec(frame, cps.countsPerSec())
-        video_shower.frame = frame
-        cps.increment()
+        stopped = video_getter.stopped
+        item = video_getter.read(timeout=0 if stopped else 0.1)
+        if item is None:
+            if stopped:
+                video_shower.stop()
+                break
+            continue
+
+        frame = putIterationsPerSec(item.image, metrics)
+        video_shower.update(frame, item.seq, item.timestamp)
+        loop.increment()
+
+    printDropped(video_getter)
+    printDisplayed(video_shower)
+
+def processFrame(frame, out):
+    """
+    Example CPU-bound per-frame operation for the VideoProcess workers:
+    an edge-preserving bilateral filter written into out.
+    """
+
+    cv2.bilateralFilter(frame, 9, 75, 75, dst=out)
+
+def threadProcess(source=0, workers=None, ordered=True, metrics=None,
+        sink=None, max_display_fps=0):
+    """
+    Dedicated thread for grabbing video frames with VideoGet object.
+    Worker processes apply processFrame() to each frame via a
+    VideoProcess object; a feeder thread passes frames from VideoGet to
+    VideoProcess. Dedicated thread for showing video frames with
+    VideoShow object. Main thread passes processed frames from
+    VideoProcess to VideoShow.
+    """
+
+    metrics = metrics or PipelineMetrics()
+    loop = metrics.rate("loop")
+    video_getter = VideoGet(source, queue_size=2, policy="drop_oldest",
+        metrics=metrics)
+    video_processor = VideoProcess(processFrame, video_getter.frame.shape,
+        workers=workers, ordered=ordered, metrics=metrics).start()
+    video_getter.start()
+    video_shower = VideoShow(video_getter.frame, metrics, sink,
+        max_display_fps).start()
+
+    def feed():
+        # Once VideoGet has stopped, read() returns None only when its
+        # buffer is empty, so frames still buffered are passed on too.
+        while not video_processor.stopped:
+            stopped = video_getter.stopped
+            item = video_getter.read(timeout=0.1)
+            if item is not None:
+                video_processor.submit(item.image, item.timestamp)
+            elif stopped:
+                break
+
+    feeder = Thread(target=feed, args=())
+    feeder.start()
+
+    # read() and pending() raise if a worker process dies; stop the other
+    # threads before passing the error on.
+    try:
+        while True:
+            if video_shower.stopped or (
+                    not feeder.is_alive() and not video_processor.pending()):
+                break
+
+            item = video_processor.read(timeout=0.1)
+            if item is None:
+                continue
+
+            frame = putIterationsPerSec(item.image, metrics)
+            video_shower.update(frame, item.seq, item.timestamp)
+            loop.increment()
+    finally:
+        video_shower.stop()
+        video_getter.stop()
+        video_processor.stop()
+        feeder.join()
+    printDropped(video_getter)
+    printDisplayed(video_shower)
+    print("{} frames processed by {} workers, {} dropped, {} failed".format(
+        video_processor.frames_processed, video_processor.workers,
+        video_processor.frames_dropped, video_processor.frames_failed))
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--source", "-s", default=0,
         help="Path to video file or integer representing webcam index"
             + " (default 0).")
+    ap.add_argument("--step", type=int, default=1,
+        help="Use every STEP-th frame of the source; skipped frames are"
+            + " grabbed but not decoded (default 1)")
+    ap.add_argument("--width", type=int, default=0,
+        help="Resize frames to this width, maintaining aspect ratio"
+            + " (default 0, no resizing)")
     ap.add_argument("--thread", "-t", default="none",
         help="Threading mode: get (video read in its own thread),"
             + " show (video show in its own thread), both"
             + " (video read and video show in their own threads),"
+            + " process (video read and show in their own threads and"
+            + " frames filtered by a pool of worker processes),"
             + " none (default--no multithreading)")
+    ap.add_argument("--policy", "-p", default="latest",
+        choices=VideoGet.POLICIES,
+        help="VideoGet frame buffer policy when the buffer is full"
+            + " (default latest)")
+    ap.add_argument("--queue-size", "-q", type=int, default=1,
+        help="VideoGet frame buffer size for the drop_oldest and block"
+            + " policies (default 1)")
+    ap.add_argument("--pool-size", type=int, default=0,
+        help="Number of preallocated VideoGet frame buffers to decode into;"
+            + " must exceed the queue size (default 0, no pool)")
+    ap.add_argument("--workers", "-w", type=int, default=None,
+        help="Number of worker processes for the process threading mode"
+            + " (default: number of CPUs)")
+    ap.add_argument("--latest", action="store_true",
+        help="In process mode, show only the most recent result instead of"
+            + " every result in frame order")
+    ap.add_argument("--metrics-file", "-m", default=None,
+        help="Periodically export pipeline metrics to this file")
+    ap.add_argument("--metrics-format", default="jsonl",
+        choices=MetricsExporter.FORMATS,
+        help="Metrics export format: jsonl (append a JSON snapshot per"
+            + " line, default) or prometheus (text exposition format)")
+    ap.add_argument("--metrics-interval", type=float, default=1.0,
+        help="Seconds between metrics exports (default 1)")
+    ap.add_argument("--max-display-fps", type=float, default=0,
+        help="Maximum frame rate at which VideoShow displays frames in the"
+            + " show, both, and process threading modes (default 0,"
+            + " unlimited)")
+    ap.add_argument("--output", "-o", default=None,
+        help="Also write displayed frames to this video file, or to numbered"
+            + " image files if the path contains a format field, e.g.,"
+            + " frames/{:06d}.jpg")
+    ap.add_argument("--output-fps", type=float, default=30.0,
+        help="Frame rate of the output video file (default 30)")
+    ap.add_argument("--output-policy", default="drop",
+        choices=VideoWrite.POLICIES,
+        help="What to do when the output queue is full: drop the frame"
+            + " (default) or block until there is room")
     args = vars(ap.parse_args())
 
     # If source is a string consisting only of integers, check that it doesn't
@@ -114,14 +317,49 @@ def main():
     ):
         args["source"] = int(args["source"])
 
+    if args["step"] > 1 or args["width"]:
+        args["source"] = FrameSource(args["source"], step=args["step"],
+            width=args["width"])
+
+    metrics = PipelineMetrics()
+    sink = ImshowSink()
+    video_writer = None
+    if args["output"] is not None:
+        video_writer = VideoWrite(args["output"], args["output_fps"],
+            policy=args["output_policy"], metrics=metrics).start()
+        sink = TeeSink(sink, video_writer)
+
+    exporter = None
+    if args["metrics_file"] is not None:
+        exporter = MetricsExporter(metrics, args["metrics_file"],
+            args["metrics_interval"], args["metrics_format"]).start()
+
     if args["thread"] == "both":
-        threadBoth(args["source"])
+        threadBoth(args["source"], args["policy"], args["queue_size"],
+            args["pool_size"], metrics, sink, args["max_display_fps"])
     elif args["thread"] == "get":
-        threadVideoGet(args["source"])
+        threadVideoGet(args["source"], args["policy"], args["queue_size"],
+            args["pool_size"], metrics, sink)
+    elif args["thread"] == "process":
+        threadProcess(args["source"], args["workers"], not args["latest"],
+            metrics, sink, args["max_display_fps"])
     elif args["thread"] == "show":
-        threadVideoShow(args["source"])
+        threadVideoShow(args["source"], metrics, sink, args["max_display_fps"])
     else:
-        noThreading(args["source"])
+        noThreading(args["source"], metrics, sink)
+
+    if video_writer is not None:
+        try:
+            video_writer.stop()
+        except Exception as e:
+            print("Error writing {}: {}".format(args["output"], e))
+        print("{} frames written, {} dropped, {:.1f} frames/sec encoded".format(
+            video_writer.frames_written, video_writer.frames_dropped,
+            video_writer.encodeFps()))
+
+    if exporter is not None:
+        exporter.stop()
+    printMetrics(metrics)
 
 if __name__ == "__main__":
     main()
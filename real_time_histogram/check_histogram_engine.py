@@ -0,0 +1,59 @@
+"""
+Check that HistogramEngine's joint histogram and each per-channel
+histogram sum to 1, for 2- and 3-channel joint histograms, with and
+without subsampling. Exits with status 1 on any failure. For usage, type:
+    > python check_histogram_engine.py -h
+"""
+
+import argparse
+import sys
+import numpy as np
+from histogram_engine import HistogramEngine
+
+# (joint channels, engine options) for each configuration checked.
+CONFIGS = (
+    ((1, 2), {}),
+    ((0, 1, 2), {}),
+    ((1, 2), {"stride": 4}),
+    ((0, 1, 2), {"stride": 4}),
+    ((0, 1, 2), {"maxError": 0.05}),
+    )
+
+def checkEngine(img, bins=8, tol=1e-4):
+    """
+    Compute the histograms of img with each configuration in CONFIGS and
+    return a list of (joint channels, options, joint sum, hist row sums)
+    for the configurations whose sums are not all within tol of 1.
+    """
+
+    failures = []
+    for joint, options in CONFIGS:
+        engine = HistogramEngine(bins, (0, 1, 2), joint=joint, seed=0,
+            **options)
+        hist = engine.compute(img)
+        jointSum = float(engine.joint.sum())
+        rowSums = hist.sum(axis=1).tolist()
+        if not np.allclose([jointSum] + rowSums, 1, atol=tol):
+            failures.append((joint, options, jointSum, rowSums))
+    return failures
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-s", "--size", type=int, nargs=2, default=(480, 640),
+        metavar=("HEIGHT", "WIDTH"), help="Size of the random test image")
+    ap.add_argument("-b", "--bins", type=int, default=8,
+        help="Bins per channel")
+    args = vars(ap.parse_args())
+
+    img = np.random.default_rng(0).integers(0, 256,
+        tuple(args["size"]) + (3,), dtype=np.uint8)
+    failures = checkEngine(img, args["bins"])
+    for joint, options, jointSum, rowSums in failures:
+        print("joint={} {}: joint sums to {}, hist rows to {}".format(
+            joint, options, jointSum, rowSums))
+    if failures:
+        sys.exit(1)
+    print("All histograms sum to 1")
+
+if __name__ == "__main__":
+    main()
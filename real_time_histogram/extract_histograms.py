@@ -0,0 +1,250 @@
+'''
+Name: extract_histograms.py
+Description: Offline counterpart of real_time_histogram.py. Computes the
+    histograms of every frame (or every STEP-th frame) of a video file
+    without any GUI, splitting the video into ranges of frames that are
+    processed concurrently by a pool of worker processes, each seeking to
+    its own range. Histograms are written to a memory-mapped .npy array of
+    shape (frames, channels, bins), with the timestamp of each frame in a
+    second .npy array. An interrupted run is resumed by running the same
+    command again. For usage, type:
+    > python extract_histograms.py -h
+'''
+
+import argparse
+import json
+from multiprocessing import Pool
+import os
+import sys
+import time
+import numpy as np
+import cv2
+from histogram_engine import HistogramEngine
+from live_histogram import CHANNELS
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'multithread'))
+from FrameSource import FrameSource
+from Metrics import RateMeter
+
+def outputPaths(output):
+    '''
+    Return the paths of the files making up an extraction to output (a .npy
+    path): histograms, timestamps, metadata, and completed ranges.
+    '''
+    stem = output[:-4] if output.endswith('.npy') else output
+    return {
+        'histograms': stem + '.npy',
+        'timestamps': stem + '_timestamps.npy',
+        'metadata': stem + '.json',
+        'progress': stem + '.done',
+        }
+
+def frameRanges(totalFrames, step, segmentFrames):
+    '''
+    Split frames [0, totalFrames) into ranges (start, end) of about
+    segmentFrames frames each, starting at multiples of step so that every
+    range processes the same frames as a single pass would.
+    '''
+    size = max(1, -(-segmentFrames // step)) * step
+    return [(start, min(totalFrames, start + size))
+        for start in range(0, totalFrames, size)]
+
+def _convert(frame, color, converted):
+    '''Return the image to compute the histograms of a frame from.'''
+    if color == 'gray':
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=converted)
+    if color == 'lab':
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2LAB, dst=converted)
+    return frame
+
+def processRange(task):
+    '''
+    Compute the histograms of the frames in one range of the video in a
+    worker process and write them (and their timestamps) into the
+    memory-mapped outputs. Returns (start, end, frames, error).
+    '''
+    (start, end, paths, params) = task
+    capture = None
+    frames = 0
+    try:
+        histograms = np.load(paths['histograms'], mmap_mode='r+')
+        timestamps = np.load(paths['timestamps'], mmap_mode='r+')
+        engine = HistogramEngine(params['bins'], CHANNELS[params['color']],
+            stride=params['stride'], maxError=params['max_error'])
+        capture = FrameSource(params['video'], step=params['step'],
+            width=params['width'], start_frame=start, end_frame=end)
+        if not capture.isOpened():
+            return start, end, frames, 'Error opening video'
+
+        frame = converted = None
+        while True:
+            (grabbed, frame) = capture.read(frame)
+            if not grabbed:
+                break
+            converted = _convert(frame, params['color'], converted)
+            row = capture.frame_idx // params['step']
+            histograms[row] = engine.compute(converted)
+            if capture.timestamp is not None:
+                timestamps[row] = capture.timestamp
+            frames += 1
+        histograms.flush()
+        timestamps.flush()
+    except Exception as e:
+        return start, end, frames, '{}: {}'.format(type(e).__name__, e)
+    finally:
+        if capture is not None:
+            capture.release()
+    return start, end, frames, None
+
+def _initWorker():
+    # Each worker processes one frame at a time; let the pool provide the
+    # parallelism rather than OpenCV's internal threads.
+    cv2.setNumThreads(1)
+
+def extractHistograms(video, output, color='rgb', bins=16, step=1, width=0,
+        stride=1, max_error=None, workers=None, segment_frames=1000,
+        report_interval=5.0):
+    '''
+    Compute the histograms of every step-th frame of a video file into
+    memory-mapped .npy files (see outputPaths()): a (rows, channels, bins)
+    float32 array of normalized histograms, where row i is frame i * step,
+    and a (rows,) float64 array of frame timestamps in seconds. Rows of
+    frames that couldn't be read stay NaN.
+
+    The video is split into ranges of segment_frames frames processed by a
+    pool of workers. Completed ranges are recorded, and if the outputs
+    already exist (from an interrupted run with the same parameters), only
+    the remaining ranges are processed.
+
+    Returns a dict with the number of frames processed, ranges skipped as
+    already done, rows missing, failed ranges, and the elapsed time.
+    '''
+    if color not in CHANNELS:
+        raise ValueError('Invalid color {!r}; expected one of {}'.format(
+            color, ', '.join(CHANNELS)))
+    capture = FrameSource(video)
+    if not capture.isOpened():
+        raise RuntimeError('Error opening video {}'.format(video))
+    totalFrames = capture.frameCount()
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    if not totalFrames:
+        raise RuntimeError('Frame count of {} is unknown; it can\'t be split'
+            ' into ranges'.format(video))
+
+    params = {
+        'video': os.path.abspath(video),
+        'color': color,
+        'bins': bins,
+        'step': max(1, step),
+        'width': width,
+        'stride': stride,
+        'max_error': max_error,
+        'frames': totalFrames,
+        }
+    rows = -(-totalFrames // params['step'])
+    shape = (rows, len(CHANNELS[color]), bins)
+    paths = outputPaths(output)
+
+    done = set()
+    if os.path.isfile(paths['metadata']):
+        with open(paths['metadata']) as f:
+            metadata = json.load(f)
+        if metadata['params'] != params:
+            raise RuntimeError('{} was extracted with different parameters;'
+                ' remove it or choose another output'.format(
+                    paths['histograms']))
+        if os.path.isfile(paths['progress']):
+            with open(paths['progress']) as f:
+                done = set(line.strip() for line in f if line.strip())
+    else:
+        directory = os.path.dirname(paths['histograms'])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        for key, dtype, arrayShape in (('histograms', np.float32, shape),
+                ('timestamps', np.float64, shape[:1])):
+            array = np.lib.format.open_memmap(paths[key], mode='w+',
+                dtype=dtype, shape=arrayShape)
+            array[:] = np.nan
+            array.flush()
+            del array
+        if os.path.isfile(paths['progress']):
+            os.remove(paths['progress'])
+        with open(paths['metadata'], 'w') as f:
+            json.dump({'params': params, 'shape': shape, 'fps': fps,
+                'channels': CHANNELS[color]}, f, indent=2)
+
+    # Ranges done by a run with a different segment_frames don't match the
+    # current ranges, so they are redone rather than counted as skipped.
+    ranges = frameRanges(totalFrames, params['step'], segment_frames)
+    tasks = [(start, end, paths, params) for (start, end) in ranges
+        if '{}-{}'.format(start, end) not in done]
+    result = {'frames': 0, 'skipped': len(ranges) - len(tasks), 'failed': []}
+    rate = RateMeter()
+    startTime = time.perf_counter()
+    nextReport = startTime + report_interval
+
+    with Pool(workers, initializer=_initWorker) as pool, open(
+            paths['progress'], 'a') as progress:
+        for i, (start, end, frames, error) in enumerate(pool.imap_unordered(
+                processRange, tasks), 1):
+            result['frames'] += frames
+            rate.increment(frames)
+            if error is not None:
+                result['failed'].append(('{}-{}'.format(start, end), error))
+                print('Frames {}-{}: {}'.format(start, end, error),
+                    file=sys.stderr)
+            else:
+                progress.write('{}-{}\n'.format(start, end))
+                progress.flush()
+
+            now = time.perf_counter()
+            if now >= nextReport:
+                nextReport = now + report_interval
+                print('{}/{} ranges, {} frames, {:.1f} frames/sec'.format(i,
+                    len(tasks), result['frames'], rate.rate()))
+
+    histograms = np.load(paths['histograms'], mmap_mode='r')
+    result['missing'] = int(np.isnan(histograms[:, 0, 0]).sum())
+    result['elapsed'] = time.perf_counter() - startTime
+    return result
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('video', help='Path to video file')
+    ap.add_argument('-o', '--output', required=True,
+        help='Output .npy file of per-frame histograms; timestamps are'
+            + ' written to OUTPUT_timestamps.npy and parameters to'
+            + ' OUTPUT.json')
+    ap.add_argument('-c', '--color', type=str, default='rgb',
+        help='Color space: "gray", "rgb" (default), or "lab"')
+    ap.add_argument('-b', '--bins', type=int, default=16,
+        help='Number of bins per channel (default 16)')
+    ap.add_argument('-s', '--step', type=int, default=1,
+        help='Process every STEP-th frame; others are skipped without decoding')
+    ap.add_argument('-w', '--width', type=int, default=0,
+        help='Resize frames to specified width in pixels (maintains aspect)')
+    ap.add_argument('--stride', type=int, default=1,
+        help='Compute histograms from every STRIDE-th pixel of every'
+            + ' STRIDE-th row (default 1, all pixels)')
+    ap.add_argument('--max-error', type=float,
+        help='Compute histograms from a random sample of pixels with at'
+            + ' most this error per bin (99%% confidence)')
+    ap.add_argument('-j', '--workers', type=int, default=None,
+        help='Number of worker processes (default: number of CPUs)')
+    ap.add_argument('--segment-frames', type=int, default=1000,
+        help='Frames per range processed by a worker (default 1000)')
+    args = vars(ap.parse_args())
+
+    result = extractHistograms(args['video'], args['output'], args['color'],
+        args['bins'], args['step'], args['width'], args['stride'],
+        args['max_error'], args['workers'], args['segment_frames'])
+    print('{} frames ({} ranges already done), {} failed ranges, {} rows'
+        ' missing in {:.1f} s ({:.1f} frames/sec)'.format(result['frames'],
+            result['skipped'], len(result['failed']), result['missing'],
+            result['elapsed'],
+            result['frames'] / max(result['elapsed'], 1e-9)))
+
+if __name__ == '__main__':
+    main()
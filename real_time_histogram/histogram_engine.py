@@ -0,0 +1,164 @@
+'''
+Name: histogram_engine.py
+Description: Computes the normalized histograms of several channels of a
+    frame (and optionally their joint histogram) into preallocated arrays,
+    either from every pixel or from a subsample: every STRIDE-th pixel in
+    each direction, or a random sample just large enough that, with a given
+    confidence, no bin is off by more than a given error.
+'''
+
+import math
+import numpy as np
+import cv2
+
+def sampleSize(maxError, confidence, numBins):
+    '''
+    Return the number of pixels, drawn uniformly at random with replacement,
+    needed for every one of numBins histogram bins (over all channels) to
+    be within maxError of its exact value (as a fraction of pixels) with
+    probability confidence. By Hoeffding's inequality, each bin is off by
+    more than maxError with probability at most 2 exp(-2 n maxError^2), so
+    by the union bound n = ln(2 numBins / (1 - confidence)) / (2 maxError^2)
+    suffices.
+    '''
+    if not 0 < maxError < 1:
+        raise ValueError('maxError must be in (0, 1)')
+    if not 0 < confidence < 1:
+        raise ValueError('confidence must be in (0, 1)')
+    return int(math.ceil(math.log(2 * numBins / (1 - confidence))
+        / (2 * maxError ** 2)))
+
+class HistogramEngine:
+    '''
+    Class that computes the histogram of each of the given channels of an
+    8-bit image, normalized to fractions of pixels, as a (channels x bins)
+    float32 array. The array (hist) is allocated once and overwritten by
+    each call to compute(), and cv2.calcHist() writes each channel's
+    histogram into its row directly from the interleaved image, so no
+    channel is split out or copied and nothing is allocated per frame.
+
+    joint: channel indices (a subset of channels, e.g. (1, 2) for the
+        chromaticity of Lab) whose joint histogram, with jointBins bins per
+        channel, is also computed into joint. It takes a single pass over
+        the pixels, and the histograms of these channels are then its
+        marginals (if jointBins == bins) instead of separate passes.
+    stride: if > 1, only every stride-th pixel of every stride-th row is
+        counted. The pixels are gathered with a nearest-neighbor resize
+        into a reused buffer, reading about 1/stride^2 of the frame. This
+        is fast but its error depends on the image (e.g., fine periodic
+        patterns can alias).
+    maxError: if given, a fresh random sample of sampleSize(maxError,
+        confidence, total bins) pixels is drawn from each frame (or every
+        pixel is used, if the frame has fewer), so that with probability
+        confidence no bin of hist or joint is off by more than maxError.
+        The indices of the sample are drawn into reused buffers. The sample
+        size depends only on the number of bins, not on the frame size, so
+        the cost of the histogram stays constant on large (e.g., 4K)
+        frames.
+    '''
+    def __init__(self, bins=16, channels=(0, 1, 2), joint=None,
+            jointBins=None, stride=1, maxError=None, confidence=0.99,
+            seed=None):
+        if stride > 1 and maxError is not None:
+            raise ValueError('stride and maxError are mutually exclusive')
+        self.bins = bins
+        self.channels = list(channels)
+        self.jointChannels = list(joint) if joint else []
+        self.jointBins = jointBins or bins
+        self.stride = max(1, int(stride))
+        self.maxError = maxError
+        self.confidence = confidence
+
+        self.hist = np.zeros((len(self.channels), bins), dtype=np.float32)
+        self.joint = None
+        if self.jointChannels:
+            if not set(self.jointChannels) <= set(self.channels):
+                raise ValueError('joint channels must be among channels')
+            self.joint = np.zeros((self.jointBins,) * len(self.jointChannels),
+                dtype=np.float32)
+
+        self.sampleSize = None
+        if maxError is not None:
+            numBins = len(self.channels) * bins
+            if self.joint is not None:
+                numBins += self.joint.size
+            self.sampleSize = sampleSize(maxError, confidence, numBins)
+        self.rng = np.random.default_rng(seed)
+        self._uniform = None
+        self._indices = None
+        self._sample = None
+        self._decimated = None
+        self.pixels = 0
+
+    def _source(self, img):
+        '''
+        Return the pixels to count: the image itself, a decimated copy, or
+        a random sample (as an Nx1xC image).
+        '''
+        (height, width) = img.shape[:2]
+        if self.stride > 1:
+            size = (max(1, width // self.stride), max(1, height // self.stride))
+            shape = (size[1], size[0]) + img.shape[2:]
+            if self._decimated is not None and self._decimated.shape != shape:
+                self._decimated = None
+            self._decimated = cv2.resize(img, size, dst=self._decimated,
+                interpolation=cv2.INTER_NEAREST)
+            return self._decimated
+
+        if self.sampleSize is not None and self.sampleSize < height * width:
+            flat = img.reshape(height * width, -1)
+            if self._sample is None or self._sample.shape[1] != flat.shape[1]:
+                self._uniform = np.empty(self.sampleSize, dtype=np.float64)
+                self._indices = np.empty(self.sampleSize, dtype=np.int64)
+                self._sample = np.empty((self.sampleSize, flat.shape[1]),
+                    dtype=img.dtype)
+
+            # Scale uniform [0, 1) draws to pixel indices in place, since
+            # rng.integers() can't write into an existing array. Rounding
+            # can give height * width for draws just below 1, which
+            # mode='clip' maps to the last pixel; it also keeps np.take()
+            # from buffering its output, as it does with mode='raise'.
+            self.rng.random(out=self._uniform)
+            self._uniform *= height * width
+            np.copyto(self._indices, self._uniform, casting='unsafe')
+            np.take(flat, self._indices, axis=0, out=self._sample,
+                mode='clip')
+            return self._sample.reshape(self.sampleSize, 1, -1)
+        return img
+
+    def compute(self, img):
+        '''
+        Compute the histograms of an image and return hist (the joint
+        histogram, if any, is in joint). Both are normalized so that each
+        histogram sums to 1.
+        '''
+        source = self._source(img)
+        self.pixels = source.shape[0] * source.shape[1]
+        scale = 1.0 / self.pixels
+
+        fromJoint = []
+        if self.joint is not None:
+            numJoint = len(self.jointChannels)
+            joint = cv2.calcHist([source], self.jointChannels, None,
+                [self.jointBins] * numJoint, [0, 256] * numJoint,
+                hist=self.joint.reshape(self.joint.shape
+                    + (1,) * (numJoint == 1)))
+            # The binding reads a 3D buffer as a 2D multichannel Mat, so
+            # for three joint channels calcHist() allocates its own output
+            # instead of filling joint; copy it in.
+            if not np.may_share_memory(joint, self.joint):
+                self.joint[...] = joint.reshape(self.joint.shape)
+            self.joint *= scale
+            if self.jointBins == self.bins:
+                fromJoint = self.jointChannels
+                for axis, channel in enumerate(self.jointChannels):
+                    others = tuple(a for a in range(numJoint) if a != axis)
+                    self.hist[self.channels.index(channel)] = self.joint.sum(
+                        axis=others)
+
+        for i, channel in enumerate(self.channels):
+            if channel not in fromJoint:
+                cv2.calcHist([source], [channel], None, [self.bins],
+                    [0, 256], hist=self.hist[i].reshape(self.bins, 1))
+                self.hist[i] *= scale
+        return self.hist
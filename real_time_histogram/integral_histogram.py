@@ -0,0 +1,197 @@
+'''
+Name: integral_histogram.py
+Description: Integral histograms of video frames. The integral histogram is
+    built once per frame, after which the per-channel histogram of any
+    axis-aligned rectangle (e.g., each tile of a grid or each tracked box)
+    is found from four lookups in O(bins) time, regardless of the size of
+    the rectangle or the number of rectangles.
+'''
+
+import numpy as np
+import cv2
+
+class IntegralHistogram:
+    '''
+    Class holding the integral histogram of each of the given channels of an
+    8-bit image: integral[y, x, c, b] is the number of pixels above and to
+    the left of cell (y, x) whose channel c falls in bin b.
+
+    Memory is (rows + 1) x (cols + 1) x channels x bins counts, so it is
+    kept in check in three ways:
+        cell: the integral histogram is built on a grid of cell x cell
+            pixel cells rather than on single pixels. Query rectangles are
+            expanded outward to cell boundaries, so results are exact for
+            rectangles aligned to the grid (e.g., tiles whose size is a
+            multiple of cell) and cover up to cell - 1 extra pixels on each
+            side otherwise. If cell is None, the smallest cell for which the
+            integral histogram fits in maxBytes is used.
+        dtype: counts are stored as uint16 if the image has fewer than
+            65536 pixels and as uint32 otherwise. Region counts are computed
+            with unsigned wraparound, which is exact since they can't
+            exceed the dtype's range.
+        bins: memory is proportional to the number of bins; for a 1080p
+            frame with 3 channels and 16 bins, 4x4-pixel cells take about
+            25 MB and 8x8-pixel cells about 6 MB.
+    '''
+    def __init__(self, bins=16, channels=(0, 1, 2), cell=None,
+            maxBytes=32 << 20):
+        if not 1 <= bins <= 256:
+            raise ValueError('bins must be between 1 and 256')
+        self.bins = bins
+        self.channels = list(channels)
+        self.fixedCell = cell
+        self.maxBytes = maxBytes
+
+        # Map 8-bit values to bin indices with one cv2.LUT() pass.
+        self._binLut = ((np.arange(256) * bins) >> 8).astype(np.uint8)
+
+        self.cell = None
+        self.shape = None
+        self.dtype = None
+        self.integral = None
+        self._bandKeys = None
+        self._keys = None
+        self._rowSum = None
+
+    @staticmethod
+    def memoryBytes(shape, bins, numChannels, cell=1):
+        '''
+        Return the size in bytes of the integral histogram of an image of
+        the given (height, width) with the given bins, channels, and cell.
+        '''
+        (height, width) = shape[:2]
+        itemSize = 2 if height * width < (1 << 16) else 4
+        return ((-(-height // cell) + 1) * (-(-width // cell) + 1)
+            * numChannels * bins * itemSize)
+
+    def _allocate(self, shape):
+        (height, width) = shape
+        numChannels = len(self.channels)
+        cell = self.fixedCell
+        if cell is None:
+            cell = cellForBudget(shape, self.bins, numChannels, self.maxBytes)
+        self.cell = cell
+        self.shape = shape
+        self.dtype = np.uint16 if height * width < (1 << 16) else np.uint32
+
+        rows = -(-height // cell)
+        cols = -(-width // cell)
+        self.integral = np.zeros((rows + 1, cols + 1, numChannels, self.bins),
+            dtype=self.dtype)
+
+        # Key of each pixel (within a band of one row of cells) for counting
+        # with np.bincount: (cell column * channels + channel) * bins + bin.
+        columnKeys = ((np.arange(width) // cell)[:, None] * numChannels
+            + np.arange(numChannels)) * self.bins
+        self._bandKeys = np.ascontiguousarray(np.broadcast_to(columnKeys,
+            (cell, width, numChannels)), dtype=np.intp)
+        self._keys = np.empty_like(self._bandKeys)
+        self._rowSum = np.empty((cols, numChannels, self.bins),
+            dtype=self.dtype)
+
+    def build(self, img):
+        '''Build the integral histogram of an image; returns self.'''
+        shape = img.shape[:2]
+        if self.shape != shape:
+            self._allocate(shape)
+
+        binned = cv2.LUT(img, self._binLut)
+        if binned.ndim == 2:
+            binned = binned[..., None]
+        if self.channels != list(range(binned.shape[2])):
+            binned = binned[..., self.channels]
+
+        # Count pixels per cell, channel, and bin one band of cell rows at a
+        # time, so the counts stay in cache, and add each band's cumulative
+        # sum across columns to the row above it.
+        (rows, cols) = (self.integral.shape[0] - 1, self.integral.shape[1] - 1)
+        numBins = cols * len(self.channels) * self.bins
+        for row in range(rows):
+            band = binned[row * self.cell:(row + 1) * self.cell]
+            keys = self._keys[:band.shape[0]]
+            np.add(self._bandKeys[:band.shape[0]], band, out=keys)
+            counts = np.bincount(keys.ravel(), minlength=numBins)
+            np.cumsum(counts.reshape(self._rowSum.shape), axis=0,
+                dtype=self.dtype, out=self._rowSum)
+            np.add(self.integral[row, 1:], self._rowSum,
+                out=self.integral[row + 1, 1:])
+        return self
+
+    def _cells(self, rects):
+        '''
+        Convert an Nx4 array of pixel rectangles (x, y, width, height) to
+        cell coordinates (x0, y0, x1, y1), expanded outward to cell
+        boundaries and clipped to the image.
+        '''
+        rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+        (rows, cols) = (self.integral.shape[0] - 1, self.integral.shape[1] - 1)
+        x0 = np.clip(rects[:, 0] // self.cell, 0, cols)
+        y0 = np.clip(rects[:, 1] // self.cell, 0, rows)
+        x1 = np.clip(-(-(rects[:, 0] + rects[:, 2]) // self.cell), 0, cols)
+        y1 = np.clip(-(-(rects[:, 1] + rects[:, 3]) // self.cell), 0, rows)
+        return x0, y0, x1, y1
+
+    def histograms(self, rects, normalize=True):
+        '''
+        Return the per-channel histograms of many rectangles at once, given
+        as an Nx4 array of (x, y, width, height), as an N x channels x bins
+        array: normalized to fractions of pixels (float32), or pixel counts
+        if not normalize. Each takes four lookups, so the cost depends only
+        on N and the number of bins.
+        '''
+        (x0, y0, x1, y1) = self._cells(rects)
+        integral = self.integral
+        counts = ((integral[y1, x1] + integral[y0, x0])
+            - (integral[y0, x1] + integral[y1, x0]))
+        if not normalize:
+            return counts
+        hist = counts.astype(np.float32)
+        totals = hist[:, :1].sum(axis=2, keepdims=True)
+        np.divide(hist, totals, out=hist, where=totals > 0)
+        return hist
+
+    def histogram(self, x, y, width, height, normalize=True):
+        '''Return the channels x bins histogram of one rectangle.'''
+        return self.histograms([(x, y, width, height)], normalize)[0]
+
+    @staticmethod
+    def grid(shape, rows, cols, cell=1):
+        '''
+        Return the rectangles (x, y, width, height) of a rows x cols grid of
+        tiles covering an image of the given (height, width), in row-major
+        order, for use with histograms(). Tile edges are rounded to
+        multiples of cell (pass the integral histogram's cell), so the
+        tiles stay aligned to its grid and partition the image exactly
+        instead of sharing the cells their edges would cut through.
+        '''
+        (height, width) = shape[:2]
+        ys = _snap(np.linspace(0, height, rows + 1), cell, height)
+        xs = _snap(np.linspace(0, width, cols + 1), cell, width)
+        (tileY, tileX) = np.meshgrid(np.arange(rows), np.arange(cols),
+            indexing='ij')
+        return np.stack([xs[tileX], ys[tileY], xs[tileX + 1] - xs[tileX],
+            ys[tileY + 1] - ys[tileY]], axis=-1).reshape(-1, 4)
+
+    @property
+    def nbytes(self):
+        return 0 if self.integral is None else self.integral.nbytes
+
+def _snap(edges, cell, size):
+    '''
+    Round tile edges to the nearest multiple of cell, keeping the last edge
+    at size (the image's last cell may be partial).
+    '''
+    edges = np.minimum(np.rint(edges / cell).astype(np.int64) * cell, size)
+    edges[-1] = size
+    return edges
+
+def cellForBudget(shape, bins, numChannels, maxBytes):
+    '''
+    Return the smallest power-of-two cell size for which the integral
+    histogram of an image of the given shape fits in maxBytes.
+    '''
+    cell = 1
+    while (cell < max(shape[:2]) and IntegralHistogram.memoryBytes(shape,
+            bins, numChannels, cell) > maxBytes):
+        cell *= 2
+    return cell
@@ -0,0 +1,212 @@
+'''
+Name: live_histogram.py
+Description: Classes used by real_time_histogram.py to compute video
+    histograms at the full capture rate in a worker thread and to plot them
+    with matplotlib at a limited refresh rate, so that the video never
+    waits on the plot.
+'''
+
+from threading import Lock, Thread
+import time
+import numpy as np
+import cv2
+from histogram_engine import HistogramEngine
+
+# Channel indices (into the image the histograms are computed from), in
+# plotting order, for each color mode.
+CHANNELS = {
+    'gray': [0],
+    'rgb': [2, 1, 0],
+    'lab': [0, 1, 2],
+    }
+
+class HistogramWorker:
+    '''
+    Class that reads frames from a capture object (e.g., a FrameSource) in a
+    dedicated thread and computes the normalized histogram of each channel
+    of every frame, for color mode 'gray', 'rgb', or 'lab'.
+
+    Histograms are computed by a HistogramEngine, which counts every pixel
+    or, with stride or maxError, a subsample of them (see HistogramEngine).
+    The latest histograms and an exponentially smoothed version of them
+    (each update keeps a fraction smoothing of the previous smoothed value)
+    can be read at any time with histograms(). The image to display (the
+    grayscale image in 'gray' mode, else the frame) is passed to the
+    consumer through three buffers: one being written by the worker, one
+    holding the newest complete image, and one being displayed, so neither
+    side ever waits for the other or copies an image.
+    '''
+    def __init__(self, capture, color='gray', bins=16, smoothing=0.0,
+            stride=1, maxError=None):
+        if color not in CHANNELS:
+            raise ValueError('Invalid color {!r}; expected one of {}'.format(
+                color, ', '.join(CHANNELS)))
+        if not 0 <= smoothing < 1:
+            raise ValueError('smoothing must be in [0, 1)')
+
+        self.capture = capture
+        self.color = color
+        self.bins = bins
+        self.smoothing = smoothing
+        self.channels = CHANNELS[color]
+
+        self.engine = HistogramEngine(bins, self.channels, stride=stride,
+            maxError=maxError)
+        numChannels = len(self.channels)
+        self.latest = np.zeros((numChannels, bins), dtype=np.float32)
+        self.smoothed = np.zeros((numChannels, bins), dtype=np.float32)
+
+        # Display buffers: [writing, ready, displayed].
+        self._images = [None, None, None]
+        self._frame = None
+        self._converted = None
+        self._newImage = False
+        self._lock = Lock()
+
+        self.frames = 0
+        self.stopped = False
+        self._thread = None
+        self.startTime = None
+        self.endTime = None
+
+    def start(self):
+        self.startTime = time.perf_counter()
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _read(self):
+        '''
+        Read the next frame and return the image to compute histograms from
+        and the image to display, or None at the end of the stream.
+        '''
+        if self.color == 'gray':
+            (grabbed, self._frame) = self.capture.read(self._frame)
+            if not grabbed:
+                return None
+            gray = cv2.cvtColor(self._frame, cv2.COLOR_BGR2GRAY,
+                dst=self._images[0])
+            return gray, gray
+
+        (grabbed, frame) = self.capture.read(self._images[0])
+        if not grabbed:
+            return None
+        if self.color == 'lab':
+            self._converted = cv2.cvtColor(frame, cv2.COLOR_BGR2LAB,
+                dst=self._converted)
+            return self._converted, frame
+        return frame, frame
+
+    def run(self):
+        while not self.stopped:
+            images = self._read()
+            if images is None:
+                break
+            (source, display) = images
+            hist = self.engine.compute(source)
+
+            with self._lock:
+                self.latest[:] = hist
+                if self.frames == 0 or not self.smoothing:
+                    self.smoothed[:] = hist
+                else:
+                    self.smoothed *= self.smoothing
+                    self.smoothed += (1 - self.smoothing) * hist
+                self._images[0] = self._images[1]
+                self._images[1] = display
+                self._newImage = True
+                self.frames += 1
+        self.endTime = time.perf_counter()
+        self.stopped = True
+
+    def histograms(self, smoothed=False):
+        '''
+        Return a copy of the latest (or smoothed) histograms as a
+        (channels x bins) array.
+        '''
+        with self._lock:
+            return (self.smoothed if smoothed else self.latest).copy()
+
+    def image(self):
+        '''
+        Return the newest image to display, or None if there is none since
+        the last call. The image stays valid until the next call.
+        '''
+        with self._lock:
+            if not self._newImage:
+                return None
+            (self._images[1], self._images[2]) = (self._images[2],
+                self._images[1])
+            self._newImage = False
+            return self._images[2]
+
+    def rate(self):
+        '''Return the average number of frames processed per second.'''
+        end = self.endTime if self.endTime is not None else time.perf_counter()
+        elapsed = end - self.startTime if self.startTime is not None else 0
+        return self.frames / elapsed if elapsed > 0 else 0.0
+
+    def stop(self):
+        '''
+        Stop the worker and wait for it to finish with the current frame,
+        so the capture object can be released safely.
+        '''
+        self.stopped = True
+        if self._thread is not None:
+            self._thread.join()
+
+class HistogramPlotter:
+    '''
+    Class that updates the y-data of a set of matplotlib line artists (one
+    per channel) at most maxRate times per second. Lines are drawn with
+    blitting: the static parts of the figure (axes, labels, legend) are
+    rendered once and saved, and each update restores them and redraws
+    only the lines, instead of redrawing the whole figure. The saved
+    background is refreshed whenever the figure is fully redrawn (e.g.,
+    when the window is resized). Backends that don't support blitting
+    fall back to a full redraw on each update.
+    '''
+    def __init__(self, fig, lines, maxRate=10.0):
+        self.fig = fig
+        self.lines = lines
+        self.interval = 1.0 / maxRate if maxRate > 0 else 0.0
+        self.nextUpdate = 0.0
+        self.updates = 0
+
+        self.canvas = fig.canvas
+        self.blit = self.canvas.supports_blit
+        self.background = None
+        if self.blit:
+            for line in lines:
+                line.set_animated(True)
+            self.canvas.mpl_connect('draw_event', self._onDraw)
+        self.canvas.draw()
+
+    def _onDraw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._drawLines()
+
+    def _drawLines(self):
+        for line in self.lines:
+            self.fig.draw_artist(line)
+
+    def due(self, now=None):
+        '''Return whether an update is allowed by the maximum rate.'''
+        now = time.perf_counter() if now is None else now
+        return now >= self.nextUpdate
+
+    def update(self, histograms, now=None):
+        '''Plot histograms (channels x bins), one row per line.'''
+        now = time.perf_counter() if now is None else now
+        self.nextUpdate = now + self.interval
+        for line, histogram in zip(self.lines, histograms):
+            line.set_ydata(histogram)
+
+        if self.blit and self.background is not None:
+            self.canvas.restore_region(self.background)
+            self._drawLines()
+            self.canvas.blit(self.fig.bbox)
+        else:
+            self.canvas.draw_idle()
+        self.canvas.flush_events()
+        self.updates += 1
@@ -11,8 +11,15 @@ Created: 2018-Feb-07
 import numpy as np
 import matplotlib.pyplot as plt
 import argparse
+import os
+import sys
 import cv2
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'multithread'))
+from FrameSource import FrameSource
+from live_histogram import HistogramPlotter, HistogramWorker
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-f', '--file',
     help='Path to video file (if not using camera)')
@@ -22,17 +29,34 @@ parser.add_argument('-b', '--bins', type=int, default=16,
     help='Number of bins per channel (default 16)')
 parser.add_argument('-w', '--width', type=int, default=0,
     help='Resize video to specified width in pixels (maintains aspect)')
+parser.add_argument('-s', '--step', type=int, default=1,
+    help='Process every STEP-th frame; others are skipped without decoding')
+parser.add_argument('--start', type=float,
+    help='Start time in seconds (video file only)')
+parser.add_argument('--end', type=float,
+    help='End time in seconds (video file only)')
+parser.add_argument('--stride', type=int, default=1,
+    help='Compute histograms from every STRIDE-th pixel of every STRIDE-th'
+        + ' row (default 1, all pixels)')
+parser.add_argument('--max-error', type=float,
+    help='Compute histograms from a random sample of pixels, sized so that'
+        + ' each bin is within MAX_ERROR (a fraction of pixels, e.g. 0.01)'
+        + ' of its exact value with 99%% confidence')
+parser.add_argument('-r', '--plot-rate', type=float, default=10,
+    help='Maximum plot refreshes per second (default 10)')
+parser.add_argument('--smoothing', type=float, default=0,
+    help='Plot an exponentially smoothed histogram, keeping this fraction'
+        + ' of the previous value each frame (0 <= SMOOTHING < 1; default'
+        + ' 0 plots the latest histogram)')
 args = vars(parser.parse_args())
 
-# Configure VideoCapture class instance for using camera or file input.
-if not args.get('file', False):
-    capture = cv2.VideoCapture(0)
-else:
-    capture = cv2.VideoCapture(args['file'])
+# Configure FrameSource for using camera or file input. It skips and
+# resizes frames as requested and seeks to the start time, if given.
+capture = FrameSource(args['file'] or 0, step=args['step'],
+    width=args['width'], start_time=args['start'], end_time=args['end'])
 
 color = args['color']
 bins = args['bins']
-resizeWidth = args['width']
 
 # Initialize plot.
 fig, ax = plt.subplots()
@@ -52,62 +76,48 @@ if color == 'rgb':
     lineR, = ax.plot(np.arange(bins), np.zeros((bins,)), c='r', lw=lw, alpha=alpha, label='Red')
     lineG, = ax.plot(np.arange(bins), np.zeros((bins,)), c='g', lw=lw, alpha=alpha, label='Green')
     lineB, = ax.plot(np.arange(bins), np.zeros((bins,)), c='b', lw=lw, alpha=alpha, label='Blue')
+    lines = [lineR, lineG, lineB]
+    window = 'RGB'
 elif color == 'lab':
     lineL, = ax.plot(np.arange(bins), np.zeros((bins,)), c='k', lw=lw, alpha=alpha, label='L*')
     lineA, = ax.plot(np.arange(bins), np.zeros((bins,)), c='b', lw=lw, alpha=alpha, label='a*')
     lineB, = ax.plot(np.arange(bins), np.zeros((bins,)), c='y', lw=lw, alpha=alpha, label='b*')
+    lines = [lineL, lineA, lineB]
+    window = 'L*a*b*'
 else:
     lineGray, = ax.plot(np.arange(bins), np.zeros((bins,1)), c='k', lw=lw, label='intensity')
+    lines = [lineGray]
+    window = 'Grayscale'
 ax.set_xlim(0, bins-1)
 ax.set_ylim(0, 1)
 ax.legend()
 plt.ion()
 plt.show()
 
-# Grab, process, and display video frames. Update plot line object(s).
+# Histograms of every frame are computed in a worker thread at the full
+# capture rate. This loop only shows the newest frame and, at most
+# --plot-rate times per second, plots the newest (or smoothed) histograms
+# by blitting the lines onto the saved figure background, so the video
+# never waits on the plot.
+worker = HistogramWorker(capture, color, bins, args['smoothing'],
+    args['stride'], args['max_error']).start()
+plotter = HistogramPlotter(fig, lines, args['plot_rate'])
+smoothed = args['smoothing'] > 0
 while True:
-    (grabbed, frame) = capture.read()
-
-    if not grabbed:
+    image = worker.image()
+    if image is not None:
+        cv2.imshow(window, image)
+    elif worker.stopped:
         break
 
-    # Resize frame to width, if specified.
-    if resizeWidth > 0:
-        (height, width) = frame.shape[:2]
-        resizeHeight = int(float(resizeWidth / width) * height)
-        frame = cv2.resize(frame, (resizeWidth, resizeHeight),
-            interpolation=cv2.INTER_AREA)
-
-    # Normalize histograms based on number of pixels per frame.
-    numPixels = np.prod(frame.shape[:2])
-    if color == 'rgb':
-        cv2.imshow('RGB', frame)
-        (b, g, r) = cv2.split(frame)
-        histogramR = cv2.calcHist([r], [0], None, [bins], [0, 255]) / numPixels
-        histogramG = cv2.calcHist([g], [0], None, [bins], [0, 255]) / numPixels
-        histogramB = cv2.calcHist([b], [0], None, [bins], [0, 255]) / numPixels
-        lineR.set_ydata(histogramR)
-        lineG.set_ydata(histogramG)
-        lineB.set_ydata(histogramB)
-    elif color == 'lab':
-        cv2.imshow('L*a*b*', frame)
-        lab = cv2.cvtColor(frame, cv2.COLOR_BGR2LAB)
-        (l, a, b) = cv2.split(lab)
-        histogramL = cv2.calcHist([l], [0], None, [bins], [0, 255]) / numPixels
-        histogramA = cv2.calcHist([a], [0], None, [bins], [0, 255]) / numPixels
-        histogramB = cv2.calcHist([b], [0], None, [bins], [0, 255]) / numPixels
-        lineL.set_ydata(histogramL)
-        lineA.set_ydata(histogramA)
-        lineB.set_ydata(histogramB)
-    else:
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        cv2.imshow('Grayscale', gray)
-        histogram = cv2.calcHist([gray], [0], None, [bins], [0, 255]) / numPixels
-        lineGray.set_ydata(histogram)
-    fig.canvas.draw()
+    if plotter.due() and worker.frames:
+        plotter.update(worker.histograms(smoothed))
 
     if cv2.waitKey(1) & 0xFF == ord('q'):
         break
 
+worker.stop()
+print('{} frames at {:.1f} frames/sec, {} plot updates'.format(
+    worker.frames, worker.rate(), plotter.updates))
 capture.release()
 cv2.destroyAllWindows()
@@ -0,0 +1,346 @@
+'''
+Name: scene_index.py
+Description: Streaming shot/scene-change detection from per-frame
+    histograms. Each frame's histograms are compared with the previous
+    frame's, and a change is declared when the distance stands out from the
+    recent distances (an adaptive threshold). The result is a compact
+    on-disk index (.npz) of the scenes of a video: where each one starts
+    and ends, and a representative keyframe of each, so that downstream
+    tools can process only keyframes or changed segments and seek straight
+    to them. Histograms are computed from the video, or read from the output
+    of extract_histograms.py. For usage, type:
+    > python scene_index.py -h
+'''
+
+import argparse
+from collections import namedtuple
+import json
+import os
+import sys
+import numpy as np
+import cv2
+from histogram_engine import HistogramEngine
+from live_histogram import CHANNELS
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'multithread'))
+from FrameSource import FrameSource
+
+# A detected scene: frames [start, end) of the video, its keyframe, the
+# timestamps (in seconds, or NaN if unknown) of its first frame and
+# keyframe, and the histogram distance at the change that started it (0
+# for the first scene).
+Scene = namedtuple('Scene', ['start', 'end', 'keyframe', 'start_time',
+    'keyframe_time', 'score'])
+
+def histogramDistance(hist, previous):
+    '''
+    Return the total variation distance between two sets of normalized
+    histograms (channels x bins), averaged over channels: 0 for identical
+    histograms, 1 for histograms with no overlap.
+    '''
+    return 0.5 * float(np.abs(hist - previous).sum()) / hist.shape[0]
+
+class SceneDetector:
+    '''
+    Class that detects scene changes in a stream of per-frame histograms.
+
+    The distance between consecutive frames (see histogramDistance()) is
+    compared against an adaptive threshold: the exponentially weighted
+    mean of recent distances plus sensitivity times their standard
+    deviation (with weight decay per frame), but at least minThreshold.
+    Distances above the threshold are left out of the statistics, so a cut
+    doesn't raise the threshold for the next one.
+
+    Scenes must be at least minSceneFrames frames long. A scene is only
+    reported once the scene after it has reached that length; if another
+    change comes first (e.g., a camera flash, which changes the histograms
+    twice within a few frames), the short scene is merged into the one
+    before it, and the new scene starts at the latest change.
+
+    The keyframe of each scene is its most static frame, the one that
+    differs least from the frame before it (excluding the first frame
+    after a cut), so it is unlikely to be blurred or mid-transition. If
+    frames are passed to update(), a copy of the keyframe image is kept
+    and passed to onScene.
+
+    step is the number of video frames between consecutive frames passed
+    to update(), used to end the last scene after its last frame.
+
+    onScene, if given, is called with each Scene (and the keyframe image,
+    or None) as soon as it is reported, so scenes can be handled as the
+    video streams; finish() reports the remaining scenes.
+    '''
+    def __init__(self, sensitivity=4.0, minThreshold=0.1, minSceneFrames=10,
+            decay=0.05, step=1, onScene=None):
+        self.sensitivity = sensitivity
+        self.minThreshold = minThreshold
+        self.minSceneFrames = minSceneFrames
+        self.decay = decay
+        self.step = max(1, step)
+        self.onScene = onScene
+
+        self.scenes = []
+        self._previous = None
+        self._mean = 0.0
+        self._var = 0.0
+        self._samples = 0
+        self._scene = None
+        self._pending = None
+        self._lastFrame = None
+
+    def threshold(self):
+        '''Return the current change threshold.'''
+        return max(self.minThreshold,
+            self._mean + self.sensitivity * np.sqrt(self._var))
+
+    def _newScene(self, frameIdx, timestamp, score, frame):
+        self._scene = {'start': frameIdx, 'startTime': timestamp,
+            'score': score, 'frames': 1, 'keyframe': frameIdx,
+            'keyTime': timestamp, 'keyDistance': np.inf,
+            'keyImage': None if frame is None else frame.copy()}
+
+    def _report(self, scene, end):
+        result = Scene(scene['start'], end, scene['keyframe'],
+            scene['startTime'], scene['keyTime'], scene['score'])
+        self.scenes.append(result)
+        if self.onScene is not None:
+            self.onScene(result, scene['keyImage'])
+
+    def update(self, frameIdx, timestamp, hist, frame=None):
+        '''
+        Add the histograms (channels x bins) of the next frame, with its
+        index in the video and timestamp (or None). Returns True if a new
+        scene (so far) starts at this frame.
+        '''
+        timestamp = np.nan if timestamp is None else timestamp
+        if self._previous is None:
+            self._previous = hist.copy()
+            self._newScene(frameIdx, timestamp, 0.0, frame)
+            self._lastFrame = frameIdx
+            return False
+
+        distance = histogramDistance(hist, self._previous)
+        self._previous[:] = hist
+        self._lastFrame = frameIdx
+        scene = self._scene
+        exceeds = distance > self.threshold()
+
+        if exceeds and scene['frames'] >= self.minSceneFrames:
+            if self._pending is not None:
+                self._report(*self._pending)
+            self._pending = (scene, frameIdx)
+            self._newScene(frameIdx, timestamp, distance, frame)
+            return True
+        if exceeds and self._pending is not None:
+            # The current scene is too short: merge it into the previous
+            # one, which now ends here, and start over.
+            self._pending = (self._pending[0], frameIdx)
+            self._newScene(frameIdx, timestamp, distance, frame)
+            return True
+
+        if not exceeds:
+            # Exponentially weighted mean and variance of the distances.
+            self._samples += 1
+            rate = max(self.decay, 1.0 / self._samples)
+            delta = distance - self._mean
+            self._mean += rate * delta
+            self._var = (1 - rate) * (self._var + rate * delta * delta)
+
+        scene['frames'] += 1
+        if distance < scene['keyDistance']:
+            scene['keyframe'] = frameIdx
+            scene['keyTime'] = timestamp
+            scene['keyDistance'] = distance
+            if frame is not None:
+                if (scene['keyImage'] is None
+                        or scene['keyImage'].shape != frame.shape):
+                    scene['keyImage'] = frame.copy()
+                else:
+                    scene['keyImage'][...] = frame
+        if self._pending is not None and (
+                scene['frames'] >= self.minSceneFrames):
+            self._report(*self._pending)
+            self._pending = None
+        return False
+
+    def finish(self, frameCount=None):
+        '''
+        Report the remaining scenes and return the list of Scenes. The last
+        scene ends where the next sampled frame would be, or at frameCount
+        (the number of frames in the video), if given and smaller.
+        '''
+        if self._pending is not None:
+            self._report(*self._pending)
+            self._pending = None
+        if self._scene is not None:
+            end = self._lastFrame + self.step
+            if frameCount:
+                end = max(self._lastFrame + 1, min(end, frameCount))
+            self._report(self._scene, end)
+            self._scene = None
+        return self.scenes
+
+def saveIndex(path, scenes, params):
+    '''
+    Save scenes to a compressed .npz index, with the parameters used to
+    detect them (as JSON).
+    '''
+    columns = list(zip(*scenes)) if scenes else [()] * len(Scene._fields)
+    arrays = {}
+    for field, values in zip(Scene._fields, columns):
+        dtype = np.int64 if field in ('start', 'end', 'keyframe') else (
+            np.float64 if field.endswith('time') else np.float32)
+        arrays[field] = np.array(values, dtype=dtype)
+    np.savez_compressed(path, params=json.dumps(params), **arrays)
+
+def loadIndex(path):
+    '''
+    Load an index saved with saveIndex(). Returns (scenes, params): a list
+    of Scenes and the parameters dict.
+    '''
+    data = np.load(path)
+    columns = [data[field].tolist() for field in Scene._fields]
+    return ([Scene(*values) for values in zip(*columns)],
+        json.loads(str(data['params'])))
+
+def readKeyframes(video, scenes, width=0):
+    '''
+    Generate (scene, image) for each scene in an index, seeking straight to
+    each keyframe of the video instead of decoding the frames in between.
+    '''
+    for scene in scenes:
+        capture = FrameSource(video, width=width, start_frame=scene.keyframe,
+            end_frame=scene.keyframe + 1)
+        (grabbed, image) = capture.read()
+        capture.release()
+        if grabbed:
+            yield scene, image
+
+def _keyframePath(directory, scene):
+    return os.path.join(directory, 'scene_{:05d}_frame_{:07d}.jpg'.format(
+        scene.start, scene.keyframe))
+
+def indexVideo(video, color='rgb', bins=16, step=1, width=0, stride=1,
+        max_error=None, keyframesDir=None, **detectorArgs):
+    '''
+    Detect the scenes of a video file (or camera) in one streaming pass,
+    computing histograms with a HistogramEngine. If keyframesDir is given,
+    each scene's keyframe is written there as a JPEG as soon as the scene
+    ends. Returns the list of Scenes.
+    '''
+    def onScene(scene, image):
+        if keyframesDir is not None and image is not None:
+            cv2.imwrite(_keyframePath(keyframesDir, scene), image)
+
+    if keyframesDir is not None:
+        os.makedirs(keyframesDir, exist_ok=True)
+    detector = SceneDetector(step=step, onScene=onScene, **detectorArgs)
+    engine = HistogramEngine(bins, CHANNELS[color], stride=stride,
+        maxError=max_error)
+    capture = FrameSource(video, step=step, width=width)
+    if not capture.isOpened():
+        raise RuntimeError('Error opening video {}'.format(video))
+
+    frame = converted = None
+    while True:
+        (grabbed, frame) = capture.read(frame)
+        if not grabbed:
+            break
+        if color == 'gray':
+            converted = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=converted)
+        elif color == 'lab':
+            converted = cv2.cvtColor(frame, cv2.COLOR_BGR2LAB, dst=converted)
+        else:
+            converted = frame
+        detector.update(capture.frame_idx, capture.timestamp,
+            engine.compute(converted),
+            frame if keyframesDir is not None else None)
+    frameCount = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    capture.release()
+    return detector.finish(frameCount if frameCount > 0 else None)
+
+def indexHistograms(histogramsPath, **detectorArgs):
+    '''
+    Detect scenes from histograms extracted with extract_histograms.py,
+    without decoding the video. Returns (scenes, params), where params are
+    the extraction parameters.
+    '''
+    stem = histogramsPath[:-4] if histogramsPath.endswith('.npy') else (
+        histogramsPath)
+    with open(stem + '.json') as f:
+        params = json.load(f)['params']
+    histograms = np.load(stem + '.npy', mmap_mode='r')
+    timestamps = np.load(stem + '_timestamps.npy', mmap_mode='r')
+
+    detector = SceneDetector(step=params['step'], **detectorArgs)
+    for row in range(histograms.shape[0]):
+        hist = np.asarray(histograms[row])
+        if np.isnan(hist[0, 0]):
+            continue
+        timestamp = float(timestamps[row])
+        detector.update(row * params['step'], None if np.isnan(timestamp)
+            else timestamp, hist)
+    return detector.finish(params['frames']), params
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('input',
+        help='Path to video file, or to a .npy file of histograms written by'
+            + ' extract_histograms.py')
+    ap.add_argument('-o', '--output', required=True,
+        help='Output scene index (.npz)')
+    ap.add_argument('-k', '--keyframes-dir', default=None,
+        help='Directory to which the keyframe of each scene is written')
+    ap.add_argument('-c', '--color', type=str, default='rgb',
+        help='Color space: "gray", "rgb" (default), or "lab"')
+    ap.add_argument('-b', '--bins', type=int, default=16,
+        help='Number of bins per channel (default 16)')
+    ap.add_argument('-s', '--step', type=int, default=1,
+        help='Process every STEP-th frame; others are skipped without decoding')
+    ap.add_argument('-w', '--width', type=int, default=0,
+        help='Resize frames to specified width in pixels (maintains aspect)')
+    ap.add_argument('--stride', type=int, default=1,
+        help='Compute histograms from every STRIDE-th pixel of every'
+            + ' STRIDE-th row (default 1, all pixels)')
+    ap.add_argument('--max-error', type=float,
+        help='Compute histograms from a random sample of pixels with at'
+            + ' most this error per bin (99%% confidence)')
+    ap.add_argument('--sensitivity', type=float, default=4.0,
+        help='Standard deviations above the mean recent histogram distance'
+            + ' at which a change is declared (default 4)')
+    ap.add_argument('--min-threshold', type=float, default=0.1,
+        help='Minimum histogram distance (0-1) of a change (default 0.1)')
+    ap.add_argument('--min-scene-frames', type=int, default=10,
+        help='Minimum number of processed frames per scene (default 10)')
+    args = vars(ap.parse_args())
+
+    detectorArgs = {'sensitivity': args['sensitivity'],
+        'minThreshold': args['min_threshold'],
+        'minSceneFrames': args['min_scene_frames']}
+    if args['input'].endswith('.npy'):
+        scenes, params = indexHistograms(args['input'], **detectorArgs)
+        if args['keyframes_dir'] is not None:
+            os.makedirs(args['keyframes_dir'], exist_ok=True)
+            for scene, image in readKeyframes(params['video'], scenes,
+                    params['width']):
+                cv2.imwrite(_keyframePath(args['keyframes_dir'], scene),
+                    image)
+    else:
+        params = {'video': os.path.abspath(args['input']),
+            'color': args['color'], 'bins': args['bins'],
+            'step': args['step'], 'width': args['width'],
+            'stride': args['stride'], 'max_error': args['max_error']}
+        scenes = indexVideo(args['input'], args['color'], args['bins'],
+            args['step'], args['width'], args['stride'], args['max_error'],
+            args['keyframes_dir'], **detectorArgs)
+    params.update(detectorArgs)
+    saveIndex(args['output'], scenes, params)
+
+    for i, scene in enumerate(scenes):
+        print('Scene {}: frames {}-{}, keyframe {}'.format(i, scene.start,
+            scene.end - 1, scene.keyframe))
+    print('{} scenes written to {}'.format(len(scenes), args['output']))
+
+if __name__ == '__main__':
+    main()